@@ -0,0 +1,197 @@
+"""
+    c3sdb/build_utils/_bulk.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module with utilities for bulk writes to the database during the build: batched
+    inserts, mass updates through temporary tables, build-time PRAGMAs, building in
+    memory, and finalizing the database file
+"""
+
+
+from typing import Iterable, Tuple, List, Any
+from itertools import islice
+import sqlite3
+import os
+
+
+# default number of rows per executemany call
+_CHUNK_SIZE: int = 10000
+
+# PRAGMAs to use while building the database, WAL journaling with synchronous=NORMAL
+# is still safe against the build process crashing (committed transactions survive)
+_BUILD_PRAGMAS: List[Tuple[str, str | int]] = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    # negative cache_size is in KiB (so this is 256 MiB)
+    ("cache_size", -256000),
+    ("temp_store", "MEMORY"),
+]
+
+
+def set_build_pragmas(con: sqlite3.Connection
+                      ) -> None :
+    """
+    Sets PRAGMAs for faster bulk writes while building the database (see _BUILD_PRAGMAS),
+    `finalize_db` puts the journaling mode back to the default
+
+    Parameters
+    ----------
+    con : ``sqlite3.Connection``
+        connection to C3S.db
+    """
+    for pragma, value in _BUILD_PRAGMAS:
+        con.execute(f"PRAGMA {pragma}={value}")
+
+
+def executemany_chunked(cursor: sqlite3.Cursor,
+                        qry: str,
+                        rows: Iterable[Tuple[Any, ...]],
+                        chunk_size: int = _CHUNK_SIZE
+                        ) -> int :
+    """
+    Runs a query with executemany on bounded chunks of rows, rows can be any iterable
+    (e.g. a generator) and are only pulled one chunk at a time
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    qry : ``str``
+        parameterized query (e.g. INSERT)
+    rows : ``iterable(tuple(...))``
+        query parameters for each row
+    chunk_size : ``int``, default=_CHUNK_SIZE
+        maximal number of rows per executemany call
+
+    Returns
+    -------
+    n_changed : ``int``
+        total number of rows changed by the query
+    """
+    n_changed = 0
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        n_changed += cursor.executemany(qry, chunk).rowcount
+    return n_changed
+
+
+def bulk_update(cursor: sqlite3.Cursor,
+                table: str,
+                key: str,
+                columns: List[str],
+                rows: Iterable[Tuple[Any, ...]],
+                chunk_size: int = _CHUNK_SIZE
+                ) -> int :
+    """
+    Updates columns of many rows in a table at once, the new values are first loaded into
+    a temporary table (with executemany) and then the target table is updated with a
+    single UPDATE joined against the temporary table
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    table : ``str``
+        table to update
+    key : ``str``
+        column identifying the rows to update (e.g. g_id)
+    columns : ``list(str)``
+        columns to update
+    rows : ``iterable(tuple(...))``
+        key followed by the new values of the columns (in order) for each row
+    chunk_size : ``int``, default=_CHUNK_SIZE
+        maximal number of rows per executemany call when loading the temporary table
+
+    Returns
+    -------
+    n_updated : ``int``
+        number of rows updated
+    """
+    tmp = f"_bulk_{table}"
+    cursor.execute(f"DROP TABLE IF EXISTS temp.{tmp}")
+    cursor.execute(f"CREATE TEMP TABLE {tmp} ({key} PRIMARY KEY, {', '.join(columns)}) WITHOUT ROWID")
+    qry = f"INSERT OR REPLACE INTO temp.{tmp} VALUES ({','.join('?' * (len(columns) + 1))})"
+    executemany_chunked(cursor, qry, rows, chunk_size=chunk_size)
+    sets = ", ".join([f"{col}=(SELECT {col} FROM temp.{tmp} WHERE {tmp}.{key}={table}.{key})" for col in columns])
+    qry = f"UPDATE {table} SET {sets} WHERE {key} IN (SELECT {key} FROM temp.{tmp})"
+    n_updated = cursor.execute(qry).rowcount
+    cursor.execute(f"DROP TABLE temp.{tmp}")
+    return n_updated
+
+
+def open_build_db(db_path: str,
+                  in_memory: bool = False
+                  ) -> sqlite3.Connection :
+    """
+    Opens a connection to use for building the database with the build-time PRAGMAs set,
+    optionally building in memory (an existing database file is loaded into memory first)
+    in which case the database is written to disk by `save_build_db` at the end
+
+    Parameters
+    ----------
+    db_path : ``str``
+        path to C3S.db
+    in_memory : ``bool``, default=False
+        build in memory instead of on disk
+
+    Returns
+    -------
+    con : ``sqlite3.Connection``
+        connection to use for the build
+    """
+    if not in_memory:
+        con = sqlite3.connect(db_path)
+        set_build_pragmas(con)
+        return con
+    con = sqlite3.connect(":memory:")
+    if os.path.isfile(db_path):
+        disk_con = sqlite3.connect(db_path)
+        disk_con.backup(con)
+        disk_con.close()
+    set_build_pragmas(con)
+    return con
+
+
+def finalize_db(con: sqlite3.Connection,
+                vacuum: bool = True
+                ) -> None :
+    """
+    Finalizes the database at the end of the build: updates the query planner statistics
+    (ANALYZE), optionally rebuilds the database file (VACUUM) and switches the journaling
+    mode back to the default (merging the WAL into the database file)
+
+    Parameters
+    ----------
+    con : ``sqlite3.Connection``
+        connection to C3S.db
+    vacuum : ``bool``, default=True
+        rebuild the database file to remove fragmentation left over from the build
+    """
+    con.commit()
+    con.execute("ANALYZE")
+    con.commit()
+    if vacuum:
+        con.execute("VACUUM")
+    con.execute("PRAGMA journal_mode=DELETE")
+
+
+def save_build_db(con: sqlite3.Connection,
+                  db_path: str,
+                  ) -> None :
+    """
+    Writes a database that was built in memory (see `open_build_db`) to disk using the
+    SQLite backup API, replacing the database file
+
+    Parameters
+    ----------
+    con : ``sqlite3.Connection``
+        connection to the in-memory database
+    db_path : ``str``
+        path to C3S.db
+    """
+    con.commit()
+    disk_con = sqlite3.connect(db_path)
+    con.backup(disk_con)
+    disk_con.execute("PRAGMA journal_mode=DELETE")
+    disk_con.close()
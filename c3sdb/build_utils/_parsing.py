@@ -8,7 +8,8 @@
 
 
 import re
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Any, Iterable, Tuple
+from functools import lru_cache
 
 
 # list of names to exclude that technically match the peptide regex but are not actually peptides
@@ -38,6 +39,27 @@ PEPTIDE_EXCLUSION_PATS: List[str] = [
 ]
 
 
+# compiled patterns, the exclusion patterns are combined into a single alternation
+_PEPTIDE_PAT: re.Pattern = re.compile(r'^[ACDEFGHIKLMNPQRSTVWY]+$')
+_PEPTIDE_EXCLUSION_PAT: re.Pattern = re.compile("|".join([f"(?:{pat})" for pat in PEPTIDE_EXCLUSION_PATS]))
+_PEPTIDE_EXCLUSION_SET: frozenset = frozenset(PEPTIDE_EXCLUSION_LIST)
+_CARBOHYDRATE_PAT: re.Pattern = re.compile("|".join([f"(?:{pat})" for pat in [
+    r'[(]Hex[)][0-9]+',
+    r'^([LD][-])*[A-Za-z]+ose$',
+    r'^[A-Za-z]+itol$',
+    r'.*Cyclodextrin',
+    r'Lacto[-]N[-][A-Za-z]+ose.*',
+]]))
+_LIPID_PAT: re.Pattern = re.compile(
+    r"^(?P<cls>[A-Za-z]+)\((?P<mod>[pdoe]*)(?P<fc1>[0-9]+):(?P<fu1>[0-9]+)"
+    r"[/_]*((?P<fc2>[0-9]+):(?P<fu2>[0-9]+))*[/_]*((?P<fc3>[0-9]+):(?P<fu3>[0-9]+))*\)"
+)
+
+# maximal number of distinct names to keep parsing results for
+_PARSE_CACHE_SIZE: int = 1 << 17
+
+
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
 def parse_carbohydrate(name: str
                        ) -> bool :
     """
@@ -63,17 +85,7 @@ def parse_carbohydrate(name: str
         flag indicating if the name matches one of the carbohydrate
         regex patterns
     """
-    if re.match(r'[(]Hex[)][0-9]+', name):
-        return True
-    if re.match(r'^([LD][-])*[A-Za-z]+ose$', name):
-        return True
-    if re.match(r'^[A-Za-z]+itol$', name):
-        return True
-    if re.match(r'.*Cyclodextrin', name):
-        return True
-    if re.match(r'Lacto[-]N[-][A-Za-z]+ose.*', name):
-        return True
-    return False
+    return _CARBOHYDRATE_PAT.match(name) is not None
 
 
 def parse_lipid(name: str
@@ -114,13 +126,28 @@ def parse_lipid(name: str
         parsed lipid information (always contains 'class', 'n_carbon', and 'n_unsat'
         attributes) or None if it cannot be parsed as a lipid
     """
+    # results are memoized, return a copy since callers may modify it
+    return _copy_lipid(_parse_lipid(name))
+
+
+def _copy_lipid(parsed: Optional[Dict[str, Any]]
+                ) -> Optional[Dict[str, Any]] :
+    """ copies parsed lipid information (including the individual fatty acids) """
+    if parsed is None:
+        return None
+    parsed = dict(parsed)
+    if "fa_comp" in parsed:
+        parsed["fa_comp"] = [dict(fa) for fa in parsed["fa_comp"]]
+    return parsed
+
+
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def _parse_lipid(name: str
+                 ) -> Optional[Dict[str, Any]] :
+    """ memoized implementation of `parse_lipid`, the result must not be modified """
     parsed = {}
-    # compile regex pattern
-    s = (r"^(?P<cls>[A-Za-z]+)\((?P<mod>[pdoe]*)(?P<fc1>[0-9]+):(?P<fu1>[0-9]+)"
-         r"[/_]*((?P<fc2>[0-9]+):(?P<fu2>[0-9]+))*[/_]*((?P<fc3>[0-9]+):(?P<fu3>[0-9]+))*\)")
-    l_pat = re.compile(s)
     # parse the name using regex
-    l_res = l_pat.match(name)
+    l_res = _LIPID_PAT.match(name)
     if l_res:
         # lipid class (required)
         if l_res.group('cls'):
@@ -157,7 +184,7 @@ def parse_lipid(name: str
                 parsed["fa_comp"].append({"n_carbon": fc3, "n_unsat": fu3})
             # compute total fatty acid composition
             parsed["n_carbon"] = fc1 + fc2 + fc3
-            parsed["n_unsat"] = fu1 + fu2 + fc3
+            parsed["n_unsat"] = fu1 + fu2 + fu3
         else:
             # fc1 and fu1 are the total fatty acid composition
             parsed["n_carbon"] = int(l_res.group('fc1'))
@@ -172,6 +199,7 @@ def parse_lipid(name: str
     return parsed
 
 
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
 def parse_peptide(name: str, 
                   exclude: bool = True
                   ) -> bool :
@@ -193,18 +221,73 @@ def parse_peptide(name: str,
     matches : ``bool``
         flag indicating if the name matches the peptide regex pattern
     """
-    expats = [
-        re.compile(pat) for pat in PEPTIDE_EXCLUSION_PATS
-    ]    
+    if not _PEPTIDE_PAT.match(name):
+        return False
     if exclude:
-        excluded = False
-        for expat in expats:
-            if expat.match(name):
-                excluded = True
-        excluded = name in PEPTIDE_EXCLUSION_LIST or excluded
-    pep_pat = re.compile(r'^[ACDEFGHIKLMNPQRSTVWY]+$')
-    pep_res = pep_pat.match(name)
-    if pep_res and not excluded:
-        return True
-    return False
+        return name not in _PEPTIDE_EXCLUSION_SET and not _PEPTIDE_EXCLUSION_PAT.match(name)
+    return True
+
+
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def _annotate_name(name: str
+                   ) -> Tuple[Optional[Dict[str, Any]], bool, bool, str] :
+    """ memoized implementation of `annotate_name` """
+    lipid = _parse_lipid(name)
+    is_peptide = parse_peptide(name)
+    is_carbohydrate = parse_carbohydrate(name)
+    if lipid:
+        label = 'lipid'
+    elif is_peptide:
+        label = 'peptide'
+    elif is_carbohydrate:
+        label = 'carbohydrate'
+    else:
+        label = 'small molecule'
+    return lipid, is_peptide, is_carbohydrate, label
+
+
+def annotate_name(name: str
+                  ) -> Dict[str, Any] :
+    """
+    Runs all of the name parsers on a compound name and determines its rough chemical
+    class label from the results (lipid, then peptide, then carbohydrate, otherwise 
+    small molecule), results are memoized so repeated names are only parsed once
+
+    Parameters
+    ----------
+    name : ``str``
+        compound name
+
+    Returns
+    -------
+    annotation : ``dict(str:Any)``
+        "lipid": parsed lipid information (see `parse_lipid`) or None, "is_peptide" and 
+        "is_carbohydrate": flags from `parse_peptide` and `parse_carbohydrate`, 
+        "chem_class_label": rough chemical class label
+    """
+    lipid, is_peptide, is_carbohydrate, label = _annotate_name(name)
+    return {
+        "lipid": _copy_lipid(lipid), 
+        "is_peptide": is_peptide, 
+        "is_carbohydrate": is_carbohydrate, 
+        "chem_class_label": label,
+    }
+
 
+def annotate_names(names: Iterable[str]
+                   ) -> Dict[str, Dict[str, Any]] :
+    """
+    Annotates a batch of compound names (see `annotate_name`), each distinct name is only 
+    annotated once
+
+    Parameters
+    ----------
+    names : ``iterable(str)``
+        compound names (e.g. a list or array, may contain duplicates)
+
+    Returns
+    -------
+    annotations : ``dict(str:dict(str:Any))``
+        mapping of distinct names to their annotations
+    """
+    return {name: annotate_name(name) for name in dict.fromkeys(names)}
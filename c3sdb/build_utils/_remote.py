@@ -8,25 +8,463 @@
     - PubChem REST API to search for compounds and obtain SMILES structures 
         (see: http://pubchemdocs.ncbi.nlm.nih.gov/pug-rest-tutorial)
     - Lipid MAPS REST API to search the LMSD for lipid SMILES structures
+
+    All requests go through `_get`, which applies per-host rate limits (adapted to what
+    each service reports), timeouts, retries with backoff, and a per-host circuit breaker
 """
 
 
-from typing import List, Optional, Dict, Any, Tuple
-from time import sleep
+from typing import List, Optional, Dict, Any, Tuple, Set
+from time import sleep, monotonic
+from threading import Lock
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+import re
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from c3sdb.build_utils._telemetry import record_request, record_skipped
+from c3sdb.build_utils._transport import ReplayAdapter
 
 
-# delay (in seconds) before sending any request 
+# delay (in seconds) before sending any request, this sets the default request rate
+# for any host that does not have an explicit rate limit in _HOST_RATE_LIMITS
 _REQUEST_DELAY: float = 0.25
 
+# base URLs for the remote services, these can be pointed at a local (stub) server 
+# for testing
+_PUBCHEM_URL: str = "https://pubchem.ncbi.nlm.nih.gov/rest/pug/"
+_LMAPS_URL: str = "https://lipidmaps.org/rest/compound/"
+
+# maximal request rates (requests per second) for each remote host
+_HOST_RATE_LIMITS: Dict[str, float] = {
+    # PubChem usage policy: no more than 5 requests per second
+    "pubchem.ncbi.nlm.nih.gov": 5.,
+    "lipidmaps.org": 4.,
+}
+
+# (connect, read) timeouts (in seconds) for every request
+_TIMEOUT: Tuple[float, float] = (5., 30.)
+
+# number of times a failed request is retried, the delay before each retry grows 
+# exponentially (with jitter) from _BACKOFF_BASE up to _BACKOFF_MAX seconds, unless 
+# the response says how long to wait (Retry-After)
+_MAX_RETRIES: int = 4
+_BACKOFF_BASE: float = 0.5
+_BACKOFF_MAX: float = 30.
+
+# response statuses that are worth retrying (rate limited, server busy or unavailable)
+_RETRY_STATUSES: Set[int] = {429, 500, 502, 503, 504}
+
+# circuit breaker: after this many consecutive failed requests to a host, requests to 
+# that host are skipped for a cooldown period (in seconds)
+_BREAKER_THRESHOLD: int = 5
+_BREAKER_COOLDOWN: float = 60.
+
+# PubChem reports how close each client is to being throttled in the X-Throttling-Control 
+# response header, as a traffic light status for request count, request time and overall 
+# service load (see: https://pubchem.ncbi.nlm.nih.gov/docs/dynamic-request-throttling),
+# the request rate for the host is scaled according to the worst of these
+_THROTTLE_SCALES: Dict[str, float] = {
+    "green": 1., "yellow": 0.5, "red": 0.2, "black": 0.05
+}
+
+# on responses without throttling information, the request rate is halved when a host 
+# says it is overloaded and otherwise recovers by this fraction of the rate limit
+_RATE_RECOVERY: float = 0.1
+
+# lowest request rate (requests per second) that the adaptive throttling goes down to
+_MIN_RATE: float = 0.1
+
+
+class ServiceUnavailable(requests.ConnectionError):
+    """ raised instead of sending a request to a host while its circuit breaker is open """
+
+
+class _TokenBucket:
+    """
+    Thread-safe token bucket used to enforce a request rate limit for a single host,
+    shared by all threads sending requests to that host. The rate can be lowered (and
+    raised again, up to the initial rate) while requests are being sent.
+    """
+
+    def __init__(self, 
+                 rate: float, 
+                 capacity: float = 1.
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        rate : ``float``
+            rate (tokens per second) at which the bucket refills, this is also the 
+            maximal rate
+        capacity : ``float``, default=1.
+            maximal number of tokens the bucket can hold (i.e. the largest burst of 
+            requests that may be sent at once)
+        """
+        self.max_rate_ = rate
+        self.rate_ = rate
+        self.capacity_ = capacity
+        self.tokens_ = capacity
+        self.t_last_ = monotonic()
+        self.lock_ = Lock()
+
+    def _refill(self
+                ) -> None :
+        """ add the tokens accumulated since the last refill (call with the lock held) """
+        now = monotonic()
+        self.tokens_ = min(self.capacity_, self.tokens_ + (now - self.t_last_) * self.rate_)
+        self.t_last_ = now
+
+    def acquire(self
+                ) -> float :
+        """
+        Take a token from the bucket, blocking until one is available. Tokens are 
+        reserved while holding the lock but the waiting happens outside of it, so 
+        concurrent callers are released in the order they arrived.
+
+        Returns
+        -------
+        wait : ``float``
+            time (in seconds) spent waiting for the token
+        """
+        with self.lock_:
+            self._refill()
+            self.tokens_ -= 1.
+            wait = -self.tokens_ / self.rate_ if self.tokens_ < 0. else 0.
+        if wait > 0.:
+            sleep(wait)
+        return wait
+
+    def set_rate(self,
+                 rate: float
+                 ) -> None :
+        """
+        Change the refill rate, it is kept between _MIN_RATE and the initial rate
+
+        Parameters
+        ----------
+        rate : ``float``
+            new rate (tokens per second)
+        """
+        with self.lock_:
+            # tokens accumulated so far count at the old rate
+            self._refill()
+            self.rate_ = min(self.max_rate_, max(_MIN_RATE, rate))
+
+    def pause(self,
+              delay: float
+              ) -> None :
+        """
+        Hold off all requests for some time (e.g. as requested by a Retry-After header), 
+        without affecting requests that are already waiting on a token any further
+
+        Parameters
+        ----------
+        delay : ``float``
+            time (in seconds) to hold off requests for
+        """
+        with self.lock_:
+            self._refill()
+            self.tokens_ = min(self.tokens_, -delay * self.rate_)
+
+
+class _CircuitBreaker:
+    """
+    Thread-safe circuit breaker for a single host. After _BREAKER_THRESHOLD consecutive 
+    failures the circuit opens and requests are skipped until the cooldown has passed, 
+    then a single trial request is let through: if it succeeds the circuit closes again,
+    if it fails the circuit stays open for another cooldown period.
+    """
+
+    def __init__(self,
+                 threshold: int = _BREAKER_THRESHOLD,
+                 cooldown: float = _BREAKER_COOLDOWN
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        threshold : ``int``, default=_BREAKER_THRESHOLD
+            number of consecutive failures that opens the circuit
+        cooldown : ``float``, default=_BREAKER_COOLDOWN
+            time (in seconds) to skip requests for once the circuit is open
+        """
+        self.threshold_ = threshold
+        self.cooldown_ = cooldown
+        self.n_failures_ = 0
+        self.t_open_until_ = None
+        self.trial_ = False
+        self.lock_ = Lock()
+
+    def allow(self
+              ) -> bool :
+        """
+        Check whether a request may be sent
+
+        Returns
+        -------
+        allow : ``bool``
+            False if the circuit is open (or a trial request is already in flight)
+        """
+        with self.lock_:
+            if self.t_open_until_ is None:
+                return True
+            if monotonic() < self.t_open_until_ or self.trial_:
+                return False
+            self.trial_ = True
+            return True
+
+    def success(self
+                ) -> None :
+        """ record a successful request, closes the circuit """
+        with self.lock_:
+            self.n_failures_ = 0
+            self.t_open_until_ = None
+            self.trial_ = False
+
+    def failure(self
+                ) -> None :
+        """ record a failed request, opens the circuit if there have been too many """
+        with self.lock_:
+            self.n_failures_ += 1
+            if self.trial_ or self.n_failures_ >= self.threshold_:
+                self.t_open_until_ = monotonic() + self.cooldown_
+            self.trial_ = False
+
+
+# fraction of each host's rate limit that this process may use, this gets lowered when
+# several processes are sending requests at the same time (see `set_rate_share`)
+_RATE_SHARE: float = 1.
+
+# token buckets and circuit breakers for each host, created on first request to the host
+_BUCKETS: Dict[str, _TokenBucket] = {}
+_BREAKERS: Dict[str, _CircuitBreaker] = {}
+_BUCKETS_LOCK: Lock = Lock()
+
+
+def set_rate_share(n_processes: int
+                   ) -> None :
+    """
+    Splits the per-host rate limits evenly between several processes that are sending
+    requests at the same time (e.g. sharded builds), so that together they stay under
+    the limits. This should be called in each process before any requests are sent.
+
+    Parameters
+    ----------
+    n_processes : ``int``
+        number of processes sharing the rate limits
+    """
+    global _RATE_SHARE
+    with _BUCKETS_LOCK:
+        _RATE_SHARE = 1. / max(1, n_processes)
+        _BUCKETS.clear()
+
+
+def _host_state(host: str
+                ) -> Tuple[_TokenBucket, _CircuitBreaker] :
+    """ get the token bucket and circuit breaker for a host, creating them if needed """
+    with _BUCKETS_LOCK:
+        if host not in _BUCKETS:
+            _BUCKETS[host] = _TokenBucket(_HOST_RATE_LIMITS.get(host, 1. / _REQUEST_DELAY) * _RATE_SHARE)
+        if host not in _BREAKERS:
+            _BREAKERS[host] = _CircuitBreaker(_BREAKER_THRESHOLD, _BREAKER_COOLDOWN)
+        return _BUCKETS[host], _BREAKERS[host]
+
+
+def _throttle(url: str
+              ) -> float :
+    """
+    Block until a request to the host in the specified URL is allowed under that 
+    host's rate limit (see _HOST_RATE_LIMITS)
+
+    Parameters
+    ----------
+    url : ``str``
+        URL that a request is about to be sent to
+
+    Returns
+    -------
+    wait : ``float``
+        time (in seconds) spent waiting
+    """
+    bucket, _ = _host_state(urlparse(url).hostname)
+    return bucket.acquire()
+
+
+def remote_session(pool_maxsize: int = 16
+                   ) -> requests.Session :
+    """
+    Sets up a requests session for the remote APIs, connections are kept alive and 
+    pooled per host so that concurrent requests (e.g. from the worker threads in 
+    `add_smiles_to_db`) reuse them instead of reconnecting for every request
+
+    Parameters
+    ----------
+    pool_maxsize : ``int``, default=16
+        maximal number of connections to keep open to each host, should be at least 
+        the number of threads sending requests
+
+    Returns
+    -------
+    session : ``requests.Session``
+        session with a pooled ``HTTPAdapter`` mounted for http and https
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max(4, len(_HOST_RATE_LIMITS)), pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _retry_after(resp: requests.Response
+                 ) -> Optional[float] :
+    """ time (in seconds) to wait from the Retry-After header of a response, if present """
+    if (value := resp.headers.get("Retry-After")) is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _throttle_scale(resp: requests.Response
+                    ) -> Optional[float] :
+    """ 
+    request rate scale from the PubChem dynamic throttling status (worst of the reported 
+    statuses) in a response, None if the response does not have it, e.g.:
+    "Request Count status: Green (0%), Request Time status: Yellow (52%), Service status: Green (20%)"
+    """
+    if (value := resp.headers.get("X-Throttling-Control")) is None:
+        return None
+    scales = [_THROTTLE_SCALES[s] for s in re.findall(r"status:\s*(\w+)", value.lower()) if s in _THROTTLE_SCALES]
+    return min(scales) if scales else None
+
+
+def _adapt_rate(bucket: _TokenBucket,
+                resp: requests.Response
+                ) -> None :
+    """ adjust the request rate for a host according to a response from it """
+    if (scale := _throttle_scale(resp)) is not None:
+        # the host told us how close we are to being throttled
+        bucket.set_rate(bucket.max_rate_ * scale)
+    elif resp.status_code in (429, 503):
+        # overloaded, back off
+        bucket.set_rate(bucket.rate_ / 2.)
+    elif resp.ok and bucket.rate_ < bucket.max_rate_:
+        bucket.set_rate(bucket.rate_ + bucket.max_rate_ * _RATE_RECOVERY)
+
+
+def _backoff(attempt: int
+             ) -> float :
+    """ exponential backoff with jitter, time (in seconds) to wait before a retry """
+    delay = min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(delay / 2., delay)
+
+
+def _get(session: requests.Session,
+         url: str,
+         endpoint: str
+         ) -> Tuple[requests.Response, int] :
+    """
+    Sends a GET request once the rate limit for the host allows it (see `_throttle`), with
+    connect/read timeouts (_TIMEOUT). Requests that fail with a connection error, a timeout
+    or a retryable status (_RETRY_STATUSES) are retried up to _MAX_RETRIES times with 
+    exponential backoff, honoring Retry-After. The request rate for the host is adapted 
+    to the responses (see `_adapt_rate`), and a circuit breaker skips requests to a host 
+    that keeps failing, counting one failure for each request that still fails once its 
+    retries have run out. Requests served from a recorded archive (replay sessions, see 
+    `c3sdb.build_utils._transport.replay_session`) are neither retried nor counted by the 
+    circuit breaker. Every attempt is recorded in the request stats for the endpoint (see 
+    `c3sdb.build_utils._telemetry`).
+
+    Parameters
+    ----------
+    session : ``requests.Session``
+        requests session
+    url : ``str``
+        request URL
+    endpoint : ``str``
+        name of the endpoint for the request stats
+
+    Returns
+    -------
+    resp : ``requests.Response``
+        response, if the retries run out on a retryable status the last response is 
+        returned
+    n_requests : ``int``
+        number of web requests sent (including retries)
+
+    Raises
+    ------
+    ServiceUnavailable
+        if the circuit breaker for the host is open
+    requests.RequestException
+        if the request still fails with a connection error or timeout after the retries,
+        or fails with any other error (e.g. ``ResponseNotRecorded`` in a replay session), 
+        the number of web requests sent is in the ``n_requests`` attribute of the exception
+    """
+    host = urlparse(url).hostname
+    bucket, breaker = _host_state(host)
+    # recorded responses are served locally, there is no host to give a break
+    replay = isinstance(session.get_adapter(url), ReplayAdapter)
+    max_retries = 0 if replay else _MAX_RETRIES
+    if not replay and not breaker.allow():
+        record_skipped(endpoint)
+        exc = ServiceUnavailable(f"_get: skipping request to {host}, too many failed requests")
+        exc.n_requests = 0
+        raise exc
+    n_requests = 0
+    try:
+        for attempt in range(max_retries + 1):
+            throttle = bucket.acquire()
+            t_0 = monotonic()
+            n_requests += 1
+            try:
+                resp = session.get(url, timeout=_TIMEOUT)
+            except requests.RequestException as exc:
+                record_request(endpoint, monotonic() - t_0, error=True, throttle=throttle, retry=attempt > 0)
+                if attempt == max_retries or not isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+                    raise
+                sleep(_backoff(attempt))
+                continue
+            # not found is a normal response for searches
+            record_request(endpoint, monotonic() - t_0, error=not (resp.ok or resp.status_code == 404), 
+                           throttle=throttle, retry=attempt > 0)
+            _adapt_rate(bucket, resp)
+            if resp.status_code not in _RETRY_STATUSES or attempt == max_retries:
+                break
+            if (delay := _retry_after(resp)) is not None:
+                # hold off every request to this host, not just this one
+                bucket.pause(delay)
+            else:
+                sleep(_backoff(attempt))
+    except requests.RequestException as exc:
+        if not replay:
+            breaker.failure()
+        exc.n_requests = n_requests
+        raise
+    if not replay:
+        if resp.status_code in _RETRY_STATUSES:
+            breaker.failure()
+        else:
+            breaker.success()
+    return resp, n_requests
+
 
 def pubchem_search_by_name(session: requests.Session, 
                            name: str
                            ) -> Tuple[Optional[List[int]], int] :
     """
     Searches for a PubChem CID using a compound name, returning a list of results,
-    returns None if any errors
+    returns an empty list if no compounds match the name or None if any other errors
+    (including the request failing or being skipped, see `_get`)
 
     Parameters
     ----------
@@ -38,23 +476,30 @@ def pubchem_search_by_name(session: requests.Session,
     Returns
     -------
     pubchem_cids ``list(int)`` or ``None``
-        list of PubChem CID(s) matching the search name or None if unsuccessful
+        list of PubChem CID(s) matching the search name (empty if there were no 
+        matches) or None if unsuccessful
     n_requests : ``int``
         number of web requests sent
     """
     # construct the request URL per REST API documentation
-    url_prolog = "https://pubchem.ncbi.nlm.nih.gov/rest/pug/"
+    url_prolog = _PUBCHEM_URL
     url_input = "compound/name/"
     url_command = "/cids/"
     url_output = "TXT"
     url = url_prolog + url_input + name + url_command + url_output
-    sleep(_REQUEST_DELAY)
-    resp = session.get(url).text
+    try:
+        resp, n_requests = _get(session, url, "pubchem_search_by_name")
+    except requests.RequestException as e:
+        return None, e.n_requests
+    # no compounds matched the name
+    if resp.status_code == 404:
+        return [], n_requests
     # check for a failed search response
-    if resp.split()[0] == "Status:":
-        return None, 1
+    if not resp.ok or not resp.text.strip() or resp.text.split()[0] == "Status:":
+        return None, n_requests
+    resp = resp.text
     # split response on whitespace
-    return [int(_) for _ in resp.split()], 1
+    return [int(_) for _ in resp.split()], n_requests
 
 
 def pubchem_cid_fetch_smiles(session: requests.Session, 
@@ -80,24 +525,92 @@ def pubchem_cid_fetch_smiles(session: requests.Session,
     Returns
     -------
     smiles : ``str`` or None
-        SMILES structure or None if no results
+        SMILES structure or None if no results (or the request failed)
     n_requests : ``int``
         number of web requests sent
     """
     # construct the request URL per REST API documentation
-    url_prolog = "https://pubchem.ncbi.nlm.nih.gov/rest/pug/"
+    url_prolog = _PUBCHEM_URL
     url_input = "compound/cid/"
     # option to search for Isomeric SMILES
     stype = "Canonical" if canonical else "Isomeric"
     url_command = "/property/{}SMILES/".format(stype)
     url_output = "TXT"
     url = url_prolog + url_input + str(cid) + url_command + url_output
-    sleep(_REQUEST_DELAY)
-    resp = session.get(url).text
+    try:
+        resp, n_requests = _get(session, url, "pubchem_cid_fetch_smiles")
+    except requests.RequestException as e:
+        return None, e.n_requests
+    resp = resp.text if resp.ok else ""
     # check for a failed search response
-    if resp.split()[0] == "Status:":
-        return None, 1
-    return resp.strip(), 1
+    if not resp.strip() or resp.split()[0] == "Status:":
+        return None, n_requests
+    return resp.strip(), n_requests
+
+
+def pubchem_cids_fetch_smiles(session: requests.Session, 
+                              cids: List[int]
+                              ) -> Tuple[Optional[Dict[int, str]], int] :
+    """
+    Fetches SMILES structures for a batch of PubChem CIDs in a single request, both the 
+    isomeric and canonical SMILES are requested at once and the isomeric SMILES is 
+    used if available, falling back on the canonical SMILES if not
+
+    .. note::
+
+        PubChem has renamed these properties (IsomericSMILES -> SMILES, and 
+        CanonicalSMILES -> ConnectivitySMILES) and may return either set of names 
+        in the response, both are accepted
+    
+    Parameters
+    ----------
+    session : ``requests.Session``
+        requests session
+    cids : ``list(int)``
+        PubChem CIDs, the number of CIDs per request should be kept to a few hundred 
+        at most in order to stay within URL length limits
+
+    Returns
+    -------
+    cid_to_smi : ``dict(int:str)`` or ``None``
+        mapping of CIDs to SMILES structures, CIDs without any SMILES are not included
+        (empty if PubChem does not have any of the CIDs), or None if the request failed 
+        (connection error, timeout, skipped request, error status or a response that is 
+        not a property table) so that failures can be told apart from missing structures
+    n_requests : ``int``
+        number of web requests sent
+    """
+    if not cids:
+        return {}, 0
+    # construct the request URL per REST API documentation
+    url_prolog = _PUBCHEM_URL
+    url_input = "compound/cid/"
+    url_command = "/property/IsomericSMILES,CanonicalSMILES/"
+    url_output = "JSON"
+    url = url_prolog + url_input + ",".join([str(_) for _ in cids]) + url_command + url_output
+    try:
+        resp, n_requests = _get(session, url, "pubchem_cids_fetch_smiles")
+    except requests.RequestException as e:
+        return None, e.n_requests
+    # none of the CIDs were found
+    if resp.status_code == 404:
+        return {}, n_requests
+    if not resp.ok:
+        return None, n_requests
+    try:
+        resp = resp.json()
+    except requests.JSONDecodeError:
+        return None, n_requests
+    # a failed request has a "Fault" instead of a "PropertyTable"
+    if not isinstance(resp, dict) or "PropertyTable" not in resp:
+        return None, n_requests
+    cid_to_smi = {}
+    for prop in resp["PropertyTable"].get("Properties", []):
+        smi = (prop.get("IsomericSMILES") or prop.get("SMILES") 
+               or prop.get("CanonicalSMILES") or prop.get("ConnectivitySMILES"))
+        if smi:
+            cid_to_smi[int(prop["CID"])] = smi
+    return cid_to_smi, n_requests
 
 
 def _str_from_lipid_dict(lipid: Dict[Any, Any], 
@@ -150,6 +663,10 @@ def lmaps_fetch_smiles(session: requests.Session,
     try searching using the 'abbrev_chains' input item first, then the 'abbrev' input 
     item if that fails.
 
+    Failed requests raise an exception (unlike the PubChem searches) so that a lipid 
+    that could not be searched for can be told apart from one that LIPID MAPS does not 
+    have, the caller can then fall back on the lipid SMILES generator.
+
     Parameters
     ----------
     session : ``requests.Session``
@@ -161,44 +678,43 @@ def lmaps_fetch_smiles(session: requests.Session,
     Returns
     -------
     smiles : ``str`` or ``None``
-        SMILES structure or None in case of error
+        SMILES structure or None if not found
     n_requests : ``int``
         number of web requests sent
+
+    Raises
+    ------
+    requests.RequestException
+        if a request fails, the response is not JSON, or a request is skipped 
+        (``ServiceUnavailable``, see `_get`), the number of web requests sent is in the 
+        ``n_requests`` attribute of the exception
     """
     # track number of web requests sent
     n_requests = 0
-    url = "https://lipidmaps.org/rest/compound/abbrev{}/{}/smiles/"
+    url = _LMAPS_URL + "abbrev{}/{}/smiles/"
     lipid_name = _str_from_lipid_dict(lipid, False)
     result = None
-    if "_" in lipid_name or "/" in lipid_name:
-        # includes individual fatty acid composition
-        #try:
-        sleep(_REQUEST_DELAY)
-        result = session.get(url.format("_chains", lipid_name)).json()
-        n_requests += 1
-        #except:
-        #    msg = "fetch_lipid_smiles: search with 'abbrev_chains' for lipid {} failed".format(lipid_name)
-        #    print(msg, end=" ")
-        # try again with 
+    try:
+        if "_" in lipid_name or "/" in lipid_name:
+            # includes individual fatty acid composition
+            resp, n_req = _get(session, url.format("_chains", lipid_name), "lmaps_abbrev_chains")
+            n_requests += n_req
+            result = resp.json()
+            # try again with 
+            if not result:
+                resp, n_req = _get(session, url.format("", lipid_name), "lmaps_abbrev")
+                n_requests += n_req
+                result = resp.json()
+            # regenerate the name but with total fatty acid composition in case the above did not work
+            lipid_name = _str_from_lipid_dict(lipid, True)
         if not result:
-            #try:
-            sleep(_REQUEST_DELAY)
-            result = session.get(url.format("", lipid_name)).json()
-            n_requests += 1
-            #except Exception as e:
-            #    print(e)
-            #    msg = "fetch_lipid_smiles: search with 'abbrev' for lipid {} failed".format(lipid_name)
-            #    print(msg, end=" ")
-        # regenerate the name but with total fatty acid composition in case the above did not work
-        lipid_name = _str_from_lipid_dict(lipid, True)
-    if not result:
-        #try:
-        sleep(_REQUEST_DELAY)
-        result = session.get(url.format("", lipid_name)).json()
-        n_requests += 1
-        #except:
-        #    msg = "fetch_lipid_smiles: search with 'abbrev' for lipid {} failed".format(lipid_name)
-        #    print(msg, end=" ")
+            resp, n_req = _get(session, url.format("", lipid_name), "lmaps_abbrev")
+            n_requests += n_req
+            result = resp.json()
+    except requests.RequestException as e:
+        # include the requests that were sent before this one failed
+        e.n_requests = n_requests + getattr(e, "n_requests", 0)
+        raise
     # if there was a result, just return the first one
     smi = None
     if result:
@@ -0,0 +1,328 @@
+"""
+    c3sdb/build_utils/_telemetry.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module with utilities for instrumenting the build: per-stage wall/CPU timings and
+    throughput, per-endpoint request counts and latency histograms for web requests,
+    throttled progress output, and a machine-readable (JSON) build report
+"""
+
+
+from typing import Optional, Dict, Any, List, Iterator
+from contextlib import contextmanager
+from threading import Lock
+import platform
+import bisect
+import json
+import time
+import os
+import sys
+
+from c3sdb import __version__
+
+
+# upper bounds (in seconds) of the request latency histogram bins, the last bin
+# collects everything slower than the last bound
+_LATENCY_BINS: List[float] = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.]
+
+# request stats for each endpoint, accumulated by `record_request`
+_REQUEST_STATS: Dict[str, Dict[str, Any]] = {}
+_REQUEST_STATS_LOCK: Lock = Lock()
+
+
+def _new_request_stats(
+                       ) -> Dict[str, Any] :
+    """ empty request stats for an endpoint """
+    return {
+        "n_requests": 0, "n_errors": 0, "n_retries": 0, "n_skipped": 0, "total_s": 0., "max_s": 0., "throttle_s": 0.,
+        "histogram": [0] * (len(_LATENCY_BINS) + 1)
+    }
+
+
+def record_request(endpoint: str,
+                   latency: float,
+                   error: bool = False,
+                   throttle: float = 0.,
+                   retry: bool = False
+                   ) -> None :
+    """
+    Records a web request in the request stats, this is thread-safe
+
+    Parameters
+    ----------
+    endpoint : ``str``
+        name of the endpoint the request went to
+    latency : ``float``
+        time (in seconds) from sending the request until the response came back
+    error : ``bool``, default=False
+        whether the request failed (e.g. an error status or an unreadable response)
+    throttle : ``float``, default=0.
+        time (in seconds) spent waiting on the rate limit before sending the request
+    retry : ``bool``, default=False
+        whether the request was a retry of a failed request
+    """
+    with _REQUEST_STATS_LOCK:
+        stats = _REQUEST_STATS.setdefault(endpoint, _new_request_stats())
+        stats["n_requests"] += 1
+        stats["n_errors"] += error
+        stats["n_retries"] += retry
+        stats["total_s"] += latency
+        stats["max_s"] = max(stats["max_s"], latency)
+        stats["throttle_s"] += throttle
+        stats["histogram"][bisect.bisect_left(_LATENCY_BINS, latency)] += 1
+
+
+def record_skipped(endpoint: str
+                   ) -> None :
+    """
+    Records a web request that was skipped (e.g. because the circuit breaker for the 
+    host was open) in the request stats, this is thread-safe
+
+    Parameters
+    ----------
+    endpoint : ``str``
+        name of the endpoint the request would have gone to
+    """
+    with _REQUEST_STATS_LOCK:
+        _REQUEST_STATS.setdefault(endpoint, _new_request_stats())["n_skipped"] += 1
+
+
+def get_request_stats(
+                      ) -> Dict[str, Dict[str, Any]] :
+    """
+    Returns a copy of the raw request stats for each endpoint (e.g. to send back from
+    a worker process and combine using `merge_request_stats`)
+
+    Returns
+    -------
+    request_stats : ``dict(str:dict(...))``
+        request stats for each endpoint
+    """
+    with _REQUEST_STATS_LOCK:
+        return {endpoint: {**stats, "histogram": list(stats["histogram"])}
+                for endpoint, stats in _REQUEST_STATS.items()}
+
+
+def merge_request_stats(request_stats: Dict[str, Dict[str, Any]]
+                        ) -> None :
+    """
+    Adds raw request stats (from `get_request_stats`, e.g. in a worker process) into the
+    request stats of this process
+
+    Parameters
+    ----------
+    request_stats : ``dict(str:dict(...))``
+        request stats for each endpoint
+    """
+    with _REQUEST_STATS_LOCK:
+        for endpoint, other in request_stats.items():
+            stats = _REQUEST_STATS.setdefault(endpoint, _new_request_stats())
+            for key in ["n_requests", "n_errors", "n_retries", "n_skipped", "total_s", "throttle_s"]:
+                stats[key] += other[key]
+            stats["max_s"] = max(stats["max_s"], other["max_s"])
+            stats["histogram"] = [a + b for a, b in zip(stats["histogram"], other["histogram"])]
+
+
+def reset_request_stats(
+                        ) -> None :
+    """ clears the request stats """
+    with _REQUEST_STATS_LOCK:
+        _REQUEST_STATS.clear()
+
+
+def _summarize_request_stats(
+                             ) -> Dict[str, Dict[str, Any]] :
+    """ request stats for each endpoint with mean latency and labeled histogram bins """
+    summary = {}
+    labels = [f"<={b:g}s" for b in _LATENCY_BINS] + [f">{_LATENCY_BINS[-1]:g}s"]
+    for endpoint, stats in get_request_stats().items():
+        n = stats["n_requests"]
+        summary[endpoint] = {
+            "n_requests": n,
+            "n_errors": stats["n_errors"],
+            "n_retries": stats["n_retries"],
+            "n_skipped": stats["n_skipped"],
+            "mean_s": stats["total_s"] / n if n else 0.,
+            "max_s": stats["max_s"],
+            "total_s": stats["total_s"],
+            "throttle_s": stats["throttle_s"],
+            "histogram": dict(zip(labels, stats["histogram"])),
+        }
+    return summary
+
+
+def _cpu_time(
+              ) -> float :
+    """ CPU time (user + system) of this process and all of its finished child processes """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Progress:
+    """
+    Throttled progress output, rewrites a single progress line at most once every
+    ``interval`` seconds instead of on every update (printing is not free when there
+    are many thousands of updates)
+    """
+
+    def __init__(self,
+                 total: Optional[int] = None,
+                 interval: float = 1.,
+                 prefix: str = "\t"
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        total : ``int``, optional
+            total number of items, if known
+        interval : ``float``, default=1.
+            minimal time (in seconds) between progress lines
+        prefix : ``str``, default="\\t"
+            prefix for the progress line
+        """
+        self.total_ = total
+        self.interval_ = interval
+        self.prefix_ = prefix
+        self.n_ = 0
+        self.t_start_ = time.monotonic()
+        self.t_last_ = -float("inf")
+        self.printed_ = False
+
+    def _print(self,
+               msg: str
+               ) -> None :
+        """ rewrite the progress line """
+        rate = self.n_ / max(time.monotonic() - self.t_start_, 1e-9)
+        total = f"/{self.total_}" if self.total_ is not None else ""
+        line = f"{self.prefix_}({self.n_}{total}, {rate:.1f}/s) {msg}"
+        print(f"\r{line:<120s}", end="")
+        self.printed_ = True
+
+    def update(self,
+               n: int = 1,
+               msg: str = ""
+               ) -> None :
+        """
+        Advance the progress by n items, only printing if enough time has passed
+
+        Parameters
+        ----------
+        n : ``int``, default=1
+            number of items completed
+        msg : ``str``, default=""
+            message to show with the progress (e.g. the current item)
+        """
+        self.n_ += n
+        if (now := time.monotonic()) - self.t_last_ >= self.interval_:
+            self.t_last_ = now
+            self._print(msg)
+
+    def close(self
+              ) -> None :
+        """ print the final progress and end the progress line """
+        if self.n_ > 0:
+            self._print("")
+        if self.printed_:
+            print()
+
+
+class BuildReport:
+    """
+    Collects performance metrics over a build: wall and CPU time for each stage, the
+    number of rows each stage processed (and throughput), cache statistics, and web
+    request stats for each endpoint, then writes it all to a JSON report
+    """
+
+    def __init__(self
+                 ) -> None :
+        self.t_start_ = time.time()
+        self.wall_start_ = time.perf_counter()
+        self.cpu_start_ = _cpu_time()
+        self.stages_: Dict[str, Dict[str, Any]] = {}
+        self.caches_: Dict[str, Dict[str, Any]] = {}
+        self.info_: Dict[str, Any] = {}
+        reset_request_stats()
+
+    @contextmanager
+    def stage(self,
+              name: str
+              ) -> Iterator[Dict[str, Any]] :
+        """
+        Context manager that times a build stage, yields the record for the stage so that
+        the stage can fill in the number of rows it processed ("n_rows") and any other
+        counters, throughput (rows per second) is computed at the end
+
+        Parameters
+        ----------
+        name : ``str``
+            name of the build stage
+        """
+        record = {"n_rows": 0}
+        wall0, cpu0 = time.perf_counter(), _cpu_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - wall0, _cpu_time() - cpu0
+            record.update({"wall_s": wall, "cpu_s": cpu,
+                           "rows_per_s": record["n_rows"] / wall if wall > 0. else 0.})
+            self.stages_[name] = record
+
+    def add_cache_stats(self,
+                        name: str,
+                        stats: Dict[str, Any]
+                        ) -> None :
+        """
+        Records stats for a cache, hit rates are computed from hits and misses if they
+        are present
+
+        Parameters
+        ----------
+        name : ``str``
+            name of the cache
+        stats : ``dict(str:...)``
+            cache stats (e.g. from ``MQNCache.stats()``)
+        """
+        stats = dict(stats)
+        if "hits" in stats and "misses" in stats:
+            n = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / n if n else 0.
+        self.caches_[name] = stats
+
+    def to_dict(self
+                ) -> Dict[str, Any] :
+        """
+        Returns the full report
+
+        Returns
+        -------
+        report : ``dict(str:...)``
+            build performance report
+        """
+        return {
+            "c3sdb_version": __version__,
+            "python_version": sys.version.split()[0],
+            "platform": platform.platform(),
+            "n_cpus": os.cpu_count(),
+            "t_start": self.t_start_,
+            "wall_s": time.perf_counter() - self.wall_start_,
+            "cpu_s": _cpu_time() - self.cpu_start_,
+            **self.info_,
+            "stages": self.stages_,
+            "caches": self.caches_,
+            "requests": _summarize_request_stats(),
+        }
+
+    def save(self,
+             path: str
+             ) -> None :
+        """
+        Writes the report to a JSON file (overwrites the file if it exists)
+
+        Parameters
+        ----------
+        path : ``str``
+            path to the report file
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
@@ -0,0 +1,195 @@
+"""
+    c3sdb/build_utils/_transport.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module with pluggable transports (``requests`` transport adapters) for recording
+    responses from the remote APIs into a local archive and replaying them back, so that
+    the build can be run (e.g. benchmarked or regression tested) without network access
+
+    The archive is a JSON Lines file with one recorded response per line
+"""
+
+
+from typing import Dict, Tuple, Optional, Any
+import json
+import base64
+import os
+from threading import Lock
+from time import sleep
+import random
+from http import HTTPStatus
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+class ResponseNotRecorded(requests.RequestException):
+    """ 
+    raised by ``ReplayAdapter`` for requests that have no recorded response in the archive, 
+    unlike a connection error this is not worth retrying 
+    """
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends requests as normal but also records every response
+    into an archive file (appending to it if it already exists)
+    """
+
+    def __init__(self,
+                 archive: str,
+                 **kwargs: Any
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        archive : ``str``
+            path to the archive file to record responses into
+        **kwargs : ``Any``
+            passed on to ``requests.adapters.HTTPAdapter``
+        """
+        super().__init__(**kwargs)
+        self.archive_ = archive
+        self.lock_ = Lock()
+
+    def send(self,
+             request: requests.PreparedRequest,
+             **kwargs: Any
+             ) -> requests.Response :
+        resp = super().send(request, **kwargs)
+        record = {
+            "method": request.method,
+            "url": request.url,
+            "status": resp.status_code,
+            "headers": dict(resp.headers),
+            "content": base64.b64encode(resp.content).decode(),
+        }
+        with self.lock_:
+            with open(self.archive_, "a") as af:
+                af.write(json.dumps(record) + "\n")
+        return resp
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter that never touches the network, instead serving responses from
+    an archive file that was recorded using ``RecordingAdapter``, with optional
+    simulated latency. If a URL was recorded more than once, the last recorded response
+    is used. Requests for URLs that were not recorded raise ``ResponseNotRecorded``.
+    """
+
+    def __init__(self,
+                 archive: str,
+                 latency: float = 0.,
+                 jitter: float = 0.
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        archive : ``str``
+            path to the archive file with recorded responses
+        latency : ``float``, default=0.
+            simulated latency (in seconds) added to every response
+        jitter : ``float``, default=0.
+            if set, a random amount of additional latency between 0 and this value (in
+            seconds) is added to every response
+        """
+        super().__init__()
+        if not os.path.isfile(archive):
+            msg = f"ReplayAdapter: archive file {archive} not found"
+            raise ValueError(msg)
+        self.latency_ = latency
+        self.jitter_ = jitter
+        self.records_: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        with open(archive, "r") as af:
+            for line in af:
+                if line.strip():
+                    record = json.loads(line)
+                    self.records_[(record["method"], record["url"])] = record
+
+    def send(self,
+             request: requests.PreparedRequest,
+             **kwargs: Any
+             ) -> requests.Response :
+        if (record := self.records_.get((request.method, request.url))) is None:
+            msg = f"ReplayAdapter: no recorded response for {request.method} {request.url}"
+            raise ResponseNotRecorded(msg, request=request)
+        if (delay := self.latency_ + random.uniform(0., self.jitter_)) > 0.:
+            sleep(delay)
+        resp = requests.Response()
+        resp.status_code = record["status"]
+        resp.headers = CaseInsensitiveDict(record["headers"])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp._content = base64.b64decode(record["content"])
+        resp.url = request.url
+        resp.request = request
+        try:
+            resp.reason = HTTPStatus(resp.status_code).phrase
+        except ValueError:
+            resp.reason = ""
+        return resp
+
+    def close(self
+              ) -> None :
+        pass
+
+
+def recording_session(archive: str,
+                      session: Optional[requests.Session] = None
+                      ) -> requests.Session :
+    """
+    Sets up a requests session that records all responses into an archive file
+
+    Parameters
+    ----------
+    archive : ``str``
+        path to the archive file to record responses into
+    session : ``requests.Session``, optional
+        existing session to set up, a new one is created if not provided
+
+    Returns
+    -------
+    session : ``requests.Session``
+        session with a ``RecordingAdapter`` mounted for http and https
+    """
+    session = requests.Session() if session is None else session
+    adapter = RecordingAdapter(archive)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def replay_session(archive: str,
+                   latency: float = 0.,
+                   jitter: float = 0.,
+                   session: Optional[requests.Session] = None
+                   ) -> requests.Session :
+    """
+    Sets up a requests session that serves all responses from an archive file (recorded
+    using `recording_session`) without any network access
+
+    Parameters
+    ----------
+    archive : ``str``
+        path to the archive file with recorded responses
+    latency : ``float``, default=0.
+        simulated latency (in seconds) added to every response
+    jitter : ``float``, default=0.
+        if set, a random amount of additional latency between 0 and this value (in
+        seconds) is added to every response
+    session : ``requests.Session``, optional
+        existing session to set up, a new one is created if not provided
+
+    Returns
+    -------
+    session : ``requests.Session``
+        session with a ``ReplayAdapter`` mounted for http and https
+    """
+    session = requests.Session() if session is None else session
+    adapter = ReplayAdapter(archive, latency=latency, jitter=jitter)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
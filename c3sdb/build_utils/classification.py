@@ -9,7 +9,15 @@
 
 import sqlite3
 
-from c3sdb.build_utils._parsing import parse_carbohydrate, parse_lipid, parse_peptide
+from c3sdb.build_utils._parsing import annotate_names
+from c3sdb.build_utils._bulk import bulk_update, executemany_chunked
+
+
+# version of the name annotations, stored in the name_annotations_info table, annotations 
+# made by an older version (or without a recorded version) are re-done by add_name_annotations
+# - 1: original
+# - 2: fixed the total n_unsat of lipids with three fatty acids (was using the third n_carbon)
+_ANNOTATION_VERSION: int = 2
 
 
 def label_class_byname(cursor: sqlite3.Cursor
@@ -26,23 +34,62 @@ def label_class_byname(cursor: sqlite3.Cursor
     cursor : ``sqlite3.Cursor``
         cursor for C3S.db database
     """
-    # map global identifiers to class labels
-    gid_to_lab = {}
-    qry = "SELECT g_id, name FROM master WHERE chem_class_label IS NULL"
-    for g_id, name in cursor.execute(qry).fetchall():
-        #print('(g_id: {}) {:40s} looks like a'.format(g_id, name), end=' ')
-        if parse_lipid(name):
-            label = 'lipid'
-        elif parse_peptide(name):
-            label = 'peptide'
-        elif parse_carbohydrate(name):
-            label = 'carbohydrate'
-        else:
-            label = 'small molecule'
-        #print(label)
-        gid_to_lab[g_id] = label
+    # map global identifiers to class labels, names are annotated once each (and the
+    # annotations are memoized so names already seen by the SMILES stage are not re-parsed)
+    rows = cursor.execute("SELECT g_id, name FROM master WHERE chem_class_label IS NULL").fetchall()
+    annotations = annotate_names([name for _, name in rows])
+    gid_to_lab = [(g_id, annotations[name]["chem_class_label"]) for g_id, name in rows]
     # add the chem class label to the master table by g_id for any compounds that were matched
-    qry = "UPDATE master SET chem_class_label=? WHERE g_id=?"
-    for g_id in gid_to_lab:
-        qdata = (gid_to_lab[g_id], g_id)
-        cursor.execute(qry, qdata)
+    bulk_update(cursor, "master", "g_id", ["chem_class_label"], gid_to_lab)
+
+
+def set_annotation_version(cursor: sqlite3.Cursor
+                           ) -> None :
+    """
+    records that the annotations in the name_annotations table of C3S.db were made by
+    the current version of the name parsers (_ANNOTATION_VERSION)
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db database
+    """
+    cursor.execute("INSERT OR REPLACE INTO name_annotations_info VALUES ('version', ?)", 
+                   (str(_ANNOTATION_VERSION),))
+
+
+def add_name_annotations(cursor: sqlite3.Cursor
+                         ) -> int :
+    """
+    adds the information parsed from compound names (lipid class, fatty acid composition,
+    peptide/carbohydrate flags) to the name_annotations table of C3S.db, for any entries
+    that do not have annotations yet, if the existing annotations were made by an older
+    version of the name parsers (see _ANNOTATION_VERSION) they are all re-done
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db database
+
+    Returns
+    -------
+    n_annotated : ``int``
+        number of entries that had annotations added
+    """
+    res = cursor.execute("SELECT value FROM name_annotations_info WHERE key='version'").fetchone()
+    if res is None or int(res[0]) != _ANNOTATION_VERSION:
+        cursor.execute("DELETE FROM name_annotations")
+        set_annotation_version(cursor)
+    qry = "SELECT g_id, name FROM master WHERE g_id NOT IN (SELECT g_id FROM name_annotations)"
+    rows = cursor.execute(qry).fetchall()
+    annotations = annotate_names([name for _, name in rows])
+    ann_rows = []
+    for g_id, name in rows:
+        ann = annotations[name]
+        lipid = ann["lipid"] or {}
+        fa_comp = "/".join([f"{fa['n_carbon']}:{fa['n_unsat']}" for fa in lipid["fa_comp"]]) if "fa_comp" in lipid else None
+        ann_rows.append((
+            g_id, lipid.get("lipid_class"), lipid.get("n_carbon"), lipid.get("n_unsat"), lipid.get("fa_mod"), 
+            fa_comp, int(ann["is_peptide"]), int(ann["is_carbohydrate"])
+        ))
+    return executemany_chunked(cursor, "INSERT INTO name_annotations VALUES (?,?,?,?,?,?,?,?)", ann_rows)
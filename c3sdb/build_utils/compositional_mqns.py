@@ -0,0 +1,439 @@
+"""
+    c3sdb/build_utils/compositional_mqns.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module for computing MQNs of generated peptide and lipid structures analytically from
+    their composition instead of running RDKit on every SMILES structure
+
+    The SMILES structures that come out of the peptide and lipid SMILES generators (see
+    `c3sdb.build_utils.smiles`) are fully determined by the residue sequence or by the
+    lipid class and fatty acid composition, and their MQNs are sums of contributions:
+
+    - peptides: a per-residue contribution vector for each amino acid, plus corrections
+        for the residues at the N- and C-termini, plus a per-residue backbone term
+    - lipids: a reference structure for each lipid class (head group and glycerol or
+        sphingoid backbone), plus per-carbon and per-unsaturation contributions from the
+        fatty acyl chains
+
+    The contribution vectors are calibrated against RDKit (so they always match the
+    installed version) from a handful of small reference structures, then the MQNs for
+    any number of structures are computed with a few vectorized NumPy operations.
+
+    The analytical MQNs are checked against RDKit for every generator template using:
+    `python3 -m c3sdb.build_utils.compositional_mqns`
+"""
+
+
+from typing import Optional, List, Dict, Tuple, Any
+import random
+
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import Descriptors
+from rdkit.rdBase import BlockLogs
+
+from c3sdb.build_utils._parsing import annotate_names
+from c3sdb.build_utils.smiles import (
+    _AA_TO_SMI, _peptide_seq_to_smiles, _carbon_chain, _generate_lipid_smiles
+)
+
+
+# lipid classes supported by each of the lipid SMILES generator templates
+_SPHINGO_CLS: Tuple[str, ...] = ("SM", "Cer", "GlcCer", "HexCer")
+_DIACYL_CLS: Tuple[str, ...] = ("PC", "PE", "PS", "PA", "PG", "DG", "DGDG")
+_LYSO_CLS: Tuple[str, ...] = ("LPC", "LPE", "LPS", "LPA", "LPG")
+
+# reference (sum) fatty acid compositions that the lipid classes are calibrated at
+_LIPID_REF_COMP: Dict[str, Tuple[int, int]] = {
+    **{c: (36, 1) for c in _SPHINGO_CLS},
+    **{c: (36, 2) for c in _DIACYL_CLS},
+    **{c: (18, 1) for c in _LYSO_CLS},
+    "TG": (54, 3),
+}
+
+# amino acids in a fixed order
+_AAS: Tuple[str, ...] = tuple(sorted(_AA_TO_SMI))
+
+# ring closure digits in the peptide SMILES generator only go up to 9, past that the
+# generated SMILES means something else to RDKit so those have to be computed normally
+_MAX_PEPTIDE_RINGS: int = 9
+
+
+def _rdkit_mqns(smi: str
+                ) -> np.ndarray :
+    """ computes MQNs for a SMILES structure using RDKit, as a float array """
+    return np.array(Descriptors.rdMolDescriptors.MQNs_(Chem.MolFromSmiles(smi)), dtype=np.float64)
+
+
+def _chain_composition(c: np.ndarray,
+                       u: np.ndarray
+                       ) -> Tuple[np.ndarray, np.ndarray] :
+    """
+    Computes the actual number of carbons and double bonds in the carbon chains that
+    `c3sdb.build_utils.smiles._carbon_chain` makes for (arrays of) c carbons and u
+    unsaturations, which are not always the same as the inputs (e.g. a chain always
+    has at least one carbon, fractional inputs get rounded up)
+
+    Parameters
+    ----------
+    c : ``numpy.ndarray(float)``
+        number of carbons
+    u : ``numpy.ndarray(float)``
+        number of unsaturations
+
+    Returns
+    -------
+    n_c : ``numpy.ndarray(float)``
+        number of carbons in the chains
+    n_u : ``numpy.ndarray(float)``
+        number of double bonds in the chains
+    """
+    n_u = np.ceil(np.maximum(u, 0.))
+    n_c = 1. + 3. * n_u + np.maximum(0., np.ceil(c - 1. - 3. * n_u))
+    return n_c, n_u
+
+
+def _lipid_chains(lipid_cls: str,
+                  n_carbon: np.ndarray,
+                  n_unsat: np.ndarray
+                  ) -> List[Tuple[np.ndarray, np.ndarray]] :
+    """
+    Splits (arrays of) sum fatty acid compositions into the carbons and unsaturations
+    that the lipid SMILES generator template for a lipid class passes to `_carbon_chain`
+    for each of its chains
+
+    Parameters
+    ----------
+    lipid_cls : ``str``
+        lipid class
+    n_carbon : ``numpy.ndarray(int)``
+        fatty acid carbons
+    n_unsat : ``numpy.ndarray(int)``
+        fatty acid unsaturations
+
+    Returns
+    -------
+    chains : ``list(tuple(numpy.ndarray(float), numpy.ndarray(float)))``
+        carbons and unsaturations for each chain
+    """
+    if lipid_cls in _SPHINGO_CLS:
+        # the sphingoid base chain is fixed, with one unsaturation unless saturated
+        return [(n_carbon - 19, np.maximum(n_unsat - 1, 0)),
+                (np.full(n_carbon.shape, 15), np.minimum(n_unsat, 1))]
+    if lipid_cls in _DIACYL_CLS:
+        nc, nu = n_carbon - 2, n_unsat
+        return [(nc / 2, nu / 2), (nc / 2 + nc % 2, nu / 2 + nu % 2)]
+    if lipid_cls in _LYSO_CLS:
+        return [(n_carbon - 1, n_unsat)]
+    # TG
+    nc, nu = n_carbon - 3, n_unsat
+    return [(nc // 3 + nc % 3, nu // 3 + nu % 3), (nc // 3, nu // 3), (nc // 3, nu // 3)]
+
+
+def _lipid_composition(lipid_cls: str,
+                       n_carbon: np.ndarray,
+                       n_unsat: np.ndarray
+                       ) -> Tuple[np.ndarray, np.ndarray] :
+    """ total carbons and double bonds in the fatty acyl chains of generated lipid structures """
+    total_c, total_u = np.zeros(n_carbon.shape), np.zeros(n_carbon.shape)
+    for c, u in _lipid_chains(lipid_cls, n_carbon, n_unsat):
+        n_c, n_u = _chain_composition(c, u)
+        total_c += n_c
+        total_u += n_u
+    return total_c, total_u
+
+
+class CompositionalMQNs:
+    """
+    Computes MQNs for generated peptide and lipid SMILES structures from their composition
+    using contribution vectors that are calibrated against RDKit
+
+    A few structures for every generator template are also checked against RDKit right
+    after calibrating, if any of them do not match (e.g. a change in a newer RDKit version
+    breaks the additivity) the analytical MQNs are not used at all (see ``usable_``) and
+    everything gets computed by RDKit as before.
+
+    The number of structures that had MQNs computed analytically is counted in the
+    ``n_computed_`` attribute.
+    """
+
+    def __init__(self
+                 ) -> None :
+        """
+        Calibrates the contribution vectors against RDKit
+        """
+        # only silence RDKit while calibrating and spot checking
+        with BlockLogs():
+            self._calibrate_peptides()
+            self._calibrate_lipids()
+            self.usable_ = True
+            self.usable_ = self._spot_check()
+        self.n_computed_ = 0
+
+    def _calibrate_peptides(self
+                            ) -> None :
+        """
+        calibrates per-residue, terminal residue, and backbone contributions for peptides,
+        relative to polyglycine
+        """
+        def mqns(seq):
+            return _rdkit_mqns(_peptide_seq_to_smiles(seq))
+        # polyglycine is affine in the number of residues
+        self._pep_per_res = mqns("GGGGG") - mqns("GGGG")
+        self._pep_base = mqns("GGGG") - 4. * self._pep_per_res
+        # residue contributions are calibrated from pairs of residues because some (His)
+        # only add up to whole numbers in pairs
+        poly_g = {n: self._pep_base + n * self._pep_per_res for n in (5, 6)}
+        self._pep_res = np.array([(mqns("GG" + aa * 2 + "GG") - poly_g[6]) / 2. for aa in _AAS])
+        self._pep_n_term = np.array([mqns(aa * 2 + "GGGG") - poly_g[6] - 2. * v for aa, v in zip(_AAS, self._pep_res)])
+        self._pep_c_term = np.array([mqns("GGGG" + aa * 2) - poly_g[6] - 2. * v for aa, v in zip(_AAS, self._pep_res)])
+        # correction terms: RDKit has to round any fractional sums, figure out which way
+        # it goes for each column from a single copy of a residue with a fractional contribution
+        self._pep_ceil = np.zeros(42, dtype=bool)
+        self._pep_floor = np.zeros(42, dtype=bool)
+        for aa, v in zip(_AAS, self._pep_res):
+            if (frac := v != np.round(v)).any():
+                diff = mqns("GG" + aa + "GG") - poly_g[5] - v
+                self._pep_ceil |= frac & (diff > 0)
+                self._pep_floor |= frac & (diff < 0)
+        # lookup tables for encoding sequences
+        self._aa_codes = np.full(256, -1, dtype=np.int16)
+        for i, aa in enumerate(_AAS):
+            self._aa_codes[ord(aa)] = i
+        self._aa_rings = np.array([2 if "{1}" in _AA_TO_SMI[aa] else int("{0}" in _AA_TO_SMI[aa]) for aa in _AAS])
+
+    def _calibrate_lipids(self
+                          ) -> None :
+        """
+        calibrates the reference structure for each lipid class and the per-carbon and
+        per-unsaturation contributions of fatty acyl chains
+        """
+        def acid_mqns(c, u):
+            return _rdkit_mqns("OC(=O)" + _carbon_chain(c, u))
+        self._lipid_per_c = acid_mqns(16, 0) - acid_mqns(15, 0)
+        self._lipid_per_u = acid_mqns(16, 1) - acid_mqns(16, 0)
+        self._lipid_ref = {}
+        for lipid_cls, (nc, nu) in _LIPID_REF_COMP.items():
+            total_c, total_u = _lipid_composition(lipid_cls, np.array([nc]), np.array([nu]))
+            self._lipid_ref[lipid_cls] = (_rdkit_mqns(_generate_lipid_smiles(lipid_cls, nc, nu)),
+                                          total_c[0], total_u[0])
+
+    def _spot_check(self
+                    ) -> bool :
+        """ checks a few structures for every generator template against RDKit """
+        seqs = ["".join(_AAS), "".join(reversed(_AAS)), "HWH", "PGH", "K"]
+        for seq, mqns in zip(seqs, self.peptide_mqns(seqs)):
+            if mqns is None or mqns != _rdkit_mqns(_peptide_seq_to_smiles(seq)).tolist():
+                return False
+        for lipid_cls in _LIPID_REF_COMP:
+            comps = [(40, 0), (41, 3), (44, 7)] if lipid_cls != "TG" else [(50, 0), (55, 5)]
+            classes = [lipid_cls] * len(comps)
+            nc, nu = zip(*comps)
+            for (n_carbon, n_unsat), mqns in zip(comps, self.lipid_mqns(classes, nc, nu)):
+                smi = _generate_lipid_smiles(lipid_cls, n_carbon, n_unsat)
+                if mqns is None or mqns != _rdkit_mqns(smi).tolist():
+                    return False
+        return True
+
+    def peptide_mqns(self,
+                     seqs: List[str]
+                     ) -> List[Optional[List[int]]] :
+        """
+        Computes MQNs for the structures that the peptide SMILES generator makes for
+        linear peptide sequences
+
+        Parameters
+        ----------
+        seqs : ``list(str)``
+            peptide sequences
+
+        Returns
+        -------
+        mqns : ``list(list(int) or None)``
+            MQNs for each sequence, None if the MQNs can not be computed analytically (the
+            sequence has unknown residues or too many rings for the SMILES generator)
+        """
+        if not self.usable_ or not seqs:
+            return [None] * len(seqs)
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        codes = self._aa_codes[np.frombuffer("".join(seqs).encode("ascii", "replace"), dtype=np.uint8)]
+        seq_idx = np.repeat(np.arange(len(seqs)), lengths)
+        known = codes >= 0
+        # residue counts for each sequence
+        counts = np.zeros((len(seqs), len(_AAS)))
+        np.add.at(counts, (seq_idx[known], codes[known]), 1.)
+        valid = (lengths > 0) & (counts.sum(axis=1) == lengths) & (counts @ self._aa_rings <= _MAX_PEPTIDE_RINGS)
+        # sum the contributions
+        first = codes[np.minimum(offsets, len(codes) - 1)]
+        last = codes[np.maximum(offsets + lengths - 1, 0)]
+        mqns = (self._pep_base + lengths[:, None] * self._pep_per_res + counts @ self._pep_res
+                + self._pep_n_term[first] + self._pep_c_term[last])
+        mqns[:, self._pep_ceil] = np.ceil(mqns[:, self._pep_ceil])
+        mqns[:, self._pep_floor] = np.floor(mqns[:, self._pep_floor])
+        mqns = np.rint(mqns).astype(np.int64).tolist()
+        return [m if v else None for m, v in zip(mqns, valid)]
+
+    def lipid_mqns(self,
+                   lipid_classes: List[str],
+                   n_carbons: List[int],
+                   n_unsats: List[int],
+                   fa_mods: Optional[List[Optional[str]]] = None
+                   ) -> List[Optional[List[int]]] :
+        """
+        Computes MQNs for the structures that the lipid SMILES generator makes for lipid
+        classes and (sum) fatty acid compositions
+
+        Parameters
+        ----------
+        lipid_classes : ``list(str)``
+            lipid classes
+        n_carbons : ``list(int)``
+            fatty acid carbons
+        n_unsats : ``list(int)``
+            fatty acid unsaturations
+        fa_mods : ``list(str or None)``, optional
+            fatty acid modifiers, defaults to no modifiers
+
+        Returns
+        -------
+        mqns : ``list(list(int) or None)``
+            MQNs for each lipid, None if the lipid SMILES generator does not make a
+            structure for it
+        """
+        n = len(lipid_classes)
+        out = [None] * n
+        if not self.usable_ or not n:
+            return out
+        fa_mods = [None] * n if fa_mods is None else fa_mods
+        lipid_classes = np.array(lipid_classes, dtype=object)
+        n_carbons = np.array(n_carbons, dtype=np.int64)
+        n_unsats = np.array(n_unsats, dtype=np.int64)
+        has_mod = np.array([bool(fa_mod) for fa_mod in fa_mods])
+        is_d = np.array([fa_mod == "d" for fa_mod in fa_mods])
+        for lipid_cls, (ref, ref_c, ref_u) in self._lipid_ref.items():
+            sel = lipid_classes == lipid_cls
+            # sphingolipids accept the "d" modifier, nothing else accepts any modifier
+            sel &= ~has_mod | is_d if lipid_cls in _SPHINGO_CLS else ~has_mod
+            if lipid_cls == "TG":
+                # the TG template needs at least 3 fatty acid carbons per chain
+                sel &= n_carbons >= 6
+            if not sel.any():
+                continue
+            idx = np.nonzero(sel)[0]
+            total_c, total_u = _lipid_composition(lipid_cls, n_carbons[idx], n_unsats[idx])
+            mqns = ref + np.outer(total_c - ref_c, self._lipid_per_c) + np.outer(total_u - ref_u, self._lipid_per_u)
+            for i, m in zip(idx, np.rint(mqns).astype(np.int64).tolist()):
+                out[i] = m
+        return out
+
+    def mqns_from_names(self,
+                        smi_to_name: Dict[str, str]
+                        ) -> Dict[str, List[int]] :
+        """
+        Computes MQNs for SMILES structures that came from the peptide or lipid SMILES
+        generators, using the compound names to get the sequences or lipid compositions.
+        A structure is only used if it is identical to what the generator makes for the
+        parsed name (e.g. not a lipid structure from LIPID MAPS)
+
+        Parameters
+        ----------
+        smi_to_name : ``dict(str:str)``
+            mapping of SMILES structures to compound names
+
+        Returns
+        -------
+        smi_to_mqns : ``dict(str:list(int))``
+            mapping of the SMILES structures that had MQNs computed analytically to MQNs
+        """
+        if not self.usable_:
+            return {}
+        annotations = annotate_names(smi_to_name.values())
+        peptides, lipids = [], []
+        for smi, name in smi_to_name.items():
+            annotation = annotations[name]
+            if (p_lipid := annotation["lipid"]) is not None:
+                lc, nc, nu, fa_mod = p_lipid["lipid_class"], p_lipid["n_carbon"], p_lipid["n_unsat"], p_lipid.get("fa_mod")
+                if smi == _generate_lipid_smiles(lc, nc, nu, fa_mod=fa_mod):
+                    lipids.append((smi, lc, nc, nu, fa_mod))
+            elif annotation["is_peptide"] and smi == _peptide_seq_to_smiles(name):
+                peptides.append((smi, name))
+        smi_to_mqns = {}
+        if peptides:
+            for (smi, _), mqns in zip(peptides, self.peptide_mqns([seq for _, seq in peptides])):
+                if mqns is not None:
+                    smi_to_mqns[smi] = mqns
+        if lipids:
+            _, lipid_classes, n_carbons, n_unsats, fa_mods = map(list, zip(*lipids))
+            for (smi, *_), mqns in zip(lipids, self.lipid_mqns(lipid_classes, n_carbons, n_unsats, fa_mods)):
+                if mqns is not None:
+                    smi_to_mqns[smi] = mqns
+        self.n_computed_ += len(smi_to_mqns)
+        return smi_to_mqns
+
+    def validate(self,
+                 n_random_peptides: int = 2000,
+                 seed: int = 420
+                 ) -> Dict[str, Any] :
+        """
+        Checks the analytical MQNs against RDKit for every generator template: all
+        peptides with up to 3 residues plus random longer sequences, and every lipid
+        class over a wide range of fatty acid compositions and modifiers
+
+        Parameters
+        ----------
+        n_random_peptides : ``int``, default=2000
+            number of random peptide sequences (4-40 residues) to check
+        seed : ``int``, default=420
+            random seed for generating the peptide sequences
+
+        Returns
+        -------
+        results : ``dict(...)``
+            number of structures checked ("n_checked"), structures that were computed
+            by RDKit because they can not be done analytically ("n_skipped") and the
+            structures with mismatched MQNs ("mismatches", list of SMILES)
+        """
+        rng = random.Random(seed)
+        seqs = [a for a in _AAS]
+        seqs += [a + b for a in _AAS for b in _AAS]
+        seqs += [a + b + c for a in _AAS for b in _AAS for c in _AAS]
+        seqs += ["".join(rng.choices(_AAS, k=rng.randint(4, 40))) for _ in range(n_random_peptides)]
+        checks = [(_peptide_seq_to_smiles(seq), mqns) for seq, mqns in zip(seqs, self.peptide_mqns(seqs))]
+        lipids = [(lipid_cls, nc, nu, fa_mod) for lipid_cls in _LIPID_REF_COMP for fa_mod in (None, "d", "O")
+                  for nc in range(0, 81) for nu in range(0, 25)]
+        results = {"n_checked": 0, "n_skipped": 0, "mismatches": []}
+        for (lipid_cls, nc, nu, fa_mod), mqns in zip(lipids, self.lipid_mqns(*map(list, zip(*lipids)))):
+            smi = _generate_lipid_smiles(lipid_cls, nc, nu, fa_mod=fa_mod)
+            if smi is None and mqns is not None:
+                # MQNs for a lipid that the generator does not make a structure for
+                results["mismatches"].append(f"{lipid_cls} {nc}:{nu} ({fa_mod})")
+            elif smi is not None:
+                checks.append((smi, mqns))
+        for smi, mqns in checks:
+            if mqns is None:
+                results["n_skipped"] += 1
+                continue
+            results["n_checked"] += 1
+            if mqns != _rdkit_mqns(smi).tolist():
+                results["mismatches"].append(smi)
+        return results
+
+
+def _main():
+    print("calibrating compositional MQNs ...", end=" ")
+    compositional = CompositionalMQNs()
+    print("done")
+    print(f"\tpassed spot checks: {compositional.usable_}")
+    print("validating against RDKit ...", end=" ")
+    results = compositional.validate()
+    print("done")
+    print(f"\tstructures checked: {results['n_checked']} skipped: {results['n_skipped']} "
+          f"mismatched: {len(results['mismatches'])}")
+    for smi in results["mismatches"][:10]:
+        print(f"\t\t{smi}")
+
+
+if __name__ == "__main__":
+    _main()
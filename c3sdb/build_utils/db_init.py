@@ -3,48 +3,210 @@
 
     Dylan Ross (dylan.ross@pnnl.gov)
 
-    Module for inititializing the database file
+    Module for inititializing the database file, and for upgrading databases made with
+    older versions of the schema
 """
 
 
+from typing import List, Tuple
 import os
 import sqlite3
 
+from c3sdb.build_utils.classification import set_annotation_version
+
 
 # store path to _include directory in this package
 _INCLUDE_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_include/")
 
+# version of the database schema, stored in the database file (PRAGMA user_version)
+# - 0: original schema (rowid tables, mqns.g_id declared INTEGER, no secondary indexes)
+# - 1: mqns.g_id declared TEXT (rows kept in the same order as master), predicted keyed on 
+#       g_id (TEXT) WITHOUT ROWID, secondary indexes on master
+_SCHEMA_VERSION: int = 1
+
+# tables that are rebuilt when upgrading from schema version 0, the scripts defining them, 
+# and the queries selecting the rows to copy over from the old tables (in order)
+_V1_TABLES: List[Tuple[str, str, str]] = [
+    ("mqns", "mqn_schema.sqlite3", 
+     "SELECT _old_mqns.* FROM _old_mqns LEFT JOIN master ON master.g_id=_old_mqns.g_id "
+     "ORDER BY master.rowid IS NULL, master.rowid, _old_mqns.rowid"),
+    ("predicted", "pred_CCS_schema.sqlite3", 
+     "SELECT * FROM _old_predicted"),
+]
+
 
-def create_db(f: str
+def create_db(f: str,
+              overwrite: bool = True
               ) -> None :
     """
     initialize the C3S.db from SQLite3 scripts (included in this package in the c3sdb/_include/ directory)
     
     .. note:: 
 
-        overwrites the database file if it already exists
+        overwrites the database file if it already exists, unless overwrite=False in which 
+        case an existing database is kept (only the build manifest tables are added to it if 
+        they are missing), existing databases made with an older version of the schema are 
+        not upgraded here, that has to be done explicitly with the migrate script 
+        (`python3 -m c3sdb.build_utils.migrate C3S.db`)
 
     Parameters
     ----------
     f : ``str``
         filename/path of the database
+    overwrite : ``bool``, default=True
+        overwrite the database file if it already exists
     """
     # see if the file exists
-    if os.path.exists(f):
+    exists = os.path.exists(f)
+    if exists and overwrite:
         os.remove(f)
+        exists = False
+    if exists:
+        con = sqlite3.connect(f)
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        has_master = con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='master'").fetchone()
+        con.close()
+        if has_master and version < _SCHEMA_VERSION:
+            msg = (f"create_db: existing database {f} has schema version {version} (current version is "
+                   f"{_SCHEMA_VERSION}), upgrade it first with: python3 -m c3sdb.build_utils.migrate {f}")
+            raise RuntimeError(msg)
     # initial connection creates the DB
     con = sqlite3.connect(f)  
     cur = con.cursor()
     # execute SQL scripts to set up the database
     sql_scripts = [
-        os.path.join(_INCLUDE_PATH, "C3SDB_schema.sqlite3"),
-        os.path.join(_INCLUDE_PATH, "mqn_schema.sqlite3"),
-        os.path.join(_INCLUDE_PATH, "pred_CCS_schema.sqlite3")
+        os.path.join(_INCLUDE_PATH, "build_manifest_schema.sqlite3"),
+        os.path.join(_INCLUDE_PATH, "name_annotations_schema.sqlite3")
     ]
+    if not exists:
+        sql_scripts = [
+            os.path.join(_INCLUDE_PATH, "C3SDB_schema.sqlite3"),
+            os.path.join(_INCLUDE_PATH, "mqn_schema.sqlite3"),
+            os.path.join(_INCLUDE_PATH, "pred_CCS_schema.sqlite3")
+        ] + sql_scripts
     for sql_script in sql_scripts:
         with open(sql_script, "r") as sql_f:
             cur.executescript(sql_f.read())
+    if not exists:
+        cur.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+        set_annotation_version(cur)
     # save and close the database
     con.commit()
     con.close()
 
+
+def _script_statements(sql_script: str
+                       ) -> List[str] :
+    """ 
+    split one of the SQL scripts (in _include/) into statements, so that they can be run 
+    inside of a transaction (executescript commits before running the script) 
+    """
+    stmts, stmt = [], ""
+    with open(os.path.join(_INCLUDE_PATH, sql_script), "r") as sql_f:
+        for line in sql_f:
+            if not stmt and line.lstrip().startswith("--"):
+                continue
+            stmt += line
+            if sqlite3.complete_statement(stmt):
+                stmts.append(stmt.strip())
+                stmt = ""
+    return stmts
+
+
+def _index_names(cursor: sqlite3.Cursor
+                 ) -> List[str] :
+    """ names of the secondary indexes on the master table (see C3SDB_indexes.sqlite3) """
+    qry = "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='master' AND name LIKE 'idx_%'"
+    return [name for name, in cursor.execute(qry).fetchall()]
+
+
+def create_indexes(cursor: sqlite3.Cursor
+                   ) -> None :
+    """
+    Creates the secondary indexes on C3S.db (defined in C3SDB_indexes.sqlite3), this 
+    should be done after the data has been loaded. Indexes that already exist are kept.
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    """
+    with open(os.path.join(_INCLUDE_PATH, "C3SDB_indexes.sqlite3"), "r") as sql_f:
+        cursor.executescript(sql_f.read())
+
+
+def drop_indexes(cursor: sqlite3.Cursor
+                 ) -> None :
+    """
+    Drops the secondary indexes on C3S.db (e.g. before bulk loading more data into an 
+    existing database), they get recreated by `create_indexes`
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    """
+    for name in _index_names(cursor):
+        cursor.execute(f"DROP INDEX {name}")
+    cursor.connection.commit()
+
+
+def migrate_db(f: str
+               ) -> bool :
+    """
+    Upgrades an existing database to the current schema version (_SCHEMA_VERSION) in 
+    place, in a single transaction (the database is left as it was if anything fails)
+
+    - version 0 -> 1: the mqns table is rebuilt with g_id declared TEXT (keeping its rows 
+        in the same order as the corresponding entries in master) and the predicted table 
+        is rebuilt as a WITHOUT ROWID table keyed on g_id (TEXT), then the secondary indexes 
+        are created on the master table and the query planner statistics are updated. The number of rows in each rebuilt table is 
+        checked against the old table and the upgrade is aborted if they do not match.
+
+    Parameters
+    ----------
+    f : ``str``
+        filename/path of the database
+
+    Returns
+    -------
+    migrated : ``bool``
+        whether the database was upgraded (False if it was already up to date)
+    """
+    con = sqlite3.connect(f, isolation_level=None)
+    cur = con.cursor()
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    if version >= _SCHEMA_VERSION:
+        con.close()
+        return False
+    tables = {name for name, in cur.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    cur.execute("BEGIN")
+    try:
+        if version < 1:
+            for table, sql_script, qry_copy in _V1_TABLES:
+                if table not in tables:
+                    continue
+                # rename the old table, recreate it from the current schema and copy the 
+                # data over (TEXT affinity converts any numeric g_ids to text)
+                cur.execute(f"ALTER TABLE {table} RENAME TO _old_{table}")
+                for stmt in _script_statements(sql_script):
+                    cur.execute(stmt)
+                n_old = cur.execute(f"SELECT COUNT(*) FROM _old_{table}").fetchone()[0]
+                cur.execute(f"INSERT INTO {table} {qry_copy}")
+                n_new = cur.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                if n_new != n_old:
+                    msg = f"migrate_db: {table} has {n_new} rows after rebuilding (expected {n_old})"
+                    raise RuntimeError(msg)
+                cur.execute(f"DROP TABLE _old_{table}")
+            if "master" in tables:
+                for stmt in _script_statements("C3SDB_indexes.sqlite3"):
+                    cur.execute(stmt)
+        cur.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        con.close()
+        raise
+    cur.execute("ANALYZE")
+    con.close()
+    return True
@@ -0,0 +1,97 @@
+"""
+    c3sdb/build_utils/gen_lipid_library.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    script for generating the precomputed lipid library (see `c3sdb.build_utils.lipid_library`)
+
+    - use command: `python3 -m c3sdb.build_utils.gen_lipid_library`
+    - (re)creates the built in lipid library file: `c3sdb/_include/lipid_library.db`
+    - the library needs to be regenerated whenever the lipid SMILES generator or the
+        composition ranges below change, or to make its MQNs usable with a different
+        RDKit version
+"""
+
+
+from typing import List, Tuple, Iterator
+import sqlite3
+import os
+
+import rdkit
+
+from c3sdb.build_utils.smiles import _generate_lipid_smiles
+from c3sdb.build_utils.mqns import compute_mqns_many
+from c3sdb.build_utils.lipid_library import _LIPID_LIBRARY_PATH, _LIPID_LIBRARY_SCHEMA, _pack_mqns
+
+
+# lipid classes to include in the library along with the fatty acid modifiers that the
+# lipid SMILES generator accepts for them and the (inclusive) ranges of (sum) fatty acid
+# carbons and unsaturations to cover
+_LIBRARY_RANGES: List[Tuple[List[str], List[str], Tuple[int, int], Tuple[int, int]]] = [
+    # sphingolipids
+    (["SM", "Cer", "GlcCer", "HexCer"], ["", "d"], (28, 52), (0, 10)),
+    # phospholipids
+    (["PC", "PE", "PS", "PA", "PG"], [""], (12, 60), (0, 20)),
+    # lysophospholipids
+    (["LPC", "LPE", "LPS", "LPA", "LPG"], [""], (12, 30), (0, 8)),
+    # glycerolipids
+    (["DG", "DGDG"], [""], (20, 56), (0, 14)),
+    # triacylglycerols (up to 6 unsaturations in each of the three fatty acids)
+    (["TG"], [""], (24, 72), (0, 18)),
+]
+
+
+def _enumerate_lipids(
+                      ) -> Iterator[Tuple[str, int, int, str, str]] :
+    """
+    yields lipid_class, n_carbon, n_unsat, fa_mod, SMILES for every lipid in the library
+    ranges that the lipid SMILES generator can make a structure for
+    """
+    for lipid_classes, fa_mods, (c_min, c_max), (u_min, u_max) in _LIBRARY_RANGES:
+        for lipid_class in lipid_classes:
+            for fa_mod in fa_mods:
+                for n_carbon in range(c_min, c_max + 1):
+                    for n_unsat in range(u_min, u_max + 1):
+                        if smi := _generate_lipid_smiles(lipid_class, n_carbon, n_unsat, fa_mod=fa_mod or None):
+                            yield lipid_class, n_carbon, n_unsat, fa_mod, smi
+
+
+def generate_lipid_library(db_path: str = _LIPID_LIBRARY_PATH
+                           ) -> int :
+    """
+    Generates the lipid library, overwrites the library file if it exists
+
+    Parameters
+    ----------
+    db_path : ``str``, default=_LIPID_LIBRARY_PATH
+        path to the lipid library database file
+
+    Returns
+    -------
+    n_lipids : ``int``
+        number of lipids in the library
+    """
+    lipids = list(_enumerate_lipids())
+    smi_to_mqns = compute_mqns_many([lipid[4] for lipid in lipids])
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    con = sqlite3.connect(db_path)
+    con.executescript(_LIPID_LIBRARY_SCHEMA)
+    con.execute("INSERT INTO library_info VALUES ('rdkit_version', ?)", (rdkit.__version__,))
+    con.executemany("INSERT INTO lipid_library VALUES (?,?,?,?,?,?)",
+                    [(*lipid, _pack_mqns(smi_to_mqns[lipid[4]])) for lipid in lipids])
+    con.commit()
+    con.execute("VACUUM")
+    con.close()
+    return len(lipids)
+
+
+def _main():
+    print("generating lipid library ...", end=" ")
+    n_lipids = generate_lipid_library()
+    print("done")
+    print(f"\tlipids in library: {n_lipids}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,342 @@
+"""
+    c3sdb/build_utils/incremental.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module with utilities for incremental builds of the database, tracking content hashes
+    of the source datasets and of each build stage's inputs (in the build_manifest and
+    build_stages tables) so that only new or changed data needs to be processed, and 
+    checkpoints of each build stage's progress (in the build_checkpoints table) so that
+    an interrupted build can be resumed
+"""
+
+
+from typing import List, Tuple, Dict, Optional, Any
+import sqlite3
+import hashlib
+import time
+
+from c3sdb.build_utils.src_data import _find_src_file
+
+
+def src_file_hash(src_tag: str
+                  ) -> str :
+    """
+    computes the SHA1 hash of the contents of a source dataset file
+
+    Parameters
+    ----------
+    src_tag : ``str``
+        identifier for source dataset
+
+    Returns
+    -------
+    src_hash : ``str``
+        hex digest of the SHA1 hash
+    """
+    src_dset_file = _find_src_file(src_tag)
+    h = hashlib.sha1()
+    with open(src_dset_file, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_manifest(cursor: sqlite3.Cursor
+                 ) -> Dict[str, str] :
+    """
+    Returns the content hashes of the source datasets that are currently in the database
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+
+    Returns
+    -------
+    manifest : ``dict(str:str)``
+        mapping of src_tags to content hashes
+    """
+    return dict(cursor.execute("SELECT src_tag, src_hash FROM build_manifest").fetchall())
+
+
+def plan_incremental(cursor: sqlite3.Cursor,
+                     src_tags: List[str]
+                     ) -> Tuple[List[str], List[str], List[str]] :
+    """
+    Compares the source datasets to include in the build against the build manifest
+    of the database to determine what needs to change
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    src_tags : ``list(str)``
+        source datasets to include in the database
+
+    Returns
+    -------
+    to_add : ``list(str)``
+        src_tags of new source datasets and source datasets that have changed (these
+        need to be (re-)added to the database)
+    to_remove : ``list(str)``
+        src_tags of source datasets that have been dropped and source datasets that have
+        changed (these need to be removed from the database)
+    unchanged : ``list(str)``
+        src_tags of source datasets that are already in the database and have not changed
+    """
+    manifest = get_manifest(cursor)
+    to_add, to_remove, unchanged = [], [], []
+    for src_tag in src_tags:
+        if src_tag not in manifest:
+            to_add.append(src_tag)
+        elif manifest[src_tag] != src_file_hash(src_tag):
+            to_remove.append(src_tag)
+            to_add.append(src_tag)
+        else:
+            unchanged.append(src_tag)
+    # source datasets that are in the database but were dropped
+    to_remove += [src_tag for src_tag in manifest if src_tag not in src_tags]
+    # also catch any source datasets that are in the database without being in the manifest
+    # (e.g. the database was built before the manifest existed)
+    for src_tag, in cursor.execute("SELECT DISTINCT src_tag FROM master").fetchall():
+        if src_tag not in manifest and src_tag not in to_remove:
+            to_remove.append(src_tag)
+    return to_add, to_remove, unchanged
+
+
+def remove_dataset(cursor: sqlite3.Cursor,
+                   src_tag: str
+                   ) -> int :
+    """
+    Removes all entries (and their MQNs and name annotations) from a source dataset from the database, along
+    with its entry in the build manifest
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    src_tag : ``str``
+        identifier for source dataset
+
+    Returns
+    -------
+    n_removed : ``int``
+        number of entries removed from the database
+    """
+    for table in ["mqns", "name_annotations"]:
+        cursor.execute(f"DELETE FROM {table} WHERE g_id IN (SELECT g_id FROM master WHERE src_tag=?)", (src_tag,))
+    n_removed = cursor.execute("DELETE FROM master WHERE src_tag=?", (src_tag,)).rowcount
+    cursor.execute("DELETE FROM build_manifest WHERE src_tag=?", (src_tag,))
+    return n_removed
+
+
+def record_dataset(cursor: sqlite3.Cursor,
+                   src_tag: str,
+                   n_entries: int
+                   ) -> None :
+    """
+    Records a source dataset (and the hash of its current contents) in the build manifest
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    src_tag : ``str``
+        identifier for source dataset
+    n_entries : ``int``
+        number of entries added to the database from this source
+    """
+    qry = "INSERT OR REPLACE INTO build_manifest VALUES (?,?,?,?)"
+    cursor.execute(qry, (src_tag, src_file_hash(src_tag), n_entries, time.time()))
+
+
+def order_datasets(cursor: sqlite3.Cursor,
+                   src_tags: List[str]
+                   ) -> bool :
+    """
+    Puts the entries in the master table in the same order that a fresh build would have 
+    them in: grouped by source dataset in the order of src_tags (any other source datasets 
+    go at the end) and in the order they were added within each source dataset. Changed 
+    source datasets get removed and re-added at the end of the table by an incremental 
+    build, and the order of the master table determines the order data is fetched in (and 
+    therefore the seeded training/test splits). The table is left alone if it already is 
+    in order.
+
+    .. note::
+
+        the mqns table needs to be put back in the same order afterwards 
+        (`c3sdb.build_utils.mqns.sort_mqns`)
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    src_tags : ``list(str)``
+        source datasets in the order they are added in a fresh build
+
+    Returns
+    -------
+    reordered : ``bool``
+        whether the master table had to be rewritten
+    """
+    pos = {src_tag: i for i, src_tag in enumerate(src_tags)}
+    order = [pos.get(src_tag, len(src_tags)) for src_tag, in cursor.execute("SELECT src_tag FROM master ORDER BY rowid")]
+    if all(a <= b for a, b in zip(order, order[1:])):
+        return False
+    cursor.execute("CREATE TEMP TABLE _src_order (src_tag TEXT PRIMARY KEY NOT NULL, pos INTEGER NOT NULL)")
+    cursor.executemany("INSERT INTO _src_order VALUES (?,?)", pos.items())
+    cursor.execute("CREATE TEMP TABLE _master_sorted AS SELECT master.* FROM master "
+                   "LEFT JOIN _src_order ON _src_order.src_tag=master.src_tag "
+                   "ORDER BY COALESCE(_src_order.pos, ?), master.rowid", (len(src_tags),))
+    # (rowids start over from 1 once the table is empty, same as in a fresh build)
+    cursor.execute("DELETE FROM master")
+    cursor.execute("INSERT INTO master SELECT * FROM _master_sorted ORDER BY rowid")
+    cursor.execute("DROP TABLE _master_sorted")
+    cursor.execute("DROP TABLE _src_order")
+    return True
+
+
+def stage_input_hash(cursor: sqlite3.Cursor,
+                     qry: str,
+                     params: Optional[Any] = None
+                     ) -> str :
+    """
+    computes a SHA1 hash over the results of the query that selects the inputs for a
+    build stage (the query should have a deterministic order) and optionally any other
+    parameters that affect the stage output
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    qry : ``str``
+        query that selects the inputs for the build stage
+    params : ``Any``, optional
+        other parameters affecting the output of the stage, included in the hash using
+        their string representation
+
+    Returns
+    -------
+    input_hash : ``str``
+        hex digest of the SHA1 hash
+    """
+    h = hashlib.sha1(repr(params).encode())
+    for row in cursor.execute(qry):
+        h.update(repr(row).encode())
+    return h.hexdigest()
+
+
+def stage_inputs_changed(cursor: sqlite3.Cursor,
+                         stage: str,
+                         input_hash: str
+                         ) -> bool :
+    """
+    checks whether the inputs for a build stage have changed since the last time the
+    stage was run (or if the stage has never been run)
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    stage : ``str``
+        name of the build stage
+    input_hash : ``str``
+        hash of the current stage inputs (from `stage_input_hash`)
+
+    Returns
+    -------
+    changed : ``bool``
+        whether the stage needs to be run
+    """
+    res = cursor.execute("SELECT input_hash FROM build_stages WHERE stage=?", (stage,)).fetchone()
+    return res is None or res[0] != input_hash
+
+
+def record_stage(cursor: sqlite3.Cursor,
+                 stage: str,
+                 input_hash: str
+                 ) -> None :
+    """
+    Records the hash of the inputs for a build stage after the stage has been run, this 
+    should be the hash of the inputs that are left over after running the stage (e.g. the 
+    entries that still could not be assigned SMILES structures) so that the next time 
+    around the stage is skipped unless something has changed
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    stage : ``str``
+        name of the build stage
+    input_hash : ``str``
+        hash of the stage inputs (from `stage_input_hash`)
+    """
+    cursor.execute("INSERT OR REPLACE INTO build_stages VALUES (?,?,?)", (stage, input_hash, time.time()))
+
+
+def get_checkpoint(cursor: sqlite3.Cursor,
+                   stage: str
+                   ) -> Tuple[Optional[str], Optional[str]] :
+    """
+    Returns the checkpoint for a build stage
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    stage : ``str``
+        name of the build stage
+
+    Returns
+    -------
+    status : ``str`` or ``None``
+        status of the stage ("running" or "done"), None if there is no checkpoint
+    progress : ``str`` or ``None``
+        marker of the last completed chunk of the stage, None if there is none
+    """
+    res = cursor.execute("SELECT status, progress FROM build_checkpoints WHERE stage=?", (stage,)).fetchone()
+    return (None, None) if res is None else res
+
+
+def set_checkpoint(cursor: sqlite3.Cursor,
+                   stage: str,
+                   status: str,
+                   progress: Optional[str] = None
+                   ) -> None :
+    """
+    Records a checkpoint for a build stage, then commits so that the checkpoint (and 
+    everything the stage has written up to that point) survives the build being interrupted
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    stage : ``str``
+        name of the build stage
+    status : ``str``
+        status of the stage ("running" or "done")
+    progress : ``str``, optional
+        marker of the last completed chunk of the stage
+    """
+    cursor.execute("INSERT OR REPLACE INTO build_checkpoints VALUES (?,?,?,?)", 
+                   (stage, status, progress, time.time()))
+    cursor.connection.commit()
+
+
+def clear_checkpoints(cursor: sqlite3.Cursor,
+                      stages: List[str]
+                      ) -> None :
+    """
+    Clears the checkpoints for build stages (e.g. at the start of a build that is not 
+    resuming a previous one)
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    stages : ``list(str)``
+        names of the build stages
+    """
+    cursor.executemany("DELETE FROM build_checkpoints WHERE stage=?", [(stage,) for stage in stages])
+    cursor.connection.commit()
@@ -0,0 +1,158 @@
+"""
+    c3sdb/build_utils/lipid_library.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module with a precomputed library of lipid SMILES structures and MQNs, covering the
+    classes supported by the lipid SMILES generator (see `c3sdb.build_utils.smiles`) over
+    realistic fatty acid composition ranges, stored in a SQLite database that ships with
+    the package (c3sdb/_include/lipid_library.db) so resolving and featurizing those lipids
+    during the build is a local lookup
+
+    The library is (re)generated using: `python3 -m c3sdb.build_utils.gen_lipid_library`
+"""
+
+
+from typing import Optional, List, Dict, Iterable, Any
+import sqlite3
+import struct
+import os
+
+import rdkit
+
+
+# path to the built in lipid library
+_LIPID_LIBRARY_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_include/lipid_library.db")
+
+# schema for the lipid library database
+_LIPID_LIBRARY_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS library_info (
+    key TEXT PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS lipid_library (
+    -- lipid class and (sum) fatty acid composition
+    lipid_class TEXT NOT NULL,
+    n_carbon INTEGER NOT NULL,
+    n_unsat INTEGER NOT NULL,
+    -- fatty acid modifier, empty string if none
+    fa_mod TEXT NOT NULL,
+    -- SMILES structure (from the lipid SMILES generator)
+    smi TEXT NOT NULL,
+    -- MQNs packed as 42 little-endian 16-bit integers, NULL if they could not be computed
+    mqns BLOB,
+    PRIMARY KEY (lipid_class, n_carbon, n_unsat, fa_mod)
+) WITHOUT ROWID;
+"""
+
+# format for packing MQNs
+_MQN_STRUCT: struct.Struct = struct.Struct("<42h")
+
+
+def _pack_mqns(mqns: Optional[List[int]]
+               ) -> Optional[bytes] :
+    """ packs MQNs for storage in the lipid library """
+    return None if mqns is None else _MQN_STRUCT.pack(*mqns)
+
+
+def _unpack_mqns(blob: bytes
+                 ) -> List[int] :
+    """ unpacks MQNs stored in the lipid library """
+    return list(_MQN_STRUCT.unpack(blob))
+
+
+class LipidLibrary:
+    """
+    Read-only interface to a precomputed lipid library database
+
+    The MQNs in the library are only used if the library was generated with the same RDKit
+    version that is installed (see ``mqns_usable_``), otherwise only the SMILES structures
+    are used.
+    """
+
+    def __init__(self,
+                 db_path: str = _LIPID_LIBRARY_PATH
+                 ) -> None :
+        """
+        Opens a lipid library database
+
+        Parameters
+        ----------
+        db_path : ``str``, default=_LIPID_LIBRARY_PATH
+            path to the lipid library database file, defaults to the built in library
+        """
+        if not os.path.isfile(db_path):
+            msg = f"LipidLibrary: lipid library file {db_path} not found"
+            raise ValueError(msg)
+        self.db_path_ = db_path
+        self.con_ = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        qry = "SELECT value FROM library_info WHERE key='rdkit_version'"
+        res = self.con_.execute(qry).fetchone()
+        self.mqns_usable_ = res is not None and res[0] == rdkit.__version__
+        self.n_hits_ = 0
+
+    def get_smiles(self,
+                   p_lipid: Dict[str, Any]
+                   ) -> Optional[str] :
+        """
+        Looks up the SMILES structure for a parsed lipid
+
+        Parameters
+        ----------
+        p_lipid : ``dict(...)``
+            parsed lipid information (from `c3sdb.build_utils._parsing.parse_lipid`)
+
+        Returns
+        -------
+        smi : ``str`` or ``None``
+            SMILES structure, None if the lipid is not in the library
+        """
+        qry = "SELECT smi FROM lipid_library WHERE lipid_class=? AND n_carbon=? AND n_unsat=? AND fa_mod=?"
+        params = (p_lipid["lipid_class"], p_lipid["n_carbon"], p_lipid["n_unsat"], p_lipid.get("fa_mod") or "")
+        if (res := self.con_.execute(qry, params).fetchone()) is None:
+            return None
+        self.n_hits_ += 1
+        return res[0]
+
+    def get_mqns_many(self,
+                      smis: Iterable[str]
+                      ) -> Dict[str, List[int]] :
+        """
+        Looks up MQNs for a set of SMILES structures, always empty if the library MQNs are
+        not usable with the installed RDKit version
+
+        Parameters
+        ----------
+        smis : ``iterable(str)``
+            SMILES structures
+
+        Returns
+        -------
+        smi_to_mqns : ``dict(str:list(int))``
+            mapping of SMILES structures that are in the library (and have MQNs) to MQNs
+        """
+        if not self.mqns_usable_:
+            return {}
+        smis = list(smis)
+        smi_to_mqns = {}
+        # stay below the limit on the number of bound parameters
+        for i in range(0, len(smis), 500):
+            chunk = smis[i:i + 500]
+            qry = f"SELECT smi, mqns FROM lipid_library WHERE mqns IS NOT NULL AND smi IN ({','.join('?' * len(chunk))})"
+            for smi, mqns in self.con_.execute(qry, chunk).fetchall():
+                smi_to_mqns[smi] = _unpack_mqns(mqns)
+        return smi_to_mqns
+
+    def close(self
+              ) -> None :
+        """ close the connection to the lipid library database """
+        self.con_.close()
+
+    def __enter__(self
+                  ) -> "LipidLibrary" :
+        return self
+
+    def __exit__(self, *args
+                 ) -> None :
+        self.close()
@@ -0,0 +1,138 @@
+"""
+    c3sdb/build_utils/migrate.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Script for upgrading an existing database (C3S.db) to the current schema version in place
+    (see `c3sdb.build_utils.db_init.migrate_db`), and for benchmarking the queries used to
+    fetch data from it
+
+    - use command: `python3 -m c3sdb.build_utils.migrate C3S.db`
+    - options:
+        - `--benchmark`: print the query plans and timings for the benchmark queries
+            before and after upgrading the database
+"""
+
+
+from typing import Dict, Any, List, Tuple
+import sqlite3
+import argparse
+import time
+
+from c3sdb.build_utils.db_init import migrate_db
+
+
+# representative queries against C3S.db: fetching datasets (like `c3sdb.ml.data.C3SD`)
+# and filtering on adduct, chemical class, structure and m/z / CCS ranges
+_BENCHMARK_QUERIES: Dict[str, str] = {
+    "single_dset": "SELECT name, mz, adduct, ccs, src_tag, smi, chem_class_label, mqns.* FROM master "
+                   "INNER JOIN mqns ON mqns.g_id=master.g_id WHERE src_tag IN (?) AND smi IS NOT NULL ORDER BY master.rowid",
+    "multi_dset": "SELECT name, mz, adduct, ccs, src_tag, smi, chem_class_label, mqns.* FROM master "
+                  "INNER JOIN mqns ON mqns.g_id=master.g_id WHERE src_tag IN (?,?,?) AND smi IS NOT NULL "
+                  "ORDER BY master.rowid",
+    "adduct": "SELECT g_id, mz, ccs FROM master WHERE adduct=?",
+    "chem_class_label": "SELECT g_id, mz, ccs FROM master WHERE chem_class_label=?",
+    "smi": "SELECT g_id, adduct, ccs FROM master WHERE smi=?",
+    "mz_range": "SELECT g_id, adduct, ccs FROM master WHERE mz BETWEEN ? AND ?",
+    "ccs_range": "SELECT g_id, adduct, mz FROM master WHERE ccs BETWEEN ? AND ?",
+}
+
+
+def _benchmark_params(cursor: sqlite3.Cursor
+                      ) -> Dict[str, Tuple[Any, ...]] :
+    """ pick (typical) parameters for the benchmark queries from the data in the database """
+    def most_common(col):
+        qry = f"SELECT {col} FROM master WHERE {col} IS NOT NULL GROUP BY {col} ORDER BY COUNT(*) DESC LIMIT 3"
+        return [_ for _, in cursor.execute(qry).fetchall()]
+    src_tags = most_common("src_tag")
+    smi = cursor.execute("SELECT smi FROM master WHERE smi IS NOT NULL LIMIT 1").fetchone()
+    return {
+        "single_dset": (src_tags[0],),
+        "multi_dset": tuple((src_tags * 3)[:3]),
+        "adduct": (most_common("adduct")[0],),
+        "chem_class_label": (most_common("chem_class_label")[0],),
+        "smi": (smi[0] if smi else "",),
+        "mz_range": (500., 510.),
+        "ccs_range": (200., 202.),
+    }
+
+
+def benchmark_queries(f: str,
+                      n_repeat: int = 10
+                      ) -> Dict[str, Dict[str, Any]] :
+    """
+    Gets the query plan (EXPLAIN QUERY PLAN) and the time to run each of the benchmark
+    queries (_BENCHMARK_QUERIES) against a database
+
+    Parameters
+    ----------
+    f : ``str``
+        filename/path of the database
+    n_repeat : ``int``, default=10
+        number of times to run each query, the best time is reported
+
+    Returns
+    -------
+    results : ``dict(str:dict(...))``
+        query plan (plan, list of steps), time in milliseconds (ms) and number of rows
+        returned (n_rows) for each benchmark query
+    """
+    con = sqlite3.connect(f)
+    cur = con.cursor()
+    params = _benchmark_params(cur)
+    results = {}
+    for name, qry in _BENCHMARK_QUERIES.items():
+        plan = [detail for *_, detail in cur.execute("EXPLAIN QUERY PLAN " + qry, params[name]).fetchall()]
+        times = []
+        for _ in range(n_repeat):
+            t0 = time.perf_counter()
+            n_rows = len(cur.execute(qry, params[name]).fetchall())
+            times.append(time.perf_counter() - t0)
+        results[name] = {"plan": plan, "ms": 1000. * min(times), "n_rows": n_rows}
+    con.close()
+    return results
+
+
+def _print_benchmarks(results: Dict[str, Dict[str, Any]]
+                      ) -> None :
+    """ print benchmark results """
+    for name, result in results.items():
+        print(f"\t{name}: {result['ms']:.3f} ms ({result['n_rows']} rows)")
+        for step in result["plan"]:
+            print(f"\t\t{step}")
+
+
+def _parse_args(
+                ) -> argparse.Namespace :
+    """ parse command line arguments """
+    parser = argparse.ArgumentParser(description="upgrade an existing C3S.db to the current schema version")
+    parser.add_argument("db", nargs="?", default="C3S.db",
+                        help="path to the database (default: C3S.db)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="print query plans and timings before and after upgrading")
+    return parser.parse_args()
+
+
+def _main():
+    args = _parse_args()
+    before: List[Tuple[str, float]] = []
+    if args.benchmark:
+        print("benchmark queries (before) ...")
+        results = benchmark_queries(args.db)
+        _print_benchmarks(results)
+        before = [(name, result["ms"]) for name, result in results.items()]
+        print("... done")
+    print("upgrading database ...", end=" ")
+    print("done" if migrate_db(args.db) else "already up to date")
+    if args.benchmark:
+        print("benchmark queries (after) ...")
+        results = benchmark_queries(args.db)
+        _print_benchmarks(results)
+        print("... done")
+        print("speedup:")
+        for name, ms in before:
+            print(f"\t{name}: {ms / max(results[name]['ms'], 1e-6):.1f}x")
+
+
+if __name__ == "__main__":
+    _main()
@@ -8,10 +8,66 @@
 
 
 import sqlite3
-from typing import Optional, List
+from typing import Optional, List, Tuple, Dict, Iterator, Iterable, Callable
+from multiprocessing import Pool, Array
+from collections import deque
+from itertools import chain
+from array import array
+import ctypes
+import time
+import os
 
-from rdkit import Chem
+import rdkit
+from rdkit import Chem, RDLogger
 from rdkit.Chem import Descriptors
+from rdkit.rdBase import BlockLogs
+
+from c3sdb.build_utils.lipid_library import LipidLibrary
+from c3sdb.build_utils.compositional_mqns import CompositionalMQNs
+
+
+# reasons for failing to compute MQNs
+_MQN_PARSE_ERROR: str = "parse error"
+_MQN_ERROR: str = "MQN error"
+_MQN_TIMEOUT: str = "timeout"
+
+# how often (in seconds) to check on the progress of the MQN worker processes
+_MQN_POLL_INTERVAL: float = 0.1
+
+# (in MQN worker processes) shared counters of the number of entries finished, one slot per 
+# chunk in flight, so that stalls can be detected per entry instead of per chunk
+_progress = None
+
+
+def _compute_mqns(smi: str
+                  ) -> Tuple[Optional[List[int]], Optional[str]] :
+    """
+    Computes MQNs for a SMILES structure (see `compute_mqns`), returning the reason 
+    for any failure instead of silently dropping it
+
+    Parameters
+    ----------
+    smi : ``str``
+        SMILES string of structure
+
+    Returns
+    -------
+    mqns : ``list(int)`` or ``None`` 
+        array of MQN features, None if anything goes wrong
+    reason : ``str`` or ``None``
+        reason for failure (_MQN_PARSE_ERROR or _MQN_ERROR), None if successful
+    """
+    try:
+        mol = Chem.MolFromSmiles(smi)
+    except TypeError:
+        # smi is not a str
+        mol = None
+    if mol is None:
+        return None, _MQN_PARSE_ERROR
+    try:
+        return Descriptors.rdMolDescriptors.MQNs_(mol), None
+    except (RuntimeError, ValueError):
+        return None, _MQN_ERROR
 
 
 def compute_mqns(smi: str
@@ -30,43 +86,493 @@ def compute_mqns(smi: str
     mqns : ``list(float)`` or ``None`` 
         array of MQN features, None if anything goes wrong
     """
+    return _compute_mqns(smi)[0]
+
+
+def _mqn_worker_init(progress: Optional[ctypes.Array] = None
+                     ) -> None :
+    """
+    initializer for MQN worker processes, silences RDKit logging (otherwise every SMILES 
+    parse error gets printed) and keeps a reference to the shared progress counters
+    """
+    global _progress
+    _progress = progress
+    RDLogger.DisableLog("rdApp.*")
+
+
+def _mqns_for_chunk(chunk: List[Tuple[str, str]],
+                    slot: Optional[int] = None
+                    ) -> List[Tuple[str, Optional[List[int]], Optional[str]]] :
+    """
+    Computes MQNs for a chunk of entries in an MQN worker process
+
+    Parameters
+    ----------
+    chunk : ``list(tuple(str, str))``
+        g_ids and SMILES structures
+    slot : ``int``, optional
+        slot in the shared progress counters to count finished entries in
+
+    Returns
+    -------
+    results : ``list(tuple(str, list(int) or None, str or None))``
+        g_ids, MQNs (or None if failed), reasons for failure (or None if successful)
+    """
+    results = []
+    for g_id, smi in chunk:
+        results.append((g_id, *_compute_mqns(smi)))
+        if slot is not None:
+            _progress[slot] += 1
+    return results
+
+
+class _MQNPool:
+    """
+    Pool of MQN worker processes that keeps going in spite of pathological structures. 
+    
+    The workers count every entry they finish in shared progress counters, and a chunk 
+    that has gone timeout seconds without finishing another entry is assumed to be stuck 
+    on a pathological structure: the pool is torn down and restarted (the other in-flight 
+    chunks are resubmitted) and the stalled chunk is split up into individual entries, an 
+    individual entry that stalls is reported as a timeout.
+    """
+
+    def __init__(self, 
+                 n_workers: int
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        n_workers : ``int``
+            number of worker processes
+        """
+        self.n_workers_ = n_workers
+        self.progress_ = Array("q", n_workers, lock=False)
+        self.pool_ = Pool(n_workers, initializer=_mqn_worker_init, initargs=(self.progress_,))
+
+    def imap(self,
+             chunks: Iterable[List[Tuple[str, str]]],
+             timeout: float
+             ) -> Iterator[List[Tuple[str, Optional[List[int]], Optional[str]]]] :
+        """
+        Computes MQNs for chunks of entries, yielding the results for each chunk as they 
+        come back (not necessarily in order)
+
+        Parameters
+        ----------
+        chunks : ``iterable(list(tuple(str, str)))``
+            chunks of g_ids and SMILES structures
+        timeout : ``float``
+            wall-clock time limit (in seconds) per entry
+
+        Yields
+        ------
+        results : ``list(tuple(str, list(int) or None, str or None))``
+            g_ids, MQNs (or None if failed), reasons for failure (or None if successful)
+        """
+        queue = deque(chunks)
+        # only keep as many chunks in flight as there are workers so that every submitted 
+        # chunk starts right away, each one gets its own progress counter slot
+        # [chunk, result, slot, entries finished, deadline for finishing the next one]
+        in_flight = []
+        free = list(range(self.n_workers_))
+        while queue or in_flight:
+            while queue and free:
+                chunk, slot = queue.popleft(), free.pop()
+                in_flight.append([chunk, self.pool_.apply_async(_mqns_for_chunk, (chunk, slot)), 
+                                  slot, self.progress_[slot], time.monotonic() + timeout])
+            done = [flight for flight in in_flight if flight[1].ready()]
+            for flight in done:
+                in_flight.remove(flight)
+                free.append(flight[2])
+                yield flight[1].get()
+            if done:
+                continue
+            # push back the deadlines of chunks that have made progress
+            now = time.monotonic()
+            for flight in in_flight:
+                if (n_done := self.progress_[flight[2]]) != flight[3]:
+                    flight[3], flight[4] = n_done, now + timeout
+            stalled = [flight for flight in in_flight if flight[4] <= now and not flight[1].ready()]
+            if not stalled:
+                in_flight[0][1].wait(min(_MQN_POLL_INTERVAL, min(flight[4] for flight in in_flight) - now))
+                continue
+            # a chunk stalled, restart the pool and resubmit everything else
+            chunk = stalled[0][0]
+            self.close()
+            for flight in reversed(in_flight):
+                if flight[0] is not chunk:
+                    queue.appendleft(flight[0])
+            in_flight.clear()
+            free = list(range(self.n_workers_))
+            if len(chunk) > 1:
+                # split the chunk up to isolate the problematic entry
+                for item in reversed(chunk):
+                    queue.appendleft([item])
+            else:
+                yield [(chunk[0][0], None, _MQN_TIMEOUT)]
+            self.pool_ = Pool(self.n_workers_, initializer=_mqn_worker_init, initargs=(self.progress_,))
+
+    def close(self
+              ) -> None :
+        """ shut down the worker processes """
+        if self.pool_ is not None:
+            self.pool_.terminate()
+            self.pool_.join()
+            self.pool_ = None
+
+
+def _iter_mqns_parallel(items: List[Tuple[str, str]],
+                        n_workers: int,
+                        chunk_size: int,
+                        timeout: float
+                        ) -> Iterator[List[Tuple[str, Optional[List[int]], Optional[str]]]] :
+    """
+    Computes MQNs for entries in chunks using a pool of worker processes (see `_MQNPool`), 
+    yielding the results for each chunk as they come back. 
+
+    Parameters
+    ----------
+    items : ``list(tuple(str, str))``
+        g_ids and SMILES structures
+    n_workers : ``int``
+        number of worker processes
+    chunk_size : ``int``
+        number of entries per chunk
+    timeout : ``float``
+        wall-clock time limit (in seconds) per entry
+
+    Yields
+    ------
+    results : ``list(tuple(str, list(int) or None, str or None))``
+        g_ids, MQNs (or None if failed), reasons for failure (or None if successful)
+    """
+    pool = _MQNPool(n_workers)
     try:
-        features = Descriptors.rdMolDescriptors.MQNs_(Chem.MolFromSmiles(smi))
-        return features
-    except Exception as e:  
-        # TODO: really need to catch specific exceptions here, this blanket
-        #       catch is not good form
-        return None
+        yield from pool.imap((items[i:i + chunk_size] for i in range(0, len(items), chunk_size)), timeout)
+    finally:
+        pool.close()
 
 
-def add_mqns_to_db(cursor: sqlite3.Cursor
+def _iter_mqns_serial(items: List[Tuple[str, str]],
+                      chunk_size: int
+                      ) -> Iterator[List[Tuple[str, Optional[List[int]], Optional[str]]]] :
+    """
+    Computes MQNs for entries in chunks in this process, yielding the results for each 
+    chunk. RDKit logging (SMILES parse errors) is only silenced while computing each chunk.
+
+    Parameters
+    ----------
+    items : ``list(tuple(str, str))``
+        g_ids and SMILES structures
+    chunk_size : ``int``
+        number of entries per chunk
+
+    Yields
+    ------
+    results : ``list(tuple(str, list(int) or None, str or None))``
+        g_ids, MQNs (or None if failed), reasons for failure (or None if successful)
+    """
+    for i in range(0, len(items), chunk_size):
+        with BlockLogs():
+            results = _mqns_for_chunk(items[i:i + chunk_size])
+        yield results
+
+
+# schema for the MQN cache database
+_MQN_CACHE_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS cache_info (
+    key TEXT PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS mqn_cache (
+    -- SMILES structure
+    smi TEXT PRIMARY KEY NOT NULL,
+    -- MQNs packed as an array of (native byte order) 16-bit integers, NULL if failed
+    mqns BLOB,
+    -- reason for failure, NULL if successful
+    reason TEXT
+) WITHOUT ROWID;
+"""
+
+
+class MQNCache:
+    """
+    Persistent cache of MQNs keyed by SMILES structure, stored in a SQLite database 
+    (sidecar) file, so that each unique structure only gets parsed and featurized once 
+    across builds and inference runs. Failures (parse errors and MQN errors, but not 
+    timeouts) are cached as well. 
+    
+    The RDKit version that computed the cached MQNs is recorded in the cache and all 
+    cached entries are dropped when the cache is opened with a different RDKit version. 
+    
+    Cache hits and misses are counted in the ``hits_`` and ``misses_`` attributes.
+    """
+
+    def __init__(self, 
+                 db_path: str,
+                 timeout: float = 60.
+                 ) -> None :
+        """
+        Opens (or creates) an MQN cache database
+
+        Parameters
+        ----------
+        db_path : ``str``
+            path to the MQN cache database file
+        timeout : ``float``, default=60.
+            how long to wait (in seconds) for other processes to release a lock on the
+            database before raising an error
+        """
+        self.db_path_ = db_path
+        self.con_ = sqlite3.connect(db_path, timeout=timeout)
+        self.con_.execute("PRAGMA journal_mode=WAL")
+        self.con_.executescript(_MQN_CACHE_SCHEMA)
+        qry = "SELECT value FROM cache_info WHERE key='rdkit_version'"
+        if (res := self.con_.execute(qry).fetchone()) is None or res[0] != rdkit.__version__:
+            # cached values were computed with a different RDKit version
+            self.con_.execute("DELETE FROM mqn_cache")
+            self.con_.execute("INSERT OR REPLACE INTO cache_info VALUES ('rdkit_version', ?)", 
+                              (rdkit.__version__,))
+        self.con_.commit()
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def get_many(self, 
+                 smis: Iterable[str]
+                 ) -> Dict[str, Tuple[Optional[List[int]], Optional[str]]] :
+        """
+        Looks up cached MQNs for a set of SMILES structures
+
+        Parameters
+        ----------
+        smis : ``iterable(str)``
+            SMILES structures (should be unique)
+
+        Returns
+        -------
+        cached : ``dict(str:tuple(list(int) or None, str or None))``
+            mapping of SMILES structures that were in the cache to their MQNs (None if 
+            failed) and reasons for failure (None if successful) 
+        """
+        smis = list(smis)
+        cached = {}
+        # stay below the limit on the number of bound parameters 
+        for i in range(0, len(smis), 500):
+            chunk = smis[i:i + 500]
+            qry = f"SELECT smi, mqns, reason FROM mqn_cache WHERE smi IN ({','.join('?' * len(chunk))})"
+            for smi, mqns, reason in self.con_.execute(qry, chunk).fetchall():
+                cached[smi] = (None if mqns is None else array("h", mqns).tolist(), reason)
+        self.hits_ += len(cached)
+        self.misses_ += len(smis) - len(cached)
+        return cached
+
+    def put_many(self, 
+                 results: Iterable[Tuple[str, Optional[List[int]], Optional[str]]]
+                 ) -> None :
+        """
+        Adds MQNs (or failures) for SMILES structures to the cache, timeouts are not cached
+
+        Parameters
+        ----------
+        results : ``iterable(tuple(str, list(int) or None, str or None))``
+            SMILES structures, MQNs (or None if failed), reasons for failure (or None if 
+            successful)
+        """
+        rows = [(smi, None if mqns is None else array("h", mqns).tobytes(), reason) 
+                for smi, mqns, reason in results if reason != _MQN_TIMEOUT]
+        self.con_.executemany("INSERT OR REPLACE INTO mqn_cache VALUES (?,?,?)", rows)
+        self.con_.commit()
+
+    def stats(self
+              ) -> Dict[str, int | float] :
+        """
+        Returns cache hit/miss statistics
+
+        Returns
+        -------
+        stats : ``dict(str:int or float)``
+            number of hits, misses, and the hit rate
+        """
+        n = self.hits_ + self.misses_
+        return {"hits": self.hits_, "misses": self.misses_, "hit_rate": self.hits_ / n if n else 0.}
+
+    def close(self
+              ) -> None :
+        """ close the connection to the cache database """
+        self.con_.commit()
+        self.con_.close()
+
+    def __enter__(self
+                  ) -> "MQNCache" :
+        return self
+
+    def __exit__(self, *args
+                 ) -> None :
+        self.close()
+
+
+def compute_mqns_many(smis: Iterable[str],
+                      mqn_cache: Optional[MQNCache] = None
+                      ) -> Dict[str, Optional[List[int]]] :
+    """
+    Computes MQNs for a collection of SMILES structures, each unique structure is only 
+    parsed once and structures in the MQN cache (if provided) are not computed at all
+
+    Parameters
+    ----------
+    smis : ``iterable(str)``
+        SMILES structures (may contain duplicates)
+    mqn_cache : ``MQNCache``, optional
+        cache of MQNs keyed by SMILES structure, newly computed MQNs are added to it
+
+    Returns
+    -------
+    smi_to_mqns : ``dict(str:list(int) or None)``
+        mapping of unique SMILES structures to MQNs (None if they could not be computed)
+    """
+    unique = list(dict.fromkeys(smis))
+    cached = {} if mqn_cache is None else mqn_cache.get_many(unique)
+    computed = [(smi, *_compute_mqns(smi)) for smi in unique if smi not in cached]
+    if mqn_cache is not None:
+        mqn_cache.put_many(computed)
+    smi_to_mqns = {smi: mqn for smi, (mqn, _) in cached.items()}
+    smi_to_mqns.update({smi: mqn for smi, mqn, _ in computed})
+    return smi_to_mqns
+
+
+def sort_mqns(cursor: sqlite3.Cursor
+              ) -> bool :
+    """
+    Rewrites the mqns table so that its rows are in the same order as the corresponding 
+    entries in the master table (MQNs get added in whatever order they are computed in), 
+    older versions of `c3sdb.ml.data` rely on the two tables being in the same order when 
+    fetching data. The table is left alone if it already is in order.
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        C3S.db database cursor
+
+    Returns
+    -------
+    sorted : ``bool``
+        whether the table had to be rewritten
+    """
+    qry = "SELECT master.rowid FROM mqns LEFT JOIN master ON master.g_id=mqns.g_id ORDER BY mqns.rowid"
+    rowids = [rowid for rowid, in cursor.execute(qry).fetchall()]
+    if None not in rowids and all(a < b for a, b in zip(rowids, rowids[1:])):
+        return False
+    # (any MQNs without an entry in master go at the end)
+    cursor.execute("CREATE TEMP TABLE _mqns_sorted AS SELECT mqns.* FROM mqns "
+                   "LEFT JOIN master ON master.g_id=mqns.g_id "
+                   "ORDER BY master.rowid IS NULL, master.rowid, mqns.rowid")
+    cursor.execute("DELETE FROM mqns")
+    cursor.execute("INSERT INTO mqns SELECT * FROM _mqns_sorted ORDER BY rowid")
+    cursor.execute("DROP TABLE _mqns_sorted")
+    return True
+
+
+def add_mqns_to_db(cursor: sqlite3.Cursor,
+                   n_workers: Optional[int] = None,
+                   chunk_size: int = 256,
+                   timeout: float = 10.,
+                   mqn_cache: Optional[MQNCache] = None,
+                   lipid_library: Optional[LipidLibrary] = None,
+                   compositional: Optional[CompositionalMQNs] = None,
+                   on_chunk: Optional[Callable[[int], None]] = None,
+                   failures: Optional[Dict[str, int]] = None
                    ) -> int :
     """
     Computes the complete set of 42 MQNs as described in:
         Nguyen et al. ChemMedChem 4:1803-5 (2009)
-    And adds them to the database in the mqns table
+    And adds them to the database in the mqns table, entries that already have MQNs
+    in the mqns table are skipped
+
+    The entries are grouped by SMILES structure so that MQNs are only computed once for 
+    each unique structure, and structures in the MQN cache (if provided) are not computed
+    at all, nor are generated lipid structures that are in the lipid library (if provided, 
+    and only if its MQNs are usable with the installed RDKit version). Structures that 
+    came from the peptide or lipid SMILES generators are computed analytically from their
+    composition (if compositional is provided), the rest of the MQNs are 
+    computed in chunks by a pool of worker processes and the results are written to the 
+    database (by this process) as each chunk comes back, at the end the mqns table is put 
+    in the same order as the master table (see `sort_mqns`). Each structure 
+    has a wall-clock time limit so that a pathological SMILES can not stall the pool 
+    (see `_MQNPool`). 
+    With a single worker, everything is computed in this process instead (without the 
+    time limit).
 
     Parameters
     ----------
     cursor : ``sqlite3.Cursor``
         C3S.db database cursor
+    n_workers : ``int``, optional
+        number of worker processes, defaults to the number of CPUs
+    chunk_size : ``int``, default=256
+        number of structures for each worker to process at a time
+    timeout : ``float``, default=10.
+        wall-clock time limit (in seconds) for computing MQNs for a single structure
+    mqn_cache : ``MQNCache``, optional
+        cache of MQNs keyed by SMILES structure, newly computed MQNs are added to it
+    lipid_library : ``LipidLibrary``, optional
+        precomputed lipid library to take MQNs for generated lipid structures from
+    compositional : ``CompositionalMQNs``, optional
+        computes MQNs for generated peptide and lipid structures from their composition
+    on_chunk : ``callable(int)``, optional
+        called with the number of entries with MQNs added so far after each chunk of 
+        results has been written to the database (e.g. to commit and record progress)
+    failures : ``dict(str:int)``, optional
+        if provided, the number of entries that failed for each reason (parse error, MQN 
+        error, timeout) get added to it
 
     Returns
     -------
     n_mqns : ``int``
         number of entries with MQNs
     """
-    # generate the rdk features and MQNs
-    qry = "SELECT g_id, smi FROM master WHERE smi IS NOT NULL"
-    gid_to_mqn = {}
-    for g_id, n_smi in cursor.execute(qry).fetchall():
-        mqn = compute_mqns(n_smi)
-        if mqn:
-            gid_to_mqn[g_id] = mqn
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    # group entries by SMILES structure
+    smi_to_gids = {}
+    smi_to_name = {}
+    qry = "SELECT g_id, smi, name FROM master WHERE smi IS NOT NULL AND g_id NOT IN (SELECT g_id FROM mqns)"
+    for g_id, smi, name in cursor.execute(qry).fetchall():
+        smi_to_gids.setdefault(smi, []).append(g_id)
+        smi_to_name.setdefault(smi, name)
+    # check the cache first
+    cached = {} if mqn_cache is None else mqn_cache.get_many(smi_to_gids)
+    if lipid_library is not None:
+        missing = [smi for smi in smi_to_gids if smi not in cached]
+        cached.update({smi: (mqn, None) for smi, mqn in lipid_library.get_mqns_many(missing).items()})
+    if compositional is not None:
+        missing = {smi: smi_to_name[smi] for smi in smi_to_gids if smi not in cached}
+        cached.update({smi: (mqn, None) for smi, mqn in compositional.mqns_from_names(missing).items()})
+    items = [(smi, smi) for smi in smi_to_gids if smi not in cached]
+    if n_workers > 1 and len(items) > chunk_size:
+        results = _iter_mqns_parallel(items, n_workers, chunk_size, timeout)
+    else:
+        results = _iter_mqns_serial(items, chunk_size)
     # update the database with the generated MQNs
     qry = f"INSERT INTO mqns VALUES ({','.join('?' * 43)})" 
-    for g_id in gid_to_mqn:
-        qdata = (g_id, *gid_to_mqn[g_id])
-        cursor.execute(qry, qdata)
+    n_mqns = 0
+    failures = {} if failures is None else failures
+    cached = [(smi, mqn, reason) for smi, (mqn, reason) in cached.items()]
+    for i, chunk_results in enumerate(chain([cached], results)):
+        rows = []
+        for smi, mqn, reason in chunk_results:
+            if mqn is not None:
+                rows += [(g_id, *mqn) for g_id in smi_to_gids[smi]]
+            else:
+                failures[reason] = failures.get(reason, 0) + len(smi_to_gids[smi])
+        cursor.executemany(qry, rows)
+        n_mqns += len(rows)
+        # the first chunk is what came from the cache (or the lipid library or compositional MQNs)
+        if mqn_cache is not None and i > 0:
+            mqn_cache.put_many(chunk_results)
+        if on_chunk is not None:
+            on_chunk(n_mqns)
+    # keep the MQNs in the same order as the entries in master
+    sort_mqns(cursor)
     # return the number of entries that had MQNs added
-    return len(gid_to_mqn)
+    return n_mqns
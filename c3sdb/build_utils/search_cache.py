@@ -0,0 +1,328 @@
+"""
+    c3sdb/build_utils/search_cache.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    module with a SQLite-backed search cache mapping compound names to SMILES structures
+"""
+
+
+from typing import Optional, Iterator, Dict
+from collections.abc import MutableMapping
+import sqlite3
+import json
+import time
+
+
+# schema for the search cache database
+_CACHE_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS smiles_cache (
+    -- compound name
+    name TEXT PRIMARY KEY NOT NULL,
+    -- SMILES structure
+    smi TEXT NOT NULL,
+    -- where the SMILES structure came from (e.g. pubchem, lipidmaps, json)
+    source TEXT,
+    -- time (seconds since epoch) the entry was added
+    t_stamp REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS negative_cache (
+    -- compound name
+    name TEXT PRIMARY KEY NOT NULL,
+    -- time (seconds since epoch) after which the name should be searched for again
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class _NegativeCache(MutableMapping):
+    """
+    Negative search cache (stored in the same database as a SmilesSearchCache) mapping
+    compound names that could not be resolved to the time (seconds since epoch) when the
+    entry expires, expired entries are treated as missing. Shares the connection and 
+    batched commits of the parent SmilesSearchCache.
+    """
+
+    def __init__(self,
+                 parent: "SmilesSearchCache"
+                 ) -> None :
+        self.parent_ = parent
+
+    def __getitem__(self,
+                    name: str
+                    ) -> float :
+        qry = "SELECT expires FROM negative_cache WHERE name=? AND expires>?"
+        if (res := self.parent_.con_.execute(qry, (name, time.time())).fetchone()) is None:
+            raise KeyError(name)
+        return res[0]
+
+    def __contains__(self,
+                     name: object
+                     ) -> bool :
+        qry = "SELECT 1 FROM negative_cache WHERE name=? AND expires>?"
+        return self.parent_.con_.execute(qry, (name, time.time())).fetchone() is not None
+
+    def __setitem__(self,
+                    name: str,
+                    expires: float
+                    ) -> None :
+        self.parent_.con_.execute("INSERT OR REPLACE INTO negative_cache VALUES (?,?)", (name, expires))
+        self.parent_._wrote()
+
+    def __delitem__(self,
+                    name: str
+                    ) -> None :
+        if self.parent_.con_.execute("DELETE FROM negative_cache WHERE name=?", (name,)).rowcount == 0:
+            raise KeyError(name)
+        self.parent_._wrote()
+
+    def __iter__(self
+                 ) -> Iterator[str] :
+        qry = "SELECT name FROM negative_cache WHERE expires>?"
+        for name, in self.parent_.con_.execute(qry, (time.time(),)).fetchall():
+            yield name
+
+    def __len__(self
+                ) -> int :
+        qry = "SELECT COUNT(*) FROM negative_cache WHERE expires>?"
+        return self.parent_.con_.execute(qry, (time.time(),)).fetchone()[0]
+
+
+class SmilesSearchCache(MutableMapping):
+    """
+    Search cache mapping compound names to SMILES structures, stored in an indexed SQLite
+    database file. Supports the same (dict-like) interface as the cache loaded from the
+    .json file by `c3sdb.build_utils.smiles.load_smiles_search_cache` so the two can be
+    used interchangeably, but lookups go straight to the database instead of loading the
+    whole map into memory, and new entries are written incrementally (committed in
+    batches) instead of rewriting the whole file at the end of the build.
+
+    The database is opened in WAL mode with a busy timeout, so several processes (e.g.
+    concurrent builds) can share the same cache file.
+
+    Names that could not be resolved are kept in a separate negative cache (with an
+    expiration time for each entry) which is accessible through the ``negative`` 
+    attribute, a dict-like mapping of names to expiration times.
+
+    Lookups (``name in cache``) are counted as hits or misses in the ``hits_`` and 
+    ``misses_`` attributes.
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 ttl: Optional[float] = None,
+                 commit_every: int = 100,
+                 timeout: float = 60.
+                 ) -> None :
+        """
+        Opens (or creates) a search cache database
+
+        Parameters
+        ----------
+        db_path : ``str``
+            path to the search cache database file
+        ttl : ``float``, optional
+            if set, entries older than this (in seconds) are treated as missing
+        commit_every : ``int``, default=100
+            number of writes to accumulate before committing
+        timeout : ``float``, default=60.
+            how long to wait (in seconds) for other processes to release a lock on the
+            database before raising an error
+        """
+        self.db_path_ = db_path
+        self.ttl_ = ttl
+        self.commit_every_ = commit_every
+        self.con_ = sqlite3.connect(db_path, timeout=timeout)
+        self.con_.execute("PRAGMA journal_mode=WAL")
+        self.con_.executescript(_CACHE_SCHEMA)
+        self.con_.commit()
+        self.n_pending_ = 0
+        self.negative = _NegativeCache(self)
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def _t_min(self
+               ) -> float :
+        """ earliest t_stamp of entries that are not expired """
+        return 0. if self.ttl_ is None else time.time() - self.ttl_
+
+    def __getitem__(self,
+                    name: str
+                    ) -> str :
+        qry = "SELECT smi FROM smiles_cache WHERE name=? AND t_stamp>=?"
+        if (res := self.con_.execute(qry, (name, self._t_min())).fetchone()) is None:
+            raise KeyError(name)
+        return res[0]
+
+    def __contains__(self,
+                     name: object
+                     ) -> bool :
+        qry = "SELECT 1 FROM smiles_cache WHERE name=? AND t_stamp>=?"
+        found = self.con_.execute(qry, (name, self._t_min())).fetchone() is not None
+        self.hits_ += found
+        self.misses_ += not found
+        return found
+
+    def set(self,
+            name: str,
+            smi: str,
+            source: Optional[str] = None,
+            t_stamp: Optional[float] = None
+            ) -> None :
+        """
+        Add an entry to the cache (replacing any existing entry with the same name)
+
+        Parameters
+        ----------
+        name : ``str``
+            compound name
+        smi : ``str``
+            SMILES structure
+        source : ``str``, optional
+            where the SMILES structure came from
+        t_stamp : ``float``, optional
+            time (seconds since epoch) the entry was added, current time if not provided
+        """
+        qry = "INSERT OR REPLACE INTO smiles_cache VALUES (?,?,?,?)"
+        self.con_.execute(qry, (name, smi, source, time.time() if t_stamp is None else t_stamp))
+        self._wrote()
+
+    def __setitem__(self,
+                    name: str,
+                    smi: str
+                    ) -> None :
+        self.set(name, smi)
+
+    def __delitem__(self,
+                    name: str
+                    ) -> None :
+        if self.con_.execute("DELETE FROM smiles_cache WHERE name=?", (name,)).rowcount == 0:
+            raise KeyError(name)
+        self._wrote()
+
+    def __iter__(self
+                 ) -> Iterator[str] :
+        qry = "SELECT name FROM smiles_cache WHERE t_stamp>=?"
+        for name, in self.con_.execute(qry, (self._t_min(),)).fetchall():
+            yield name
+
+    def __len__(self
+                ) -> int :
+        qry = "SELECT COUNT(*) FROM smiles_cache WHERE t_stamp>=?"
+        return self.con_.execute(qry, (self._t_min(),)).fetchone()[0]
+
+    def get_source(self,
+                   name: str
+                   ) -> Optional[str] :
+        """
+        Returns the source recorded for an entry in the cache (None if the entry is not
+        present or has no source recorded)
+        """
+        qry = "SELECT source FROM smiles_cache WHERE name=? AND t_stamp>=?"
+        res = self.con_.execute(qry, (name, self._t_min())).fetchone()
+        return None if res is None else res[0]
+
+    def stats(self
+              ) -> Dict[str, int | float] :
+        """
+        Returns cache hit/miss statistics
+
+        Returns
+        -------
+        stats : ``dict(str:int or float)``
+            number of hits, misses, and the hit rate
+        """
+        n = self.hits_ + self.misses_
+        return {"hits": self.hits_, "misses": self.misses_, "hit_rate": self.hits_ / n if n else 0.}
+
+    def _wrote(self
+               ) -> None :
+        """ track writes and commit once enough have accumulated """
+        self.n_pending_ += 1
+        if self.n_pending_ >= self.commit_every_:
+            self.commit()
+
+    def commit(self
+               ) -> None :
+        """ commit any pending writes to the cache database """
+        self.con_.commit()
+        self.n_pending_ = 0
+
+    def purge_expired(self
+                      ) -> int :
+        """
+        Removes expired entries (if a TTL was set) and expired negative cache entries 
+        from the cache database
+
+        Returns
+        -------
+        n_purged : ``int``
+            number of entries removed
+        """
+        n = self.con_.execute("DELETE FROM smiles_cache WHERE t_stamp<?", (self._t_min(),)).rowcount
+        n += self.con_.execute("DELETE FROM negative_cache WHERE expires<=?", (time.time(),)).rowcount
+        self.commit()
+        return n
+
+    def import_json(self,
+                    json_file: str,
+                    source: str = "json",
+                    overwrite: bool = False
+                    ) -> int :
+        """
+        Imports entries from a search cache file in the .json format (see
+        `c3sdb.build_utils.smiles.save_smiles_search_cache`)
+
+        Parameters
+        ----------
+        json_file : ``str``
+            path to the .json search cache file
+        source : ``str``, default="json"
+            source to record for the imported entries
+        overwrite : ``bool``, default=False
+            replace existing entries with the same names, otherwise keep the existing ones
+
+        Returns
+        -------
+        n_imported : ``int``
+            number of entries imported
+        """
+        with open(json_file, "r") as jf:
+            jdata = json.load(jf)
+        qry = f"INSERT OR {'REPLACE' if overwrite else 'IGNORE'} INTO smiles_cache VALUES (?,?,?,?)"
+        t_stamp = time.time()
+        n = self.con_.executemany(qry, [(name, smi, source, t_stamp) for name, smi in jdata.items()]).rowcount
+        self.commit()
+        return n
+
+    def export_json(self,
+                    json_file: str
+                    ) -> None :
+        """
+        Exports the (unexpired) entries to a search cache file in the .json format (see
+        `c3sdb.build_utils.smiles.save_smiles_search_cache`), overwrites any existing file
+
+        Parameters
+        ----------
+        json_file : ``str``
+            path to save the .json search cache file to
+        """
+        self.commit()
+        qry = "SELECT name, smi FROM smiles_cache WHERE t_stamp>=? ORDER BY t_stamp, name"
+        with open(json_file, "w") as jf:
+            json.dump(dict(self.con_.execute(qry, (self._t_min(),)).fetchall()), jf, indent=4)
+
+    def close(self
+              ) -> None :
+        """ commit any pending writes and close the connection to the cache database """
+        self.commit()
+        self.con_.close()
+
+    def __enter__(self
+                  ) -> "SmilesSearchCache" :
+        return self
+
+    def __exit__(self, *args
+                 ) -> None :
+        self.close()
@@ -0,0 +1,224 @@
+"""
+    c3sdb/build_utils/sharded.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module for sharded (parallel) builds of the database: each source dataset is run
+    through the full build pipeline (add dataset, SMILES, MQNs, labels, name annotations) by its own worker
+    process into its own shard database, then the shards are merged into C3S.db using
+    ATTACH and INSERT ... SELECT
+
+    The SMILES search cache and the MQN cache are shared by all of the workers, they are
+    SQLite databases in WAL mode with busy timeouts so concurrent access is safe, and the
+    workers commit every write to the SMILES search cache right away so they never hold
+    its write lock while waiting on web requests. The per-host request rate limits are
+    split evenly between the workers.
+"""
+
+
+from typing import List, Tuple, Dict, Any, Optional, Iterator
+from multiprocessing import Pool
+import contextlib
+import sqlite3
+import io
+import os
+
+from c3sdb.build_utils.db_init import create_db
+from c3sdb.build_utils.src_data import add_dataset
+from c3sdb.build_utils.smiles import add_smiles_to_db
+from c3sdb.build_utils.search_cache import SmilesSearchCache
+from c3sdb.build_utils.mqns import MQNCache, add_mqns_to_db
+from c3sdb.build_utils.lipid_library import LipidLibrary
+from c3sdb.build_utils.compositional_mqns import CompositionalMQNs
+from c3sdb.build_utils.classification import label_class_byname, add_name_annotations
+from c3sdb.build_utils.incremental import record_dataset
+from c3sdb.build_utils._transport import replay_session
+from c3sdb.build_utils._bulk import open_build_db
+from c3sdb.build_utils._remote import set_rate_share, remote_session
+from c3sdb.build_utils._telemetry import reset_request_stats, get_request_stats
+
+
+def _shard_worker_init(n_workers: int
+                       ) -> None :
+    """ initializer for shard worker processes, splits the request rate limits """
+    set_rate_share(n_workers)
+
+
+def build_shard(src_tag: str,
+                shard_path: str,
+                smiles_cache_file: str,
+                mqn_cache_file: str,
+                offline: bool = False,
+                replay: Optional[str] = None,
+                replay_latency: float = 0.,
+                use_lipid_library: bool = True
+                ) -> Dict[str, Any] :
+    """
+    Runs a single source dataset through the full build pipeline into a shard database,
+    the output from the individual build stages is suppressed
+
+    Parameters
+    ----------
+    src_tag : ``str``
+        identifier for source dataset
+    shard_path : ``str``
+        path to the shard database (overwritten if it exists)
+    smiles_cache_file : ``str``
+        path to the (shared) SMILES search cache database
+    mqn_cache_file : ``str``
+        path to the (shared) MQN cache database
+    offline : ``bool``, default=False
+        do not send any web requests
+    replay : ``str``, optional
+        serve web responses from this archive file instead of the network
+    replay_latency : ``float``, default=0.
+        simulated latency (in seconds) for replayed web responses
+    use_lipid_library : ``bool``, default=True
+        resolve and featurize lipids using the built in lipid library
+
+    Returns
+    -------
+    stats : ``dict(str:...)``
+        number of entries added (n_added), SMILES structures added (n_smiles), web
+        requests sent (n_requests), entries with MQNs added (n_mqns) and the raw 
+        per-endpoint request stats (requests, see `_telemetry.get_request_stats`)
+    """
+    # worker processes are reused, only report the requests for this shard
+    reset_request_stats()
+    create_db(shard_path)
+    con = open_build_db(shard_path)
+    cur = con.cursor()
+    stats = {}
+    lipid_library = LipidLibrary() if use_lipid_library else None
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats["n_added"] = add_dataset(cur, src_tag)
+        record_dataset(cur, src_tag, stats["n_added"])
+        con.commit()
+        if offline:
+            session = None
+        elif replay:
+            session = replay_session(replay, latency=replay_latency)
+        else:
+            session = remote_session()
+        with SmilesSearchCache(smiles_cache_file, commit_every=1) as smiles_search_cache:
+            stats["n_smiles"], stats["n_requests"] = add_smiles_to_db(cur, session, smiles_search_cache,
+                                                                      negative_cache=smiles_search_cache.negative,
+                                                                      offline=offline, 
+                                                                      lipid_library=lipid_library)
+        con.commit()
+        # worker processes can not have their own process pools, compute MQNs serially
+        with MQNCache(mqn_cache_file) as mqn_cache:
+            stats["n_mqns"] = add_mqns_to_db(cur, n_workers=1, mqn_cache=mqn_cache, 
+                                             lipid_library=lipid_library, 
+                                             compositional=CompositionalMQNs())
+        label_class_byname(cur)
+        add_name_annotations(cur)
+    con.commit()
+    con.close()
+    if lipid_library is not None:
+        lipid_library.close()
+    stats["requests"] = get_request_stats()
+    return stats
+
+
+def _build_shard_task(task: Tuple[str, str, Dict[str, Any]]
+                      ) -> Tuple[str, str, Dict[str, Any]] :
+    """ unpacks a task for `build_shard` in a worker process """
+    src_tag, shard_path, kwargs = task
+    return src_tag, shard_path, build_shard(src_tag, shard_path, **kwargs)
+
+
+def merge_shard(cursor: sqlite3.Cursor,
+                shard_path: str
+                ) -> int :
+    """
+    Merges a shard database into C3S.db, entries with g_ids that are already in C3S.db
+    are skipped (along with their MQNs and name annotations), the build manifest entries are replaced
+
+    .. note::
+
+        commits any pending changes, since databases can not be detached in the middle
+        of a transaction
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    shard_path : ``str``
+        path to the shard database
+
+    Returns
+    -------
+    n_merged : ``int``
+        number of entries merged into C3S.db
+    """
+    cursor.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+    n_merged = cursor.execute("INSERT OR IGNORE INTO master SELECT * FROM shard.master ORDER BY rowid").rowcount
+    cursor.execute("INSERT OR IGNORE INTO mqns SELECT * FROM shard.mqns ORDER BY rowid")
+    cursor.execute("INSERT OR IGNORE INTO name_annotations SELECT * FROM shard.name_annotations")
+    cursor.execute("INSERT OR REPLACE INTO build_manifest SELECT * FROM shard.build_manifest")
+    cursor.connection.commit()
+    cursor.execute("DETACH DATABASE shard")
+    return n_merged
+
+
+def build_shards(cursor: sqlite3.Cursor,
+                 src_tags: List[str],
+                 shard_dir: str,
+                 n_workers: int,
+                 smiles_cache_file: str,
+                 mqn_cache_file: str,
+                 offline: bool = False,
+                 replay: Optional[str] = None,
+                 replay_latency: float = 0.,
+                 use_lipid_library: bool = True
+                 ) -> Iterator[Tuple[str, Dict[str, Any]]] :
+    """
+    Builds shards for source datasets using a pool of worker processes and merges each
+    of them into C3S.db (in the order of src_tags) as soon as it is done, the shard
+    database files are removed after they are merged.
+
+    The cache files should already exist (i.e. have been created and seeded) before
+    the workers are started.
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db
+    src_tags : ``list(str)``
+        source datasets to build
+    shard_dir : ``str``
+        directory to put the shard databases in
+    n_workers : ``int``
+        number of worker processes
+    smiles_cache_file : ``str``
+        path to the (shared) SMILES search cache database
+    mqn_cache_file : ``str``
+        path to the (shared) MQN cache database
+    offline : ``bool``, default=False
+        do not send any web requests
+    replay : ``str``, optional
+        serve web responses from this archive file instead of the network
+    replay_latency : ``float``, default=0.
+        simulated latency (in seconds) for replayed web responses
+    use_lipid_library : ``bool``, default=True
+        resolve and featurize lipids using the built in lipid library
+
+    Yields
+    ------
+    src_tag : ``str``
+        source dataset that was merged
+    stats : ``dict(str:...)``
+        stats from `build_shard`, plus the number of entries merged (n_merged)
+    """
+    kwargs = {
+        "smiles_cache_file": smiles_cache_file, "mqn_cache_file": mqn_cache_file,
+        "offline": offline, "replay": replay, "replay_latency": replay_latency,
+        "use_lipid_library": use_lipid_library,
+    }
+    tasks = [(src_tag, os.path.join(shard_dir, f"{src_tag}.db"), kwargs) for src_tag in src_tags]
+    with Pool(processes=n_workers, initializer=_shard_worker_init, initargs=(n_workers,)) as pool:
+        for src_tag, shard_path, stats in pool.imap(_build_shard_task, tasks):
+            stats["n_merged"] = merge_shard(cursor, shard_path)
+            os.remove(shard_path)
+            yield src_tag, stats
@@ -7,17 +7,24 @@
 """
 
 
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, Tuple, List, Iterable
+from collections.abc import MutableMapping
 import json
 import sqlite3
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 import requests
 
-from c3sdb.build_utils._parsing import parse_lipid, parse_peptide
+from c3sdb.build_utils._parsing import annotate_names
+from c3sdb.build_utils._bulk import bulk_update, executemany_chunked
+from c3sdb.build_utils._telemetry import Progress
+from c3sdb.build_utils.search_cache import SmilesSearchCache
+from c3sdb.build_utils.lipid_library import LipidLibrary
 from c3sdb.build_utils._remote import (
-    pubchem_cid_fetch_smiles, pubchem_search_by_name, lmaps_fetch_smiles
+    pubchem_cids_fetch_smiles, pubchem_search_by_name, lmaps_fetch_smiles
 )
 
 
@@ -445,13 +452,58 @@ def load_smiles_search_cache(cache_file_name: Optional[str] = None
         return {}
 
 
+# number of CIDs to fetch SMILES structures for in a single PubChem request
+_CID_CHUNK_SIZE: int = 100
+
+
+def _smis_from_cids(session: requests.Session, 
+                    cids: List[int], 
+                    executor: Optional[ThreadPoolExecutor] = None,
+                    chunk_size: int = _CID_CHUNK_SIZE
+                    ) -> Tuple[Dict[int, str], int] :
+    """
+    a wrapper around pubchem_cids_fetch_smiles that splits the CIDs into chunks and 
+    fetches the SMILES structures (isomeric if available, otherwise canonical) for each 
+    whole chunk with a single request
+
+    Parameters
+    ----------
+    session : ``requests.Session``
+        requests session for doing web requests
+    cids : ``list(int)``
+        PubChem CIDs, duplicates are only fetched once
+    executor : ``ThreadPoolExecutor``, optional
+        if provided, fetch the chunks concurrently using this executor
+    chunk_size : ``int``, default=_CID_CHUNK_SIZE
+        number of CIDs per request
+
+    Returns
+    -------
+    cid_to_smi : ``dict(int:str)``
+        mapping of CIDs to SMILES structures, CIDs without SMILES structures or in 
+        chunks that failed are not included
+    n_requests : ``int``
+        number of web requests that were sent
+    """
+    cids = list(dict.fromkeys(cids))
+    chunks = [cids[i:i + chunk_size] for i in range(0, len(cids), chunk_size)]
+    if executor is not None:
+        results = executor.map(lambda chunk: pubchem_cids_fetch_smiles(session, chunk), chunks)
+    else:
+        results = (pubchem_cids_fetch_smiles(session, chunk) for chunk in chunks)
+    cid_to_smi, n_requests = {}, 0
+    for chunk_cid_to_smi, n_req in results:
+        cid_to_smi.update(chunk_cid_to_smi or {})
+        n_requests += n_req
+    return cid_to_smi, n_requests
+
+
 def _smi_from_cid(session: requests.Session, 
                   cid: int
                   ) -> Tuple[Optional[str], int]:
     """
-    a wrapper around pubchem_cid_fetch_smiles that tries to get the isomeric SMILES
-    first, and failing that it tries to get the canonical SMILES. Returns None if both of
-    those fail. 
+    fetches the SMILES structure for a single CID, the isomeric SMILES is used if 
+    available, otherwise the canonical SMILES. Returns None if both of those fail. 
 
     Parameters
     ----------
@@ -464,43 +516,205 @@ def _smi_from_cid(session: requests.Session,
     -------
     smi : ``str`` or ``None``
         SMILES string or None if unsuccessful
+    n_requests : ``int``
+        number of web requests that were sent
+    """
+    cid_to_smi, n_requests = _smis_from_cids(session, [cid])
+    return cid_to_smi.get(cid), n_requests
+
+
+def _lipid_smiles_remote(session: requests.Session, 
+                         p_lipid: Dict[str, str | int], 
+                         gen_lipid_smi: bool,
+                         search: bool = True
+                         ) -> Tuple[Optional[str], Optional[str], bool, int] :
+    """
+    Resolves a lipid into a SMILES structure using LIPID MAPS, falling back on the 
+    lipid SMILES generator (also if searching LIPID MAPS fails, e.g. while it is 
+    unavailable). This runs in the worker threads of `add_smiles_to_db`, it does not 
+    touch the database or the search cache.
+
+    Parameters
+    ----------
+    session : ``requests.Session``
+        requests session for doing web requests
+    p_lipid : ``dict(...)``
+        parsed lipid information (from `parse_lipid`)
+    gen_lipid_smi : ``bool``
+        use the lipid SMILES generator if searching LIPID MAPS fails
+    search : ``bool``, default=True
+        search LIPID MAPS, if False go straight to the lipid SMILES generator (e.g. 
+        the lipid is in the negative cache)
+
+    Returns
+    -------
+    smi : ``str`` or ``None``
+        SMILES structure or None if unsuccessful
+    source : ``str`` or ``None``
+        where the SMILES structure came from ("lipidmaps" or "generator") or None 
+        if unsuccessful
+    not_found : ``bool``
+        whether LIPID MAPS was searched and did not have the lipid (as opposed to the
+        search failing or not being done)
+    n_requests : ``int``
+        number of web requests that were sent
     """
     n_requests = 0
-    smiles, n_req = pubchem_cid_fetch_smiles(session, cid, canonical=False)
-    n_requests += n_req
-    if not smiles:
-        smiles, n_req = pubchem_cid_fetch_smiles(session, cid)
+    not_found = False
+    if search:
+        #  search lipid maps
+        try:
+            smi, n_requests = lmaps_fetch_smiles(session, p_lipid)
+        except requests.RequestException as e:
+            smi, n_requests = None, e.n_requests
+        else:
+            not_found = smi is None
+        if smi:
+            return smi, "lipidmaps", False, n_requests
+    if gen_lipid_smi:
+        # try to generate a lipid SMILES structure
+        lc, nc, nu = p_lipid["lipid_class"], p_lipid["n_carbon"], p_lipid["n_unsat"]
+        if smi := _generate_lipid_smiles(lc, nc, nu, fa_mod=p_lipid.get("fa_mod")):
+            return smi, "generator", not_found, n_requests
+    return None, None, not_found, n_requests
+
+
+def _pubchem_cid_remote(session: requests.Session, 
+                        name: str
+                        ) -> Tuple[Optional[int], bool, int] :
+    """
+    Searches PubChem by compound name to find a CID, with one retry for failed queries 
+    (but not for names that PubChem reports as not found). This runs in the worker 
+    threads of `add_smiles_to_db`.
+
+    Parameters
+    ----------
+    session : ``requests.Session``
+        requests session for doing web requests
+    name : ``str``
+        compound name
+
+    Returns
+    -------
+    cid : ``int`` or ``None``
+        first PubChem CID matching the name, or None if unsuccessful
+    not_found : ``bool``
+        whether PubChem reported that no compounds match the name (as opposed to the
+        search failing for some other reason)
+    n_requests : ``int``
+        number of web requests that were sent
+    """
+    cids, n_requests = pubchem_search_by_name(session, name)
+    # do one retry for failed queries
+    if cids is None:
+        cids, n_req = pubchem_search_by_name(session, name)
         n_requests += n_req
-    return smiles, n_requests
+    # if multiple CIDs were found just use the first
+    return (cids[0] if cids else None), cids == [], n_requests
+
+
+def _add_to_cache(smiles_search_cache: Dict[str, str] | SmilesSearchCache, 
+                  name: str, 
+                  smi: str, 
+                  source: str
+                  ) -> None :
+    """
+    adds an entry to a search cache, recording where the SMILES structure came from 
+    if the cache supports it (SmilesSearchCache) 
+    """
+    if isinstance(smiles_search_cache, SmilesSearchCache):
+        smiles_search_cache.set(name, smi, source=source)
+    else:
+        smiles_search_cache[name] = smi
+
+
+def _in_negative_cache(negative_cache: Optional[MutableMapping[str, float]], 
+                       name: str, 
+                       t_now: float
+                       ) -> bool :
+    """ checks whether a name is in the negative cache (if there is one) and has not expired """
+    return negative_cache is not None and negative_cache.get(name, 0.) > t_now
+
+
+# default time (in seconds) that a failed lookup stays in the negative cache (30 days)
+_NEGATIVE_TTL: float = 30. * 24. * 60. * 60.
 
 
 def add_smiles_to_db(cursor: sqlite3.Cursor, 
                      session: requests.Session, 
-                     smiles_search_cache: Dict[str, str], 
-                     gen_lipid_smi: bool = True
+                     smiles_search_cache: Dict[str, str] | SmilesSearchCache, 
+                     gen_lipid_smi: bool = True,
+                     n_workers: int = 4,
+                     negative_cache: Optional[MutableMapping[str, float]] = None,
+                     negative_ttl: float = _NEGATIVE_TTL,
+                     offline: bool = False,
+                     lipid_library: Optional[LipidLibrary] = None,
+                     names: Optional[Iterable[str]] = None
                      ) -> Tuple[int, int] :
     """
     Fetches SMILES structures for the entries from the C3S.db using compound names
 
     workflow:
     - check the search cache and see if there is an entry for the compound name
+    - if the name can be parsed as a peptide, generate the SMILES structure from the sequence
     - if the name can be parsed as a lipid 
-        - try to scrape LIPID MAPS for the SMILES structure 
+        - look it up in the precomputed lipid library (if provided)
+        - or else try to scrape LIPID MAPS for the SMILES structure 
         - or else just use the lipid SMILES generator 
     - try to search PubChem by compound name to get a CID then use that to retrieve a SMILES 
 
+    The entries are grouped by distinct compound name, each name is resolved once and 
+    the result is applied to all of the entries with that name. The remote lookups 
+    (LIPID MAPS and PubChem) are run concurrently in a pool of worker threads, each 
+    remote host has its own shared rate limit (see `c3sdb.build_utils._remote`) so the 
+    number of workers only controls how many requests can be in flight at once. The 
+    results are collected in the order the names were selected from the database. The 
+    SMILES structures for the CIDs found by searching PubChem are fetched in batches 
+    (_CID_CHUNK_SIZE CIDs per request, see `pubchem_cids_fetch_smiles`) that are sent as 
+    soon as enough CIDs have come in, and every result is added to the search cache as 
+    soon as it resolves, so that the lookups that were already done are not lost if the 
+    build gets interrupted.
+
+    If a negative cache is provided, names that PubChem or LIPID MAPS could not find 
+    are added to it and are not searched for again until the entry expires (lipids in
+    the negative cache go straight to the lipid SMILES generator). Lookups that failed 
+    for other reasons (e.g. errors in the responses) are not added to the negative cache.
+    Requests to a remote service that keeps failing are skipped for a while (see 
+    `c3sdb.build_utils._remote`), lipids then fall back on the lipid SMILES generator
+    and other names are left unresolved.
+
+    In offline mode no web requests are sent at all, names are only resolved using the
+    search cache and the peptide/lipid SMILES generators, everything else is left 
+    unresolved.
+
     Parameters
     ----------
     cursor : ``sqlite3.cursor``
         cursor for running queries against the drugs.db database
     session : ``requests.Session`` 
         requests session for doing web requests
-    search_cache:  ``dict(str:str)``
+    search_cache:  ``dict(str:str)`` or ``SmilesSearchCache``
         search cache mapping compound names to SMILES structures
     gen_lipid_smi : ``bool``, default=True
         if a lipid name is able to be parsed but searching LIPID MAPS does not yield a
         SMILES structure, then use the lipid SMILES generator to generate a generic
         SMILES structure matching the lipid class and fatty acid composition 
+    n_workers : ``int``, default=4
+        number of worker threads to use for remote lookups
+    negative_cache : ``dict(str:float)``, optional
+        negative search cache mapping names that could not be found to the time (seconds 
+        since epoch) when the entry expires, e.g. ``SmilesSearchCache.negative``
+    negative_ttl : ``float``, default=_NEGATIVE_TTL
+        time (in seconds) that new entries stay in the negative cache
+    offline : ``bool``, default=False
+        do not send any web requests (session may be None)
+    lipid_library : ``LipidLibrary``, optional
+        precomputed lipid library, lipids that are in the library get their (generated)
+        SMILES structures from it without searching LIPID MAPS, only used if gen_lipid_smi
+        is set
+    names : ``iterable(str)``, optional
+        only resolve the entries with these compound names (e.g. one chunk of the names 
+        at a time), defaults to all of the entries without SMILES structures
     
     Returns
     -------
@@ -511,59 +725,146 @@ def add_smiles_to_db(cursor: sqlite3.Cursor,
     """
     # track the number of web requests that were sent
     n_requests = 0
-    # map global identifiers to SMILES structures
-    gid_to_smi = {}
-    qry_sel = "SELECT g_id, name FROM master WHERE smi IS NULL"
-    n = 0
+    # group the global identifiers by compound name
+    name_to_gids = {}
+    if names is None:
+        qry_sel = "SELECT g_id, name FROM master WHERE smi IS NULL"
+    else:
+        # only select the entries with the requested names, by joining against a temporary 
+        # table with the names
+        cursor.execute("DROP TABLE IF EXISTS temp._smiles_names")
+        cursor.execute("CREATE TEMP TABLE _smiles_names (name PRIMARY KEY) WITHOUT ROWID")
+        executemany_chunked(cursor, "INSERT OR IGNORE INTO temp._smiles_names VALUES (?)", 
+                            ((name,) for name in names))
+        qry_sel = ("SELECT g_id, master.name FROM master JOIN temp._smiles_names ON _smiles_names.name=master.name "
+                   "WHERE smi IS NULL ORDER BY master.rowid")
     for g_id, name in cursor.execute(qry_sel).fetchall():
-        n += 1
-        print(f"\r\t({n:6d}) {g_id} {name:<100s}", end="")
+        name_to_gids.setdefault(name, []).append(g_id)
+    if names is not None:
+        cursor.execute("DROP TABLE temp._smiles_names")
+    # negative cache entries that have not expired
+    t_now = time.time()
+    # resolve everything that can be done locally, queue up remote lookups 
+    name_to_smi = {}
+    pending = []
+    n_negative = 0
+    n_library = 0
+    annotations = annotate_names(name_to_gids)
+    for name in name_to_gids:
         if name in smiles_search_cache:
             # first check the search cache for the compound
-            gid_to_smi[g_id] = smiles_search_cache[name]
-        elif p_lipid := parse_lipid(name):
-            #  search lipid maps
-            smi, n_req = lmaps_fetch_smiles(session, p_lipid)
-            n_requests += n_req
-            if smi:
-                gid_to_smi[g_id] = smi
-                # add entry to search cache
-                smiles_search_cache[name] = smi
-            elif gen_lipid_smi:
-                # try to generate a lipid SMILES structure
-                if "fa_mod" not in p_lipid:
-                    p_lipid["fa_mod"] = None
-                lc, nc, nu, fm = p_lipid["lipid_class"], p_lipid["n_carbon"], p_lipid["n_unsat"], p_lipid["fa_mod"]
-                smi = _generate_lipid_smiles(lc, nc, nu, fa_mod=fm)
-                if smi:
-                    gid_to_smi[g_id] = smi
-        elif parse_peptide(name):
+            name_to_smi[name] = smiles_search_cache[name]
+        elif p_lipid := annotations[name]["lipid"]:
+            if gen_lipid_smi and lipid_library is not None and (smi := lipid_library.get_smiles(p_lipid)):
+                # resolve locally using the lipid library
+                name_to_smi[name] = smi
+                n_library += 1
+            else:
+                pending.append((name, p_lipid))
+        elif annotations[name]["is_peptide"]:
             # if parsed the name as a peptide, generate a SMILES structure from that
-            smi = _peptide_seq_to_smiles(name)
-            gid_to_smi[g_id] = smi
+            name_to_smi[name] = _peptide_seq_to_smiles(name)
+        elif offline:
+            # can not search for this one
+            continue
+        elif _in_negative_cache(negative_cache, name, t_now):
+            # already know this one can not be found
+            n_negative += 1
+        else:
+            pending.append((name, None))
+    not_found = []
+    # PubChem CIDs that have been fetched (None if PubChem does not have a SMILES structure
+    # for it), names waiting on each CID that has not been fetched yet, and batches of CIDs 
+    # to fetch (the next one to send and the ones in flight, in order)
+    cid_to_smi = {}
+    cid_to_names = {}
+    cid_batch = []
+    cid_batches = deque()
+    n_failed = 0
+
+    def resolve_pubchem(name, smi):
+        if smi:
+            name_to_smi[name] = smi
+            # add entry to search cache
+            _add_to_cache(smiles_search_cache, name, smi, "pubchem")
         else:
-            # finally search pubchem by name (try to find CID first, then grab the SMILES)  
-            cids, n_req = pubchem_search_by_name(session, name)
+            not_found.append(name)
+
+    def collect_cid_batches(wait):
+        # collect the results for the CID batches that are done (or all of them, if wait)
+        nonlocal n_requests, n_failed
+        while cid_batches and (wait or cid_batches[0][1].done()):
+            cids, future = cid_batches.popleft()
+            batch_cid_to_smi, n_req = future.result()
             n_requests += n_req
-            # do one retry for failed queries
-            if cids is None:
-                cids, n_req = pubchem_search_by_name(session, name)
-                n_requests += n_req
-            if cids is not None:
-                # if multiple CIDs were found just use the first
-                cid = cids[0]
-                smi, n_req = _smi_from_cid(session, cid)
-                n_requests += n_req
+            for cid in cids:
+                names_for_cid = cid_to_names.pop(cid)
+                if batch_cid_to_smi is None:
+                    # the request failed, leave these names unresolved (and out of the 
+                    # negative cache) so they get looked up again next time
+                    n_failed += len(names_for_cid)
+                    continue
+                cid_to_smi[cid] = batch_cid_to_smi.get(cid)
+                for name in names_for_cid:
+                    resolve_pubchem(name, cid_to_smi[cid])
+
+    # CID batches get their own worker thread so they do not wait behind all of the name lookups
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, ThreadPoolExecutor(max_workers=1) as cid_executor:
+        # do the remote lookups concurrently
+        futures = []
+        for name, p_lipid in pending:
+            if p_lipid:
+                negative = _in_negative_cache(negative_cache, name, t_now)
+                n_negative += negative
+                search = not (negative or offline)
+                futures.append(executor.submit(_lipid_smiles_remote, session, p_lipid, gen_lipid_smi, search))
+            else:
+                futures.append(executor.submit(_pubchem_cid_remote, session, name))
+        # collect results in order 
+        progress = Progress(total=len(pending))
+        for (name, p_lipid), future in zip(pending, futures):
+            progress.update(msg=name)
+            if p_lipid:
+                smi, source, missing, n_req = future.result()
                 if smi:
-                    gid_to_smi[g_id] = smi
-                    # add entry to search cache
-                    smiles_search_cache[name] = smi
+                    name_to_smi[name] = smi
+                    if source == "lipidmaps":
+                        # add entry to search cache
+                        _add_to_cache(smiles_search_cache, name, smi, source)
+                if missing:
+                    not_found.append(name)
+            else:
+                cid, missing, n_req = future.result()
+                if cid in cid_to_smi:
+                    # already fetched the SMILES structure for this CID
+                    resolve_pubchem(name, cid_to_smi[cid])
+                elif cid in cid_to_names:
+                    cid_to_names[cid].append(name)
+                elif cid is not None:
+                    cid_to_names[cid] = [name]
+                    cid_batch.append(cid)
+                    if len(cid_batch) == _CID_CHUNK_SIZE:
+                        cid_batches.append((cid_batch, cid_executor.submit(pubchem_cids_fetch_smiles, session, cid_batch)))
+                        cid_batch = []
+                elif missing:
+                    not_found.append(name)
+            n_requests += n_req
+            collect_cid_batches(False)
+        progress.close()
+        # fetch SMILES structures for the rest of the CIDs
+        if cid_batch:
+            cid_batches.append((cid_batch, cid_executor.submit(pubchem_cids_fetch_smiles, session, cid_batch)))
+        collect_cid_batches(True)
+    # record the names that could not be found in the negative cache
+    if negative_cache is not None:
+        for name in not_found:
+            negative_cache[name] = t_now + negative_ttl
+    print(f"\tnames: {len(name_to_gids)} resolved: {len(name_to_smi)} (lipid library: {n_library}) "
+          f"skipped (negative cache): {n_negative} failed (CID batches): {n_failed}")
     # add the SMILES structures to the master table by g_id for any compounds that were matched
-    print("\n\tadding SMILES structures to database ...", end=" ")
-    qry_updt = "UPDATE master SET smi=? WHERE g_id=?"
-    for g_id in gid_to_smi:
-        qdata = (gid_to_smi[g_id], g_id)
-        cursor.execute(qry_updt, qdata)
+    print("\tadding SMILES structures to database ...", end=" ")
+    rows = ((g_id, smi) for name, smi in name_to_smi.items() for g_id in name_to_gids[name])
+    n_smiles = bulk_update(cursor, "master", "g_id", ["smi"], rows)
     print("done")
     # return number of SMILES structures added
-    return len(gid_to_smi), n_requests
+    return n_smiles, n_requests
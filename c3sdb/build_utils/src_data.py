@@ -4,27 +4,72 @@
     Dylan Ross (dylan.ross@pnnl.gov)
 
     Module for adding source datasets to the database
+
+    Source datasets are read incrementally (entries are streamed into the database in
+    bounded chunks) so memory use does not depend on the size of the source. Supported
+    formats (identified by file extension):
+        - `.json`: ``{"metadata": {...}, "data": [{...}, ...]}``
+        - `.jsonl`: one entry per line, optionally preceded by a ``{"metadata": {...}}`` line
+        - `.csv` / `.tsv`: one entry per row with a header row (name, adduct, mz, ccs and
+            optionally smi columns), metadata must be provided separately
+    Any of these may also be compressed with gzip (`.gz`) or zstandard (`.zst`, requires
+    the optional ``zstandard`` package)
 """
 
 
+from typing import Dict, Any, Optional, Iterator, Iterable, Tuple, TextIO
+from functools import lru_cache
 import hashlib
 import re
 import json
 import sqlite3
 import os
+import io
+import csv
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from c3sdb.build_utils._bulk import _CHUNK_SIZE, executemany_chunked
 
 
 # path to built in source dataset directory
 _SRC_DATA_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "_include/src_data/")
 
+# supported source dataset file extensions, in the order they are searched for by src_tag
+_SRC_EXTS: Tuple[str, ...] = tuple(
+    ext + comp for ext in (".json", ".jsonl", ".csv", ".tsv") for comp in ("", ".gz", ".zst")
+)
+
+# metadata fields that are required to add a source dataset
+_REQUIRED_METADATA: Tuple[str, ...] = ("src_tag", "ccs_type", "ccs_method")
+
+# regex for identifying multiple charges
+_MULTI_Z: re.Pattern = re.compile(r".*[]]([0-9])[+-]")
+
+# fixes for messed up adducts
+_ADDUCT_FIXES: Dict[str, str] = {
+    "[M+]+": "[M]+",
+    "M+NH4]+": "[M+NH4]+",
+    "[M+H]+*": "[M+H]+",
+    "[M+Na]+*": "[M+Na]+",
+    "[M+H20-H]-": "[M+H2O-H]-",
+}
 
-def _gen_id(name: str, 
-            adduct: str, 
-            ccs: float, 
-            ccs_type: str, 
+# number of characters to read at a time when streaming JSON
+_JSON_READ_SIZE: int = 1 << 16
+
+
+def _gen_id(name: str,
+            adduct: str,
+            ccs: float,
+            ccs_type: str,
             src_tag: str
             ) -> str :
-    """ 
+    """
     computes a unique string identifier for an entry by hashing on name+adduct+ccs+ccs_type+src_tag
     """
     s = f"{name}{adduct}{ccs}{ccs_type}{src_tag}"
@@ -32,77 +77,309 @@ def _gen_id(name: str,
     return 'CCSBASE_' + h
 
 
-def add_dataset(cursor: sqlite3.Cursor, 
-                src_tag: str
-                ) -> int :
+@lru_cache(maxsize=None)
+def _normalize_adduct(adduct: str
+                      ) -> Tuple[str, int] :
+    """
+    fixes messed up adducts and determines the charge, there are only a handful of distinct
+    adducts so this is memoized instead of being worked out for every entry
+
+    Returns
+    -------
+    adduct : ``str``
+        fixed adduct
+    z : ``int``
+        charge
+    """
+    adduct = _ADDUCT_FIXES.get(adduct, adduct)
+    is_multi = _MULTI_Z.match(adduct)
+    return adduct, int(is_multi.group(1)) if is_multi else 1
+
+
+def _find_src_file(src_tag: str,
+                   src_dir: str = _SRC_DATA_PATH
+                   ) -> str :
+    """
+    finds the file for a source dataset identified by src_tag (in any of the supported
+    formats) in a directory, raises a ValueError if it is not found
+    """
+    for ext in _SRC_EXTS:
+        if os.path.isfile(src_file := os.path.join(src_dir, src_tag + ext)):
+            return src_file
+    msg = (f"_find_src_file: dataset with src_tag: {src_tag} not found")
+    raise ValueError(msg)
+
+
+def _open_src_file(src_file: str
+                   ) -> TextIO :
+    """
+    opens a source dataset file for reading as text, decompressing on the fly if needed
+    """
+    if src_file.endswith(".gz"):
+        return gzip.open(src_file, "rt", encoding="utf-8", newline="")
+    if src_file.endswith(".zst"):
+        if zstandard is None:
+            msg = (f"_open_src_file: the zstandard package is required to read {src_file}")
+            raise ImportError(msg)
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(src_file, "rb"), closefd=True),
+                                encoding="utf-8", newline="")
+    return open(src_file, "r", encoding="utf-8", newline="")
+
+
+def _src_format(src_file: str
+                ) -> str :
+    """ returns the format (json, jsonl, csv, tsv) of a source dataset file """
+    base = src_file.removesuffix(".gz").removesuffix(".zst")
+    return os.path.splitext(base)[1].lstrip(".").lower()
+
+
+class _JSONStream:
+    """
+    Minimal incremental reader for a JSON source dataset, the top-level object is walked
+    key by key and the elements of its "data" array are decoded one at a time so that the
+    whole document is never held in memory
+    """
+
+    def __init__(self,
+                 f: TextIO
+                 ) -> None :
+        self.f_ = f
+        self.buf_ = ""
+        self.pos_ = 0
+        self.eof_ = False
+        self.decoder_ = json.JSONDecoder()
+
+    def _fill(self
+              ) -> bool :
+        """ reads more text into the buffer (discarding consumed text), False at EOF """
+        if self.eof_:
+            return False
+        chunk = self.f_.read(_JSON_READ_SIZE)
+        if not chunk:
+            self.eof_ = True
+            return False
+        self.buf_ = self.buf_[self.pos_:] + chunk
+        self.pos_ = 0
+        return True
+
+    def _peek(self
+              ) -> str :
+        """ skips whitespace and returns the next character ("" at EOF) """
+        while True:
+            while self.pos_ < len(self.buf_) and self.buf_[self.pos_].isspace():
+                self.pos_ += 1
+            if self.pos_ < len(self.buf_) or not self._fill():
+                return self.buf_[self.pos_:self.pos_ + 1]
+
+    def _expect(self,
+                chars: str
+                ) -> str :
+        """ consumes the next character, which must be one of chars """
+        if (c := self._peek()) == "" or c not in chars:
+            msg = f"_JSONStream: expected one of {chars!r} but found {c!r}"
+            raise ValueError(msg)
+        self.pos_ += 1
+        return c
+
+    def _value(self
+               ) -> Any :
+        """ decodes the next value, reading more text until it is complete """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder_.raw_decode(self.buf_, self.pos_)
+                # a value that runs to the end of the buffer (e.g. a number) may be truncated
+                if end < len(self.buf_) or self.eof_:
+                    self.pos_ = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof_:
+                    raise
+            self._fill()
+
+    def items(self
+              ) -> Iterator[Tuple[str, Any]] :
+        """
+        yields ("metadata", metadata) and ("data", entry) for each element of the "data"
+        array, in the order they appear in the file, other top-level keys are skipped
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "data" and self._peek() == "[":
+                self._expect("[")
+                if self._peek() != "]":
+                    while True:
+                        yield "data", self._value()
+                        if self._expect(",]") == "]":
+                            break
+                else:
+                    self._expect("]")
+            elif key == "metadata":
+                yield "metadata", self._value()
+            else:
+                self._value()
+            if self._expect(",}") == "}":
+                return
+
+
+def _read_src_file(f: TextIO,
+                   fmt: str,
+                   metadata: Optional[Dict[str, Any]]
+                   ) -> Tuple[Dict[str, Any], Iterator[Dict[str, Any]]] :
+    """
+    sets up streaming of the entries from an open source dataset file, metadata from the
+    file (if any) is read first and is updated with the metadata that was passed in
+
+    Returns
+    -------
+    metadata : ``dict(str:Any)``
+        source dataset metadata
+    entries : ``iterator(dict(str:Any))``
+        iterator over the entries in the file
+    """
+    metadata = {} if metadata is None else metadata
+    if fmt == "json":
+        items = _JSONStream(f).items()
+        key, value = next(items, (None, None))
+        if key == "metadata":
+            metadata = {**value, **metadata}
+            entries = (entry for _, entry in items)
+        elif key == "data":
+            # data precede metadata in the file, so metadata must be provided separately
+            entries = (entry for key, entry in _chain_first((key, value), items) if key == "data")
+        else:
+            entries = iter(())
+    elif fmt == "jsonl":
+        lines = (json.loads(line) for line in f if line.strip())
+        first = next(lines, None)
+        if first is not None and "metadata" in first and len(first) == 1:
+            metadata = {**first["metadata"], **metadata}
+            entries = lines
+        else:
+            entries = lines if first is None else _chain_first(first, lines)
+    elif fmt in ("csv", "tsv"):
+        entries = csv.DictReader(f, delimiter="," if fmt == "csv" else "\t")
+    else:
+        msg = (f"_read_src_file: unrecognized source dataset format: {fmt}")
+        raise ValueError(msg)
+    for field in _REQUIRED_METADATA:
+        if field not in metadata:
+            msg = (f"_read_src_file: source dataset metadata is missing required field: {field}")
+            raise ValueError(msg)
+    return metadata, entries
+
+
+def _chain_first(first: Any,
+                 rest: Iterable[Any]
+                 ) -> Iterator[Any] :
+    """ yields first, then everything from rest """
+    yield first
+    yield from rest
+
+
+def _iter_rows(metadata: Dict[str, Any],
+               entries: Iterable[Dict[str, Any]]
+               ) -> Iterator[Tuple[Any, ...]] :
+    """
+    generates rows for the master table from source dataset entries
+
+    Parameters
+    ----------
+    metadata : ``dict(str:Any)``
+        source dataset metadata
+    entries : ``iterable(dict(str:Any))``
+        source dataset entries
+
+    Yields
+    ------
+    row : ``tuple(...)``
+        g_id, name, adduct, mass, z, mz, ccs, smi, chem_class_label, src_tag, ccs_type, ccs_method
+    """
+    ccs_type, ccs_method = metadata["ccs_type"], metadata["ccs_method"]
+    src_tag = metadata["src_tag"]
+    for cmpd in entries:
+        # strip whitespace off of the name
+        name = cmpd["name"].strip()
+        # fix messed up adducts and check for multiple charges
+        adduct, z = _normalize_adduct(cmpd["adduct"])
+        mz = float(cmpd["mz"])
+        # use smi if included (empty values in CSV/TSV files count as missing)
+        smi = cmpd.get("smi") or None
+        # make sure CCS is a float
+        ccs = float(cmpd["ccs"])
+        yield (
+            _gen_id(name, adduct, ccs, ccs_type, src_tag), name, adduct, mz * z, z, mz, ccs, smi,
+            None, src_tag, ccs_type, ccs_method
+        )
+
+
+def add_dataset_file(cursor: sqlite3.Cursor,
+                     src_file: str,
+                     metadata: Optional[Dict[str, Any]] = None,
+                     chunk_size: int = _CHUNK_SIZE
+                     ) -> int :
     """
-    Adds values from a source dataset (a JSON file identified by src_tag) to the database
-    
+    Adds values from a source dataset file (any supported format, see module docstring)
+    to the database, entries are streamed from the file and inserted in chunks, entries
+    with duplicate g_ids are skipped
+
     Parameters
     ----------
     cursor : ``sqlite3.cursor``
         cursor for C3S.db
-    src_tag : ``str``
-        identifier for source dataset (JSON file)
-    
+    src_file : ``str``
+        path to the source dataset file
+    metadata : ``dict(str:Any)``, optional
+        source dataset metadata (src_tag, ccs_type, ccs_method), required for CSV/TSV files,
+        otherwise overrides the metadata in the file
+    chunk_size : ``int``, default=_CHUNK_SIZE
+        number of entries to insert at a time
+
     Returns
     -------
     n_added : ``int``
         number of entries added to the database from this source
     """
-    # ensure the specified dataset exists
-    src_dset_file = os.path.join(_SRC_DATA_PATH, f"{src_tag}.json")
-    if not os.path.isfile(src_dset_file):
-        msg = (f"add_dataset: dataset with src_tag: {src_tag} not found")
-        raise ValueError(msg)
-    with open(src_dset_file, "r") as j:
-        jdata = json.load(j)
-    # regex for identifying multiple charges
-    multi_z = re.compile('.*[]]([0-9])[+-]')
-    # track g_ids
-    g_ids = set()
-    # track how many entries added to the database
-    added = 0
     # query string
-    # g_id, name, adduct, mz, ccs, smi, src_tag
-    qry = "INSERT INTO master VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"
-    for cmpd in jdata["data"]:
-        # strip whitespace off of the name
-        name = cmpd["name"].strip()
-        # fix messed up adducts on the fly
-        adduct = cmpd["adduct"]
-        adduct = {
-            "[M+]+": "[M]+", 
-            "M+NH4]+": "[M+NH4]+",
-            "[M+H]+*": "[M+H]+",
-            "[M+Na]+*": "[M+Na]+",
-            "[M+H20-H]-": "[M+H2O-H]-",
-        }.get(adduct, adduct)
-        # check for multiple charges
-        mz = float(cmpd["mz"])
-        is_multi = multi_z.match(adduct)
-        z = 1
-        if is_multi:
-            z = int(is_multi.group(1))
-        # calculate the mass
-        mass = mz * z
-        # use smi if included
-        smi = cmpd.get("smi")
-        # make sure CCS is a float
-        ccs = float(cmpd["ccs"])
-        # metadata
-        ccs_type, ccs_method = jdata["metadata"]["ccs_type"], jdata["metadata"]["ccs_method"]
-        src_tag = jdata["metadata"]["src_tag"]
-        # unique identifier
-        g_id = _gen_id(name, adduct, ccs, ccs_type, src_tag)
-        if g_id not in g_ids:
-            # implicitly skip duplicate g_ids
-            qdata = (
-                g_id, name, adduct, mass, z, mz, ccs, smi, None, src_tag, ccs_type, ccs_method
-            )
-            cursor.execute(qry, qdata)
-            g_ids.add(g_id)
-            added += 1
+    # g_id, name, adduct, mass, z, mz, ccs, smi, chem_class_label, src_tag, ccs_type, ccs_method
+    qry = "INSERT OR IGNORE INTO master VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"
+    with _open_src_file(src_file) as f:
+        metadata, entries = _read_src_file(f, _src_format(src_file), metadata)
+        # duplicate g_ids are implicitly skipped by INSERT OR IGNORE
+        added = executemany_chunked(cursor, qry, _iter_rows(metadata, entries), chunk_size=chunk_size)
     # return the number of entries added to the database from this dataset
     return added
-        
+
+
+def add_dataset(cursor: sqlite3.Cursor,
+                src_tag: str,
+                src_dir: str = _SRC_DATA_PATH,
+                metadata: Optional[Dict[str, Any]] = None
+                ) -> int :
+    """
+    Adds values from a source dataset (a file identified by src_tag) to the database
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.cursor``
+        cursor for C3S.db
+    src_tag : ``str``
+        identifier for source dataset (file name without extension)
+    src_dir : ``str``, default=_SRC_DATA_PATH
+        directory containing the source dataset, defaults to the built in source datasets
+    metadata : ``dict(str:Any)``, optional
+        source dataset metadata, required for CSV/TSV files (see `add_dataset_file`)
+
+    Returns
+    -------
+    n_added : ``int``
+        number of entries added to the database from this source
+    """
+    # ensure the specified dataset exists
+    src_dset_file = _find_src_file(src_tag, src_dir=src_dir)
+    return add_dataset_file(cursor, src_dset_file, metadata=metadata)
+
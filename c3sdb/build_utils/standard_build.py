@@ -8,22 +8,57 @@
     - use command: `python3 -m c3sdb.build_utils.standard_build`
     - creates files:
         - `C3S.db`: database
-        - `smiles_search_cache.json`: cached values for searching for SMILES structures
+        - `smiles_search_cache.db`: cached values for searching for SMILES structures
+        - `mqn_cache.db`: cached MQNs for each SMILES structure
+        - `build_report.json`: build performance report (wall/CPU time and throughput for 
+            each stage, cache hit rates, web request counts and latency for each endpoint)
+    - options:
+        - `--offline`: do not send any web requests, SMILES structures are only resolved 
+            using the search cache and the peptide/lipid SMILES generators, the names that 
+            could not be resolved are written to `unresolved_names.txt`
+        - `--record ARCHIVE`: record all web responses into an archive file
+        - `--replay ARCHIVE`: serve web responses from an archive file (made with `--record`)
+            instead of the network, `--replay-latency` sets simulated latency (in seconds)
+        - `--incremental`: update an existing `C3S.db` instead of rebuilding it from scratch,
+            only new or changed source datasets are (re-)added, dropped source datasets are 
+            removed, and the SMILES/MQN/label/annotation stages only process the affected entries
+        - `--in-memory`: build the database in memory and write it to disk at the end
+        - `--workers N`: sharded build, each source dataset is run through the SMILES/MQN/
+            label/annotation stages by one of N worker processes into its own shard database and the
+            shards are merged into `C3S.db` (can not be combined with `--record`)
+        - `--lipidmaps`: search LIPID MAPS for lipids instead of taking their structures from
+            the built in lipid library (which has structures from the lipid SMILES generator)
+        - `--resume`: resume a build that was interrupted, keeping what is already in `C3S.db`
+            and skipping the build stages that were completed (SMILES structures and MQNs
+            are committed in chunks, so those stages pick up after the last completed chunk)
+        - `--stages STAGE [STAGE ...]`: only run (or re-run) the selected build stages
+            (ingest, smiles, mqns, labels, annotations) on an existing `C3S.db`
 """
 
 
+from typing import Any, Optional, Dict
 import sqlite3
 import os
+import argparse
+import tempfile
 
-import requests
-
-from c3sdb.build_utils.db_init import create_db
+from c3sdb.build_utils.db_init import create_db, create_indexes, drop_indexes
 from c3sdb.build_utils.src_data import add_dataset
-from c3sdb.build_utils.smiles import (
-    load_smiles_search_cache, save_smiles_search_cache, add_smiles_to_db
+from c3sdb.build_utils.smiles import _SMILES_SEARCH_CACHE, add_smiles_to_db
+from c3sdb.build_utils.search_cache import SmilesSearchCache
+from c3sdb.build_utils._transport import recording_session, replay_session
+from c3sdb.build_utils._remote import remote_session
+from c3sdb.build_utils._bulk import open_build_db, finalize_db, save_build_db
+from c3sdb.build_utils._telemetry import BuildReport, merge_request_stats
+from c3sdb.build_utils.mqns import MQNCache, add_mqns_to_db, sort_mqns
+from c3sdb.build_utils.lipid_library import LipidLibrary
+from c3sdb.build_utils.compositional_mqns import CompositionalMQNs
+from c3sdb.build_utils.classification import label_class_byname, add_name_annotations, _ANNOTATION_VERSION
+from c3sdb.build_utils.sharded import build_shards
+from c3sdb.build_utils.incremental import (
+    plan_incremental, remove_dataset, record_dataset, order_datasets, stage_input_hash, stage_inputs_changed, 
+    record_stage, get_checkpoint, set_checkpoint, clear_checkpoints
 )
-from c3sdb.build_utils.mqns import add_mqns_to_db
-from c3sdb.build_utils.classification import label_class_byname
 
 
 # source datasets to include
@@ -38,54 +73,357 @@ _SRC_TAGS = [
 ]
 
 
+# build stages, in the order they are run
+_STAGES = ["ingest", "smiles", "mqns", "labels", "annotations"]
+
+
+# number of distinct compound names to resolve SMILES structures for between checkpoints
+_SMILES_CHUNK_SIZE = 1000
+
+
+# build performance report (written next to the database)
+_REPORT_FILE = "build_report.json"
+
+
+# cache files (shared between builds)
+_SMILES_CACHE_FILE = "smiles_search_cache.db"
+_MQN_CACHE_FILE = "mqn_cache.db"
+
+
+# queries selecting the inputs for each build stage (used for tracking whether 
+# the stage inputs have changed in incremental builds)
+_STAGE_INPUT_QRYS = {
+    "smiles": "SELECT g_id, name FROM master WHERE smi IS NULL ORDER BY g_id",
+    "mqns": "SELECT g_id, smi FROM master WHERE smi IS NOT NULL AND g_id NOT IN (SELECT g_id FROM mqns) ORDER BY g_id",
+    "labels": "SELECT g_id, name FROM master WHERE chem_class_label IS NULL ORDER BY g_id",
+    "annotations": "SELECT g_id, name FROM master WHERE g_id NOT IN (SELECT g_id FROM name_annotations) ORDER BY g_id",
+}
+
+
+def _stage_params(stage: str,
+                  args: argparse.Namespace
+                  ) -> Any :
+    """ other parameters that affect the output of a build stage """
+    if stage == "smiles":
+        return {"offline": args.offline}
+    if stage == "annotations":
+        # annotations made by older versions of the name parsers get re-done
+        return {"annotation_version": _ANNOTATION_VERSION}
+    return None
+
+
+def _run_stage(cursor: sqlite3.Cursor,
+               stage: str,
+               args: argparse.Namespace
+               ) -> bool :
+    """ 
+    check whether a build stage needs to be run, in incremental builds stages are skipped 
+    if their inputs have not changed since the last time they were run
+    """
+    if not args.incremental:
+        return True
+    input_hash = stage_input_hash(cursor, _STAGE_INPUT_QRYS[stage], _stage_params(stage, args))
+    if not stage_inputs_changed(cursor, stage, input_hash):
+        print("\tinputs unchanged, skipping")
+        return False
+    return True
+
+
+def _record_stage(cursor: sqlite3.Cursor,
+                  stage: str,
+                  args: argparse.Namespace
+                  ) -> None :
+    """ record the hash of the inputs left over after running a build stage """
+    input_hash = stage_input_hash(cursor, _STAGE_INPUT_QRYS[stage], _stage_params(stage, args))
+    record_stage(cursor, stage, input_hash)
+
+
+def _open_smiles_search_cache(
+                              ) -> SmilesSearchCache :
+    """ open the SMILES search cache, seeding it if it does not exist yet """
+    new_cache = not os.path.isfile(_SMILES_CACHE_FILE)
+    smiles_search_cache = SmilesSearchCache(_SMILES_CACHE_FILE)
+    if new_cache:
+        # if a local copy of the SMILES search cache does not exist, seed it with the 
+        # built-in copy from the package (or a local copy in the older .json format)
+        json_cache_file = "smiles_search_cache.json"
+        smiles_search_cache.import_json(json_cache_file if os.path.isfile(json_cache_file) else _SMILES_SEARCH_CACHE)
+    return smiles_search_cache
+
+
+def _parse_args(
+                ) -> argparse.Namespace :
+    """ parse command line arguments """
+    parser = argparse.ArgumentParser(description="standard build script for the CCSbase database (C3S.db)")
+    remote = parser.add_mutually_exclusive_group()
+    remote.add_argument("--offline", action="store_true",
+                        help="do not send any web requests")
+    remote.add_argument("--record", metavar="ARCHIVE",
+                        help="record all web responses into an archive file")
+    remote.add_argument("--replay", metavar="ARCHIVE",
+                        help="serve web responses from an archive file instead of the network")
+    parser.add_argument("--incremental", action="store_true",
+                        help="update an existing database, only processing new or changed source datasets")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="build the database in memory then write it to disk at the end")
+    parser.add_argument("--replay-latency", type=float, default=0., metavar="SEC",
+                        help="simulated latency (in seconds) for replayed web responses")
+    parser.add_argument("--lipidmaps", action="store_true",
+                        help="search LIPID MAPS for lipids instead of using the built in lipid library")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="build each source dataset into its own shard using N worker processes")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume an interrupted build, skipping the stages that were completed")
+    parser.add_argument("--stages", nargs="+", choices=_STAGES, metavar="STAGE",
+                        help=f"only run (or re-run) these build stages on an existing database ({', '.join(_STAGES)})")
+    args = parser.parse_args()
+    if args.workers > 1 and args.record:
+        parser.error("--record can not be combined with --workers")
+    if args.in_memory and (args.resume or args.stages):
+        parser.error("--in-memory can not be combined with --resume or --stages (nothing is checkpointed to disk)")
+    return args
+
+
+def _ingest_stage(cur: sqlite3.Cursor,
+                  args: argparse.Namespace,
+                  dbf: str,
+                  lipid_library: Optional[LipidLibrary],
+                  report: BuildReport
+                  ) -> Dict[str, Any] :
+    """ 
+    build stage: remove dropped or changed source datasets and add new ones, each source 
+    dataset is committed as soon as it has been added (and recorded in the build manifest)
+    so a resumed build only adds the ones that are still missing, at the end the entries 
+    are put in the same order as in a fresh build (source datasets in _SRC_TAGS order)
+    """
+    # figure out which source datasets need to be added/removed 
+    to_add, to_remove, unchanged = plan_incremental(cur, _SRC_TAGS)
+    if to_add or to_remove:
+        # secondary indexes are re-created at the end, after all of the data has been loaded
+        drop_indexes(cur)
+    n_removed = 0
+    if to_remove:
+        print("\tremoving dropped or changed source datasets ...")
+        for src_tag in to_remove:
+            n_rm = remove_dataset(cur, src_tag)
+            n_removed += n_rm
+            print(f"\t\tsrc_tag: {src_tag} n_removed: {n_rm}")
+        cur.connection.commit()
+    if unchanged:
+        print(f"\tunchanged (or already added) source datasets: {len(unchanged)}")
+    n_entries = 0
+    if args.workers > 1 and to_add:
+        # make sure the shared caches exist before starting the workers
+        _open_smiles_search_cache().close()
+        MQNCache(_MQN_CACHE_FILE).close()
+        # shards go in a temporary directory next to the database
+        with tempfile.TemporaryDirectory(prefix="c3sdb_shards_", dir=os.path.dirname(os.path.abspath(dbf))) as shard_dir:
+            # each shard is committed as it gets merged
+            for src_tag, stats in build_shards(cur, to_add, shard_dir, args.workers, 
+                                               _SMILES_CACHE_FILE, _MQN_CACHE_FILE, 
+                                               offline=args.offline, replay=args.replay, 
+                                               replay_latency=args.replay_latency,
+                                               use_lipid_library=not args.lipidmaps):
+                n_entries += stats["n_merged"]
+                # web requests were sent from the worker processes
+                merge_request_stats(stats["requests"])
+                print(f"\tsrc_tag: {src_tag} n_added: {stats['n_merged']} "
+                      f"n_smiles: {stats['n_smiles']} n_mqns: {stats['n_mqns']}")
+                set_checkpoint(cur, "ingest", "running", src_tag)
+    else:
+        for src_tag in to_add:  
+            n_added = add_dataset(cur, src_tag)
+            record_dataset(cur, src_tag, n_added)
+            n_entries += n_added
+            print(f"\tsrc_tag: {src_tag} n_added: {n_added}")
+            set_checkpoint(cur, "ingest", "running", src_tag)
+    print(f"\ttotal entries added: {n_entries}")
+    # (re-)added source datasets go at the end of the table, put them back in place
+    if order_datasets(cur, _SRC_TAGS):
+        sort_mqns(cur)
+        print("\tsource datasets reordered")
+    return {"n_rows": n_entries, "n_datasets_added": len(to_add), "n_datasets_removed": len(to_remove),
+            "n_entries_removed": n_removed}
+
+
+def _smiles_stage(cur: sqlite3.Cursor,
+                  args: argparse.Namespace,
+                  dbf: str,
+                  lipid_library: Optional[LipidLibrary],
+                  report: BuildReport
+                  ) -> Dict[str, Any] :
+    """ 
+    build stage: add SMILES structures, the distinct compound names are resolved in chunks
+    (in order) and the SMILES structures and search cache are committed after each chunk 
+    along with the last name in the chunk, a resumed build continues after that name
+    """
+    smiles_search_cache = _open_smiles_search_cache()
+    if args.record:
+        sess = recording_session(args.record)
+    elif args.replay:
+        sess = replay_session(args.replay, latency=args.replay_latency)
+    else:
+        sess = remote_session()
+    _, last_name = get_checkpoint(cur, "smiles")
+    if last_name is None:
+        qry, params = "SELECT DISTINCT name FROM master WHERE smi IS NULL ORDER BY name", ()
+    else:
+        print(f"\tresuming after: {last_name}")
+        qry, params = "SELECT DISTINCT name FROM master WHERE smi IS NULL AND name > ? ORDER BY name", (last_name,)
+    names = [name for name, in cur.execute(qry, params).fetchall()]
+    n_smiles, n_requests = 0, 0
+    for i in range(0, len(names), _SMILES_CHUNK_SIZE):
+        chunk = names[i:i + _SMILES_CHUNK_SIZE]
+        n_smi, n_req = add_smiles_to_db(cur, sess, smiles_search_cache, 
+                                        negative_cache=smiles_search_cache.negative,
+                                        offline=args.offline, lipid_library=lipid_library,
+                                        names=chunk)
+        n_smiles += n_smi
+        n_requests += n_req
+        smiles_search_cache.commit()
+        set_checkpoint(cur, "smiles", "running", chunk[-1])
+    print(f"\tSMILES structures added: {n_smiles}")
+    print(f"\tweb requests sent: {n_requests}")
+    if args.offline:
+        # report which names could not be resolved
+        unresolved = [_[0] for _ in cur.execute("SELECT DISTINCT name FROM master WHERE smi IS NULL ORDER BY name")]
+        with open("unresolved_names.txt", "w") as f:
+            f.write("".join([name + "\n" for name in unresolved]))
+        print(f"\tunresolved names (see unresolved_names.txt): {len(unresolved)}")
+    report.add_cache_stats("smiles_search_cache", smiles_search_cache.stats())
+    if lipid_library is not None:
+        report.add_cache_stats("lipid_library", {"hits": lipid_library.n_hits_})
+    # the search cache is written incrementally, just make sure everything is committed
+    smiles_search_cache.close()
+    return {"n_rows": len(names), "n_smiles": n_smiles, "n_requests": n_requests}
+
+
+def _mqns_stage(cur: sqlite3.Cursor,
+                args: argparse.Namespace,
+                dbf: str,
+                lipid_library: Optional[LipidLibrary],
+                report: BuildReport
+                ) -> Dict[str, Any] :
+    """ 
+    build stage: add MQNs, committed after each chunk of results so a resumed build only 
+    computes MQNs for the entries that are still missing them
+    """
+    def checkpoint(n_done):
+        set_checkpoint(cur, "mqns", "running", str(n_done))
+    with MQNCache(_MQN_CACHE_FILE) as mqn_cache:
+        compositional = CompositionalMQNs()
+        failures = {}
+        n_mqns = add_mqns_to_db(cur, mqn_cache=mqn_cache, lipid_library=lipid_library,
+                                compositional=compositional, on_chunk=checkpoint, failures=failures)
+        mqn_stats = mqn_cache.stats()
+    print(f"\tentries with MQNs added: {n_mqns}")
+    print(f"\tMQN cache hits: {mqn_stats['hits']} misses: {mqn_stats['misses']}")
+    print(f"\tstructures with compositional MQNs: {compositional.n_computed_}")
+    for reason, n_failed in failures.items():
+        print(f"\tfailed ({reason}): {n_failed}")
+    report.add_cache_stats("mqn_cache", mqn_stats)
+    report.add_cache_stats("compositional_mqns", {"n_computed": compositional.n_computed_})
+    return {"n_rows": n_mqns, "failures": failures}
+
+
+def _labels_stage(cur: sqlite3.Cursor,
+                  args: argparse.Namespace,
+                  dbf: str,
+                  lipid_library: Optional[LipidLibrary],
+                  report: BuildReport
+                  ) -> Dict[str, Any] :
+    """ build stage: add rough chemical classification labels """
+    qry = "SELECT COUNT(*) FROM master WHERE chem_class_label IS NULL"
+    n_unlabeled = cur.execute(qry).fetchone()[0]
+    label_class_byname(cur)
+    return {"n_rows": n_unlabeled, "n_labeled": n_unlabeled - cur.execute(qry).fetchone()[0]}
+
+
+def _annotations_stage(cur: sqlite3.Cursor,
+                       args: argparse.Namespace,
+                       dbf: str,
+                       lipid_library: Optional[LipidLibrary],
+                       report: BuildReport
+                       ) -> Dict[str, Any] :
+    """ build stage: add annotations parsed from compound names """
+    n_annotated = add_name_annotations(cur)
+    print(f"\tentries annotated: {n_annotated}")
+    return {"n_rows": n_annotated}
+
+
+# build stage functions and the messages to print when running them
+_STAGE_FUNCS = {
+    "ingest": (_ingest_stage, "adding source datasets"),
+    "smiles": (_smiles_stage, "adding SMILES structures"),
+    "mqns": (_mqns_stage, "adding MQNs to database entries"),
+    "labels": (_labels_stage, "adding rough chemical classification labels to database entries"),
+    "annotations": (_annotations_stage, "adding name annotations to database entries"),
+}
+
+
 def _main():
+    args = _parse_args()
     # database file
     dbf = "C3S.db"
+    if args.stages and not os.path.isfile(dbf):
+        raise RuntimeError(f"--stages requires an existing database ({dbf} not found)")
+    # build stages to run
+    stages = _STAGES if not args.stages else [stage for stage in _STAGES if stage in args.stages]
     # create the database
     print("initializing database ...", end=" ")
-    create_db(dbf)
+    create_db(dbf, overwrite=not (args.incremental or args.resume or args.stages))
     print("done")
     # connect to database
-    con = sqlite3.connect(dbf)
+    con = open_build_db(dbf, in_memory=args.in_memory)
     cur = con.cursor()
-    # add source datasets
-    print("adding source datasets ...")
-    n_entries = 0
-    for src_tag in _SRC_TAGS:  
-        n_added = add_dataset(cur, src_tag)
-        n_entries += n_added
-        print(f"\tsrc_tag: {src_tag} n_added: {n_added}")
-    print(f"\ttotal entries: {n_entries}")
-    print("... done")
-    # add SMILES structures 
-    print("adding SMILES structures ...")
-    smiles_cache_file = "smiles_search_cache.json"
-    # if a local copy of the SMILES search cache does not exist, grab the 
-    # built-in copy from the package
-    if not os.path.isfile(smiles_cache_file):
-        smiles_search_cache = load_smiles_search_cache(cache_file_name=None)
-    else:
-        # load the local copy if it exists
-        smiles_search_cache = load_smiles_search_cache(cache_file_name=smiles_cache_file)
-    sess = requests.Session()
-    n_smiles, n_requests = add_smiles_to_db(cur, sess, smiles_search_cache)
-    print(f"\tSMILES structures added: {n_smiles}")
-    print(f"\tweb requests sent: {n_requests}")
-    print("... done")
-    # save the search cache
-    save_smiles_search_cache(smiles_search_cache, smiles_cache_file)
-    # add MQNs 
-    print("adding MQNs to database entries ...")
-    n_mqns = add_mqns_to_db(cur)
-    print(f"\tentries with MQNs: {n_mqns}")
-    print("... done")
-    # add rough chemical classification labels
-    print("adding rough chemical classification labels to database entries ...")
-    label_class_byname(cur)
-    print("... done")
-    # commit changes to database and close
-    con.commit()
-    con.close()
+    if not args.resume:
+        # start from scratch for the stages that are getting run
+        clear_checkpoints(cur, stages)
+    # built in lipid library for resolving and featurizing lipids locally
+    lipid_library = None if args.lipidmaps else LipidLibrary()
+    # performance report, written next to the database (even if the build fails)
+    report = BuildReport()
+    report.info_.update({"args": vars(args), "completed": False})
+    report_path = os.path.join(os.path.dirname(os.path.abspath(dbf)), _REPORT_FILE)
+    try:
+        for stage in stages:
+            stage_func, msg = _STAGE_FUNCS[stage]
+            print(f"{msg} ...")
+            if args.resume and get_checkpoint(cur, stage)[0] == "done":
+                print("\talready completed, skipping")
+                print("... done")
+                continue
+            with report.stage(stage) as record:
+                # the ingest stage always runs, it figures out what needs to be added on its own
+                if stage == "ingest" or _run_stage(cur, stage, args):
+                    record.update(stage_func(cur, args, dbf, lipid_library, report))
+                    if stage != "ingest":
+                        _record_stage(cur, stage, args)
+                else:
+                    record["skipped"] = True
+                set_checkpoint(cur, stage, "done")
+            print("... done")
+        # commit changes to database, finalize and close
+        print("finalizing database ...", end=" ")
+        with report.stage("finalize") as record:
+            record["n_rows"] = cur.execute("SELECT COUNT(*) FROM master").fetchone()[0]
+            create_indexes(cur)
+            finalize_db(con, vacuum=not args.in_memory)
+            if args.in_memory:
+                save_build_db(con, dbf)
+        report.info_.update({"completed": True, "n_entries": record["n_rows"]})
+        print("done")
+    finally:
+        if not report.info_["completed"] and not args.in_memory:
+            # put back any secondary indexes that were dropped by the ingest stage, so that a 
+            # failed build does not leave the database without them
+            con.rollback()
+            create_indexes(cur)
+        con.close()
+        if lipid_library is not None:
+            lipid_library.close()
+        report.save(report_path)
+    print(f"build report: {report_path}")
 
 
 if __name__ == "__main__":
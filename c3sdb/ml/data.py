@@ -9,8 +9,11 @@
 
 
 import os
-from typing import List, Any, Optional, Tuple
-from sqlite3 import connect
+from typing import List, Any, Optional, Tuple, Dict
+from sqlite3 import connect, Connection, Cursor
+from collections.abc import Sequence
+from pathlib import Path
+import hashlib
 import pickle
 
 from sklearn.preprocessing import OneHotEncoder, StandardScaler
@@ -18,11 +21,12 @@ from sklearn.model_selection import StratifiedShuffleSplit
 # TODO: replace all of the calls to these functions with np.function(...)
 #       and get rid of this itemized import in favor of the more typical
 #       import numpy as np
-from numpy import concatenate, percentile, digitize, array
+from numpy import percentile, digitize
 import numpy as np
 from numpy import typing as npt
 
-from c3sdb.build_utils.mqns import compute_mqns
+from c3sdb.build_utils.mqns import MQNCache, compute_mqns_many
+from c3sdb.ml.feature_cache import _DATA_ARRAYS, FeatureCache, data_key, features_key
 
 
 # define adducts with sufficient representation in the database
@@ -33,112 +37,364 @@ _EXPLICIT_ADDUCTS = [
 ]
 
 
-def _all_dset(db_path: str
-              ) -> List[str] :
+# columns of the master table that can be used to filter data
+_WHERE_COLUMNS = [
+    "adduct", "z", "mass", "mz", "ccs", "chem_class_label", "ccs_type", "ccs_method"
+]
+
+
+# (categorical) columns of the master table that samples can be stratified on
+_SAMPLE_BY_COLUMNS = [
+    "src_tag", "adduct", "z", "chem_class_label", "ccs_type", "ccs_method"
+]
+
+
+# number of rows to fetch from the database at a time
+_FETCH_BLOCK_SIZE = 8192
+
+
+# columns of the name_annotations table that can be used to filter data
+_ANNOTATION_COLUMNS = [
+    "lipid_class", "n_carbon", "n_unsat", "fa_mod", "fa_comp", "is_peptide", "is_carbohydrate"
+]
+
+
+def _filter_conditions(filter_: Dict[str, Any],
+                       columns: List[str],
+                       prefix: str = ""
+                       ) -> Tuple[List[str], List[Any]] :
     """
-    Returns a list of all src_tags in the C3S.db
-    
+    Builds SQL conditions (with bound parameters) from a filter, each key in filter_ is a column
+    and the value specifies which values to keep (see `_annotation_filter_sql`)
+
+    Parameters
+    ----------
+    filter_ : ``dict(str:Any)``
+        filter
+    columns : ``list(str)``
+        columns that can be used in the filter
+    prefix : ``str``, default=""
+        prefix for the column names in the conditions (e.g. "master.")
+
+    Returns
+    -------
+    conds : ``list(str)``
+        SQL conditions
+    params : ``list(Any)``
+        bound parameters for the conditions
+    """
+    conds, params = [], []
+    for col, value in filter_.items():
+        if col not in columns:
+            raise KeyError(col)
+        if value is None:
+            conds.append(f"{prefix}{col} IS NULL")
+        elif type(value) == tuple:
+            conds.append(f"{prefix}{col} BETWEEN ? AND ?")
+            params += list(value)
+        elif type(value) in [list, set]:
+            conds.append(f"{prefix}{col} IN ({','.join('?' * len(value))})")
+            params += list(value)
+        else:
+            conds.append(f"{prefix}{col}=?")
+            params.append(value)
+    return conds, params
+
+
+def _annotation_filter_sql(annotation_filter: Optional[Dict[str, Any]]
+                           ) -> Tuple[str, List[Any]] :
+    """
+    Builds a SQL condition (with bound parameters) selecting entries from the master table
+    based on their name annotations (name_annotations table)
+
+    Each key in annotation_filter is a column of the name_annotations table and the value
+    specifies which entries to keep:
+    - a tuple ``(min, max)`` keeps values in that (inclusive) range, e.g. ``"n_carbon": (34, 38)``
+    - a list (or set) keeps values in the list, e.g. ``"lipid_class": ["PC", "PE"]``
+    - None keeps entries without a value, e.g. ``"fa_mod": None``
+    - anything else keeps values equal to it, e.g. ``"is_peptide": True``
+
+    Parameters
+    ----------
+    annotation_filter : ``dict(str:Any)`` or None
+        name annotation filter
+
+    Returns
+    -------
+    condition : ``str``
+        SQL condition to add to a query on the master table (prefixed with AND), empty if
+        no filter was provided
+    params : ``list(Any)``
+        bound parameters for the condition
+    """
+    if not annotation_filter:
+        return "", []
+    try:
+        conds, params = _filter_conditions(annotation_filter, _ANNOTATION_COLUMNS)
+    except KeyError as e:
+        msg = f"_annotation_filter_sql: {e.args[0]} is not a name annotation column ({_ANNOTATION_COLUMNS})"
+        raise ValueError(msg) from None
+    condition = " AND master.g_id IN (SELECT g_id FROM name_annotations WHERE " + " AND ".join(conds) + ")"
+    return condition, params
+
+
+def _where_sql(where: Optional[Dict[str, Any]]
+               ) -> Tuple[str, List[Any]] :
+    """
+    Builds a SQL condition (with bound parameters) selecting entries from the master table
+    based on the values in its columns (_WHERE_COLUMNS), filters are specified the same way 
+    as for `_annotation_filter_sql`, e.g. ``{"adduct": ["[M+H]+", "[M+Na]+"], "mz": (400., 900.)}``
+
+    Parameters
+    ----------
+    where : ``dict(str:Any)`` or None
+        filter on master table columns
+
+    Returns
+    -------
+    condition : ``str``
+        SQL condition to add to a query on the master table (prefixed with AND), empty if
+        no filter was provided
+    params : ``list(Any)``
+        bound parameters for the condition
+    """
+    if not where:
+        return "", []
+    try:
+        conds, params = _filter_conditions(where, _WHERE_COLUMNS, prefix="master.")
+    except KeyError as e:
+        msg = f"_where_sql: {e.args[0]} is not a column that can be filtered on ({_WHERE_COLUMNS})"
+        raise ValueError(msg) from None
+    return " AND " + " AND ".join(conds), params
+
+
+def _sample_key(seed: int, 
+                g_id: str
+                ) -> int :
+    """ pseudo-random (but reproducible) sort key for sampling entries, from the pRNG seed and g_id """
+    return int.from_bytes(hashlib.blake2b(f"{seed}:{g_id}".encode(), digest_size=7).digest(), "big")
+
+
+def _sample_sql(cursor: Cursor,
+                qry_from: str,
+                params: List[Any],
+                max_rows: int,
+                sample_by: Optional[str],
+                seed: int
+                ) -> Tuple[str, List[Any]] :
+    """
+    Restricts a query on the master table to a random sample of (at most) max_rows of the
+    entries it selects, the sample is drawn in the database and only depends on the pRNG 
+    seed and the entries (g_ids) that are selected
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db database
+    qry_from : ``str``
+        FROM/WHERE part of the query to sample from
+    params : ``list(Any)``
+        bound parameters for qry_from
+    max_rows : ``int``
+        sample size
+    sample_by : ``str`` or None
+        if provided, stratify the sample on this column (_SAMPLE_BY_COLUMNS) so that each 
+        of its values keeps (roughly) the same proportion of the entries, otherwise the 
+        sample is simple random
+    seed : ``int``
+        pRNG seed
+
+    Returns
+    -------
+    qry_from : ``str``
+    params : ``list(Any)``
+        FROM/WHERE part of the query and bound parameters restricted to the sample
+    """
+    cursor.connection.create_function("c3sd_sample_key", 2, _sample_key, deterministic=True)
+    if sample_by is None:
+        sample = "SELECT master.rowid" + qry_from + " ORDER BY c3sd_sample_key(?, master.g_id) LIMIT ?"
+        sample_params = params + [seed, max_rows]
+    else:
+        if sample_by not in _SAMPLE_BY_COLUMNS:
+            msg = f"_sample_sql: sample_by={sample_by} is not a column that can be sampled by ({_SAMPLE_BY_COLUMNS})"
+            raise ValueError(msg)
+        # rank the entries randomly within each stratum then take them in order of their relative
+        # rank, this interleaves the strata so that any number of entries keeps their proportions
+        sample = ("SELECT rid FROM (SELECT rid, k, ROW_NUMBER() OVER (PARTITION BY s ORDER BY k) AS rn, "
+                  "COUNT(*) OVER (PARTITION BY s) AS n_s FROM (SELECT master.rowid AS rid, "
+                  f"master.{sample_by} AS s, c3sd_sample_key(?, master.g_id) AS k" + qry_from + ")) "
+                  "ORDER BY (rn - 0.5) / n_s, k LIMIT ?")
+        sample_params = [seed] + params + [max_rows]
+    return qry_from + " AND master.rowid IN (" + sample + ")", params + sample_params
+
+
+def _connect_ro(db_path: str
+                ) -> Connection :
+    """
+    Opens a read-only connection to a C3S.db database file
+
     Parameters
     ----------
     db_path : ``str``
         path to C3S.db database file
+
+    Returns
+    -------
+    con : ``sqlite3.Connection``
+        read-only connection to the database
+    """
+    return connect(Path(db_path).absolute().as_uri() + "?mode=ro", uri=True)
+
+
+def _all_dset(cursor: Cursor
+              ) -> List[str] :
+    """
+    Returns a list of all src_tags in the C3S.db, in the order the datasets were added
+    
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db database
     
     Returns
     -------
     src_tags : (list(str)) -- list of src_tags in C3S.db
     """
-    con = connect(db_path)
-    cur = con.cursor()
-    qry = 'SELECT DISTINCT src_tag FROM master'
-    src_tags = [_[0] for _ in cur.execute(qry).fetchall()]
-    con.close()
-    return src_tags
+    # (DISTINCT alone would return them in whatever order the src_tag index has them)
+    qry = 'SELECT src_tag FROM master GROUP BY src_tag ORDER BY MIN(rowid)'
+    return [_[0] for _ in cursor.execute(qry).fetchall()]
 
 
-def _fetch_single_dset(db_path: str, 
-                       src_tag: str
+def _text_column(column: npt.NDArray[np.object_]
+                 ) -> npt.NDArray[Any] :
+    """ convert a column of fetched text to a str array (unless it has NULLs, then it stays an object array) """
+    return column if None in column else column.astype(str)
+
+
+def _fetch_dsets(cursor: Cursor,
+                 src_tags: List[str],
+                 annotation_filter: Optional[Dict[str, Any]] = None,
+                 where: Optional[Dict[str, Any]] = None,
+                 max_rows: Optional[int] = None,
+                 sample_by: Optional[str] = None,
+                 seed: int = 69
+                 ) -> Any :
+    """
+    fetch name, mz, adduct, ccs, src_tag, smi, chem_class_label and MQNs for a set of datasets 
+    using the provided src_tags, in the order the entries were added
+
+    Everything is fetched with a single query (joining master and mqns, so the MQNs are aligned 
+    with the rest of the data by construction) in blocks of _FETCH_BLOCK_SIZE rows that are 
+    copied straight into preallocated columns
+
+    Parameters
+    ----------
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db database
+    src_tags : ``list(str)``
+        specify the source datasets
+    annotation_filter : ``dict(str:Any)``, optional
+        only fetch entries with matching name annotations (see `_annotation_filter_sql`)
+    where : ``dict(str:Any)``, optional
+        only fetch entries with matching values in the master table (see `_where_sql`)
+    max_rows : ``int``, optional
+        only fetch a random sample of (at most) this many of the matching entries (see `_sample_sql`)
+    sample_by : ``str``, optional
+        column to stratify the sample on (see `_sample_sql`)
+    seed : ``int``, default=69
+        pRNG seed for sampling
+    
+    Returns
+    -------
+    names, mzs, adducts, ccss, srcs, smis, mqns, cls_labs : ``numpy.ndarray(...)``
+    """
+    ann_cond, ann_params = _annotation_filter_sql(annotation_filter)
+    where_cond, where_params = _where_sql(where)
+    qry_from = ' FROM master INNER JOIN mqns ON mqns.g_id=master.g_id WHERE src_tag IN (' + \
+               ','.join('?' * len(src_tags)) + ') AND smi IS NOT NULL' + where_cond + ann_cond
+    params = list(src_tags) + where_params + ann_params
+    # count and fetch within a single read transaction so that both see the same data, even if
+    # the database is being written to at the same time
+    cursor.execute('SAVEPOINT _fetch_dsets')
+    try:
+        # preallocate the columns
+        n_rows, = cursor.execute('SELECT COUNT(*)' + qry_from, params).fetchone()
+        if max_rows is not None and max_rows < n_rows:
+            qry_from, params = _sample_sql(cursor, qry_from, params, max_rows, sample_by, seed)
+            n_rows = max_rows
+        n_mqns = len(cursor.execute('SELECT * FROM mqns LIMIT 0').description) - 1  # (minus g_id)
+        names, adducts, srcs, smis, cls_labs = [np.empty(n_rows, dtype=object) for _ in range(5)]
+        mzs, ccss = np.empty(n_rows, dtype=np.float64), np.empty(n_rows, dtype=np.float64)
+        mqns = np.empty((n_rows, n_mqns), dtype=np.int16)
+        qry = 'SELECT name, mz, adduct, ccs, src_tag, smi, chem_class_label, mqns.*' + qry_from + ' ORDER BY master.rowid'
+        cursor.execute(qry, params)
+        i = 0
+        while rows := cursor.fetchmany(_FETCH_BLOCK_SIZE):
+            block = np.array(rows, dtype=object)
+            j = i + block.shape[0]
+            names[i:j], mzs[i:j], adducts[i:j], ccss[i:j], srcs[i:j], smis[i:j], cls_labs[i:j] = block[:, :7].T
+            # (column 7 is mqns.g_id)
+            mqns[i:j] = block[:, 8:]
+            i = j
+    finally:
+        cursor.execute('RELEASE _fetch_dsets')
+    # self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_, self.mqn_, self.cls_lab_
+    return (_text_column(names), mzs, _text_column(adducts), ccss, _text_column(srcs), _text_column(smis), 
+            mqns, _text_column(cls_labs))
+
+
+def _fetch_single_dset(cursor: Cursor, 
+                       src_tag: str,
+                       annotation_filter: Optional[Dict[str, Any]] = None,
+                       **query: Any
                        ) -> Any :
     """
-    fetch name, mz, adduct, ccs, src_tag, smi, and chem_class_label for a dataset using
-    the provided src_tag
+    fetch name, mz, adduct, ccs, src_tag, smi, chem_class_label and MQNs for a dataset using
+    the provided src_tag (see `_fetch_dsets`)
 
     Parameters
     ----------
-    db_path : ``str`` 
-        path to C3S.db database file
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db database
     src_tag : ``str``
         specify the source dataset
+    annotation_filter : ``dict(str:Any)``, optional
+        only fetch entries with matching name annotations (see `_annotation_filter_sql`)
+    **query : ``Any``
+        where, max_rows, sample_by and seed (see `_fetch_dsets`)
     
     Returns
     -------
     names, mzs, adducts, ccss, srcs, smis, mqns, cls_labs : ``numpy.ndarray(...)``
     """
-    con = connect(db_path)
-    cur = con.cursor()
-    qryA = 'SELECT g_id, name, mz, adduct, ccs, src_tag, smi, chem_class_label FROM master WHERE src_tag="{}"'.format(src_tag) + \
-          ' AND smi IS NOT NULL AND g_id IN (SELECT g_id FROM mqns)'
-    qryB = 'SELECT mqns.* FROM mqns INNER JOIN master ON mqns.g_id=master.g_id WHERE master.src_tag="{}"'.format(src_tag)
-    names, mzs, adducts, ccss, srcs, smis, cls_labs = [], [], [], [], [], [], []
-    for _, name, mz, adduct, ccs, src, smi, cls_lab in cur.execute(qryA).fetchall():
-        names.append(name)
-        mzs.append(mz)
-        adducts.append(adduct)
-        ccss.append(ccs)
-        srcs.append(src)
-        smis.append(smi)
-        cls_labs.append(cls_lab)
-    # fetch mqns separately from the rest of the data
-    mqns = []
-    for _, *mqn in cur.execute(qryB).fetchall():
-        mqns.append(mqn)
-    con.close()
-    # self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_
-    return array(names), array(mzs), array(adducts), array(ccss), array(srcs), array(smis), array(mqns), array(cls_labs)
-
-
-def _fetch_multi_dset(db_path: str, 
-                      src_tags: List[str]
+    return _fetch_dsets(cursor, [src_tag], annotation_filter=annotation_filter, **query)
+
+
+def _fetch_multi_dset(cursor: Cursor, 
+                      src_tags: List[str],
+                      annotation_filter: Optional[Dict[str, Any]] = None,
+                      **query: Any
                       ) -> Any : 
     """
-    fetch name, mz, adduct, ccs, src_tag, smi, and chem_class_label for a set of datasets using
-    the provided src_tag
+    fetch name, mz, adduct, ccs, src_tag, smi, chem_class_label and MQNs for a set of datasets 
+    using the provided src_tags (see `_fetch_dsets`)
 
     Parameters
     ----------
-    db_path : ``str`` 
-        path to C3S.db database file
+    cursor : ``sqlite3.Cursor``
+        cursor for C3S.db database
     src_tags : ``list(str)``
-        specify the source dataset
+        specify the source datasets
+    annotation_filter : ``dict(str:Any)``, optional
+        only fetch entries with matching name annotations (see `_annotation_filter_sql`)
+    **query : ``Any``
+        where, max_rows, sample_by and seed (see `_fetch_dsets`)
     
     Returns
     -------
     names, mzs, adducts, ccss, srcs, smis, mqns, cls_labs : ``numpy.ndarray(...)``
     """
-    con = connect(db_path)
-    cur = con.cursor()
-    qryA = 'SELECT g_id, name, mz, adduct, ccs, src_tag, smi, chem_class_label FROM master WHERE src_tag IN ('
-    qryB = 'SELECT mqns.* FROM mqns INNER JOIN master ON mqns.g_id=master.g_id WHERE master.src_tag IN ('
-    for tag in src_tags:
-        qryA += '"{}",'.format(tag)
-        qryB += '"{}",'.format(tag)
-    qryA = qryA.rstrip(',') + ') AND smi IS NOT NULL AND g_id IN (SELECT g_id FROM mqns)'
-    qryB = qryB.rstrip(',') + ')'
-    names, mzs, adducts, ccss, srcs, smis, cls_labs = [], [], [], [], [], [], []
-    for _, name, mz, adduct, ccs, src, smi, cls_lab in cur.execute(qryA).fetchall():
-        names.append(name)
-        mzs.append(mz)
-        adducts.append(adduct)
-        ccss.append(ccs)
-        srcs.append(src)
-        smis.append(smi)
-        cls_labs.append(cls_lab)
-    # fetch mqns separately from the rest of the data
-    mqns = []
-    for _, *mqn in cur.execute(qryB).fetchall():
-        mqns.append(mqn)
-    con.close()
-    # self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_, self.mqn_
-    return array(names), array(mzs), array(adducts), array(ccss), array(srcs), array(smis), array(mqns), array(cls_labs)
+    return _fetch_dsets(cursor, src_tags, annotation_filter=annotation_filter, **query)
 
 
 def _filter_common_adducts(adducts: npt.ArrayLike
@@ -158,11 +414,8 @@ def _filter_common_adducts(adducts: npt.ArrayLike
         common_adducts : ``np.ndarrray(str)``
             numpy array containing adducts with uncommon adducts replaced with 'other'
         """
-        common = adducts.copy()
-        for i in range(common.shape[0]):
-            if common[i] not in _EXPLICIT_ADDUCTS:
-                common[i] = 'other'
-        return common
+        adducts = np.asarray(adducts)
+        return np.where(np.isin(adducts, _EXPLICIT_ADDUCTS), adducts, 'other')
 
 
 class C3SD:
@@ -175,7 +428,12 @@ class C3SD:
     def __init__(self, 
                  db_path: str, 
                  datasets: str | List[str] = [], 
-                 seed: int = 69
+                 seed: int = 69,
+                 annotation_filter: Optional[Dict[str, Any]] = None,
+                 cache_dir: Optional[str] = None,
+                 where: Optional[Dict[str, Any]] = None,
+                 max_rows: Optional[int] = None,
+                 sample_by: Optional[str] = None
                  ) -> None :
         """
         Initializes a new C3SD object using the path to the C3S.db database file. Uses the datasets specified in the
@@ -197,14 +455,22 @@ class C3SD:
         - self.cls_lab_
         
         An instance variable is created to hold individual datasets that make up the combined dataset. In the case of
-        datasets=None or datasets=[...], this will be a list of C3SD objects, each containing individual datasets. Some
-        methods will propagate transformations to the objects in this list, while others will not. In the case of an 
-        initialization with datasets='...', this will simply be the str provided with the datasets parameter and 
-        certain methods will become unavailable.
+        datasets=None or datasets=[...], this will be a sequence of C3SD objects, each containing individual datasets.
+        These are lightweight views that index into the arrays of this object (including the features once they have
+        been assembled, using the same adduct encoder) rather than separate copies fetched from the database, and they
+        are only created when they are first accessed. In the case of an initialization with datasets='...', this will 
+        simply be the str provided with the datasets parameter and certain methods will become unavailable.
         - self.datasets_
         
         The total number of compounds in the dataset is stored in an instance variable:
         - self.N_
+
+        If a cache directory is provided, the fetched data and the features assembled from them are
+        stored in an on-disk cache (see `c3sdb.ml.feature_cache.FeatureCache`) keyed on the database 
+        contents, datasets, annotation filter and feature configuration, and later C3SD objects with 
+        the same configuration load them memory-mapped from the cache instead (the arrays are read-only).
+        The cache (or None) is stored in an instance variable:
+        - self.cache_
         
         The following instance variables are initialized as None (must be set by calls to other methods):
         - self.X_             (full array of features -> set by self.featurize(...))
@@ -234,20 +500,64 @@ class C3SD:
         seed : ``int``, default=69
             pRNG seed to use for any data preparation steps with a stochastic component, stored in the
             self.seed_ instance variable 
+        annotation_filter : ``dict(str:Any)``, optional
+            only include entries with matching name annotations, filtering is done in the database 
+            query using the name_annotations table, e.g. ``{"lipid_class": "PC", "n_carbon": (34, 38)}``
+            (see `_annotation_filter_sql` for details), stored in the self.annotation_filter_ instance
+            variable 
+        cache_dir : ``str``, optional
+            directory for the on-disk data and feature cache, no caching if not provided
+        where : ``dict(str:Any)``, optional
+            only include entries with matching values in the master table, filtering is done in the 
+            database query (using its indexes), e.g. ``{"adduct": ["[M+H]+", "[M+Na]+"], "z": 1, 
+            "mz": (400., 900.), "ccs_type": "DT"}`` (see `_where_sql` for details), stored in the 
+            self.where_ instance variable
+        max_rows : ``int``, optional
+            only include a random sample of (at most) this many of the selected entries, the sample is 
+            drawn in the database (so only the sampled entries are fetched) and is reproducible for a 
+            given pRNG seed, stored in the self.max_rows_ instance variable
+        sample_by : ``str``, optional
+            stratify the sample (if max_rows is provided) on a column of the master table, e.g. "src_tag"
+            to keep the proportions of the datasets (see `_sample_sql`), stored in the self.sample_by_ 
+            instance variable
         """
         # store database file path and pRNG seed
         self.db_path_, self.seed_ = db_path, seed
-        # fetch data from the database
+        self.annotation_filter_ = annotation_filter
+        self.where_, self.max_rows_, self.sample_by_ = where, max_rows, sample_by
+        self.cache_ = FeatureCache(cache_dir) if cache_dir is not None else None
+        # a single read-only connection is used for everything fetched from the database
+        con = None
+        if type(datasets) == list and not datasets:
+            con = _connect_ro(self.db_path_)
+            datasets = _all_dset(con.cursor())
+        sample = (max_rows, sample_by, seed) if max_rows is not None else None
+        self.data_key_ = data_key(self.db_path_, datasets, annotation_filter, 
+                                  where=where, sample=sample) if self.cache_ is not None else None
+        # fetch data from the database (or the cache)
+        if self.cache_ is not None and (cached := self.cache_.load_data(self.data_key_)) is not None:
+            self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_, self.mqn_, self.cls_lab_ = [cached[name] for name in _DATA_ARRAYS]
+        else:
+            con = con or _connect_ro(self.db_path_)
+            query = {"where": where, "max_rows": max_rows, "sample_by": sample_by, "seed": seed}
+            if type(datasets) == str:
+                # fetch a single dataset
+                self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_, self.mqn_, self.cls_lab_ = _fetch_single_dset(con.cursor(), datasets, 
+                                                                                                                                    annotation_filter=annotation_filter, **query) 
+            else:
+                # fetch either a subset of datasets or all datasets
+                self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_, self.mqn_, self.cls_lab_ = _fetch_multi_dset(con.cursor(), datasets, 
+                                                                                                                                   annotation_filter=annotation_filter, **query)
+            if self.cache_ is not None:
+                self.cache_.save_data(self.data_key_, dict(zip(_DATA_ARRAYS, [self.cmpd_, self.mz_, self.adduct_, self.ccs_, 
+                                                                             self.src_, self.smi_, self.mqn_, self.cls_lab_])))
+        if con is not None:
+            con.close()
         if type(datasets) == str:
-            # fetch a single dataset
-            self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_, self.mqn_, self.cls_lab_ = _fetch_single_dset(self.db_path_, datasets) 
             self.datasets_ = datasets
-        elif type(datasets) == list:
-            if not datasets:
-                datasets = _all_dset(self.db_path_)
-            # fetch either a subset of datasets or all datasets
-            self.cmpd_, self.mz_, self.adduct_, self.ccs_, self.src_, self.smi_, self.mqn_, self.cls_lab_ = _fetch_multi_dset(self.db_path_, datasets)
-            self.datasets_ = [C3SD(self.db_path_, datasets=dset, seed=self.seed_) for dset in datasets]
+        else:
+            # individual datasets are views into the rows of this object, created on first access
+            self.datasets_ = _DatasetViews(self, datasets)
         # total number of compounds
         self.N_ = self.cmpd_.shape[0]
         # declare instance variables to use later
@@ -268,12 +578,13 @@ class C3SD:
 
     def assemble_features(self, 
                           encoded_adduct: bool = True, 
-                          mqn_indices: Optional[str | List[int]] = "all"
+                          mqn_indices: Optional[str | List[int]] = "all",
+                          dtype: Any = np.float64
                           ) -> Any :
         """
         Assembles features for ML using a combination of m/z, encoded MS adduct (using 1-hot encoding), and MQNs. 
 
-        The full concatenated feature set is stored in the self.X_ instance variable
+        The full feature set is written into a single (C-contiguous) array and stored in the self.X_ instance variable
         and self.ccs_ is simply copied into self.y_ instance variable. The self.n_features_ instance variable is also
         set accordingly. 
         The 1-hot encoder for MS adducts is stored in the self.OHEncoder_ instance variable (or just None if 1-hot 
@@ -282,8 +593,10 @@ class C3SD:
         As another option, an array containing the indices of specific MQNs to include may be provided, if an
         empty array is provided the MQNs are omitted entirely. 
         If encoded_adduct=False and mqn_indices=[] only the m/z is used in the feature set.
-        If the self.datasets_ instance variable is a list (of C3SD objects), then featurize is also called for each of
-        these objects using the same parameters. 
+        The C3SD objects in the self.datasets_ instance variable (if any) are views of this object, so they have the
+        same features (for their rows) without featurize being called on them.
+        If this object has a cache (self.cache_), the features are loaded from it if they have already been 
+        assembled with the same parameters, otherwise they are stored in it.
 
         Sets the following instance variables:
         - self.X_             (full array of features)
@@ -299,35 +612,40 @@ class C3SD:
         mqn_indices : ``str`` or ``List[int]`` or ``None``, default="all"
             individually specify indices of MQNs to include in the feature set,
             or "all" to include all or None to exclude
+        dtype : ``numpy.dtype``, default=numpy.float64
+            dtype of the feature array, e.g. numpy.float32 to halve its size
         """
-        ohe_adducts = None
+        if mqn_indices == 'all':
+            mqn_indices = [_ for _ in range(42)]
+        mqn_indices = mqn_indices or []
+        if self.cache_ is not None:
+            fkey = features_key(encoded_adduct, mqn_indices, dtype=dtype)
+            if (cached := self.cache_.load_features(self.data_key_, fkey)) is not None:
+                self.X_, self.y_, self.OHEncoder_ = cached
+                self.n_features_ = self.X_.shape[1]
+                return
+        adduct_codes, n_adducts = None, 0
         if encoded_adduct:
             # convert adducts to OneHot vectors
             # To reduce the number of adducts that have to get OneHot encoded, filter through the adducts list and
             # convert any adduct that is not among the top common adducts to a single label: 'other' 
-            self.OHEncoder_ = OneHotEncoder(sparse_output=False, categories='auto')
-            common_adducts = _filter_common_adducts(self.adduct_).reshape(-1, 1)
-            ohe_adducts = self.OHEncoder_.fit_transform(common_adducts).T
-        use_mqns = None
+            # (the encoder categories are the sorted unique adducts, so the codes come straight from np.unique)
+            categories, adduct_codes = np.unique(_filter_common_adducts(self.adduct_), return_inverse=True)
+            self.OHEncoder_ = OneHotEncoder(sparse_output=False, categories='auto').fit(categories.reshape(-1, 1))
+            n_adducts = categories.shape[0]
+        # m/z, then encoded adducts (if set), then the MQNs (if set), written straight into the features
+        X = np.zeros((self.N_, 1 + n_adducts + len(mqn_indices)), dtype=dtype)
+        X[:, 0] = self.mz_
+        if adduct_codes is not None:
+            X[np.arange(self.N_), 1 + adduct_codes.ravel()] = 1
         if mqn_indices:
-            if mqn_indices == 'all':
-                mqn_indices = [_ for _ in range(42)]
-            # index self.mqn_ to get the specified indices
-            use_mqns = self.mqn_.T[mqn_indices]
-        # start with m/z, then concatenate ohe_adducts (if set) and use_mqns (if set) 
-        x = self.mz_.reshape(1, -1)
-        if ohe_adducts is not None:
-            x = concatenate([x, ohe_adducts])
-        if use_mqns is not None:
-            x = concatenate([x, use_mqns])
+            X[:, 1 + n_adducts:] = self.mqn_[:, mqn_indices]
         # set self.X_ and self.y_, and n_features
-        self.X_ = x.T
+        self.X_ = X
         self.n_features_ = self.X_.shape[1]
         self.y_ = self.ccs_
-        # call featurize on all of the C3SD objects in self.datasets_ (if there are any)
-        if type(self.datasets_) == list:
-            for dset in self.datasets_:
-                dset.assemble_features(encoded_adduct=encoded_adduct, mqn_indices=mqn_indices)
+        if self.cache_ is not None:
+            self.cache_.save_features(self.data_key_, fkey, self.X_, self.y_, self.OHEncoder_)
 
     def train_test_split(self, 
                          stratify: str, 
@@ -468,11 +786,130 @@ class C3SD:
             pickle.dump(self.SScaler_, pf)
 
 
+class _ParentAttr:
+    """
+    Attribute of a dataset view (`_C3SDView`) that is taken from the same attribute of the parent C3SD object,
+    indexed to the rows of the dataset (unless rows=False), until it gets set on the view itself
+    """
+
+    def __init__(self, 
+                 rows: bool = True
+                 ) -> None :
+        self.rows_ = rows
+
+    def __set_name__(self, owner, name):
+        self.name_ = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.name_ in obj.__dict__:
+            return obj.__dict__[self.name_]
+        value = getattr(obj.parent_, self.name_)
+        if value is None or not self.rows_:
+            return value
+        return value[obj.rows_]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name_] = value
+
+
+def _dataset_rows(src: npt.NDArray[Any], 
+                  dataset: str
+                  ) -> slice | npt.NDArray[np.int64] :
+    """
+    Index of the rows belonging to a dataset, a slice if they are contiguous (so indexing 
+    gives views rather than copies of the arrays) otherwise an array of row indices
+    """
+    idx = np.flatnonzero(src == dataset)
+    if idx.size and idx[-1] - idx[0] + 1 == idx.size:
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+
+class _C3SDView(C3SD):
+    """
+    C3SD object for an individual dataset of a combined C3SD object, the data and features are 
+    indexed from the parent object on access rather than being fetched from the database
+    """
+
+    cmpd_ = _ParentAttr()
+    mz_ = _ParentAttr()
+    adduct_ = _ParentAttr()
+    ccs_ = _ParentAttr()
+    src_ = _ParentAttr()
+    smi_ = _ParentAttr()
+    mqn_ = _ParentAttr()
+    cls_lab_ = _ParentAttr()
+    X_ = _ParentAttr()
+    y_ = _ParentAttr()
+    n_features_ = _ParentAttr(rows=False)
+    OHEncoder_ = _ParentAttr(rows=False)
+
+    def __init__(self, 
+                 parent: C3SD, 
+                 dataset: str
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        parent : ``C3SD``
+            combined C3SD object containing the dataset
+        dataset : ``str``
+            the dataset (src_tag)
+        """
+        self.parent_ = parent
+        self.rows_ = _dataset_rows(parent.src_, dataset)
+        self.db_path_, self.seed_ = parent.db_path_, parent.seed_
+        self.annotation_filter_ = parent.annotation_filter_
+        self.where_, self.max_rows_, self.sample_by_ = parent.where_, parent.max_rows_, parent.sample_by_
+        self.cache_, self.data_key_ = None, None
+        self.datasets_ = dataset
+        self.N_ = self.src_.shape[0]
+        self.X_train_ = None
+        self.y_train_ = None
+        self.N_train_ = None
+        self.X_test_ = None
+        self.y_test_ = None
+        self.N_test_ = None
+        self.SSSplit_ = None
+        self.SScaler_ = None
+        self.X_train_ss_ = None
+        self.X_test_ss_ = None
+
+
+class _DatasetViews(Sequence):
+    """
+    Sequence of views (`_C3SDView`) of the individual datasets in a combined C3SD object, 
+    each view is created the first time it is accessed
+    """
+
+    def __init__(self, 
+                 parent: C3SD, 
+                 datasets: List[str]
+                 ) -> None :
+        self.parent_ = parent
+        self.datasets_ = list(datasets)
+        self.views_: Dict[str, _C3SDView] = {}
+
+    def __len__(self):
+        return len(self.datasets_)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        dataset = self.datasets_[i]
+        if dataset not in self.views_:
+            self.views_[dataset] = _C3SDView(self.parent_, dataset)
+        return self.views_[dataset]
+
+
 def data_for_inference(mzs: npt.ArrayLike, 
                        adducts: npt.ArrayLike, 
                        smis: npt.ArrayLike, 
                        encoder_f: str, 
-                       scaler_f: str
+                       scaler_f: str,
+                       mqn_cache: Optional[MQNCache] = None
                        ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_]] :
     """
     generate data for inference using lists of m/zs, adducts, smiles structures
@@ -498,6 +935,9 @@ def data_for_inference(mzs: npt.ArrayLike,
         paths to pickle files with
         fitted instances of OneHotEncoder and StandardScaler for encoding adducts and 
         scaling features, respectively
+    mqn_cache : ``c3sdb.build_utils.mqns.MQNCache``, optional
+        cache of MQNs keyed by SMILES structure, MQNs are computed only once for each 
+        unique SMILES structure regardless
     
     Returns
     -------
@@ -523,11 +963,13 @@ def data_for_inference(mzs: npt.ArrayLike,
     assert len(adducts) == len(smis)
     # filter and encode the adducts
     enc_adducts = encoder.transform(_filter_common_adducts(np.array(adducts)).reshape(-1, 1))
+    # compute MQNs once per unique structure
+    smi_to_mqns = compute_mqns_many(smis, mqn_cache=mqn_cache)
     # add features row-by-row, skip any for which generating MQNs fails
     features = []
     included = []
     for mz, enc_adduct, smi in zip(mzs, enc_adducts, smis):
-        if (mqns := compute_mqns(smi)) is not None:
+        if (mqns := smi_to_mqns[smi]) is not None:
             features.append([mz] + enc_adduct.tolist() + mqns)
             included.append(True)
         else:
@@ -0,0 +1,289 @@
+"""
+    c3sdb/ml/feature_cache.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module with an on-disk cache for the data fetched from C3S.db and the feature matrices
+    assembled from it (see `c3sdb.ml.data.C3SD`), so that repeatedly loading the same data
+    from an unchanged database (e.g. in training sweeps) does not have to query the database
+    and assemble the features every time
+
+    The cached arrays are stored as .npy files and loaded memory-mapped (read-only), so
+    loading is nearly instant and processes loading the same data share the pages
+"""
+
+
+from typing import Dict, Optional, Any, List, Tuple
+import tempfile
+import hashlib
+import shutil
+import pickle
+import os
+
+import numpy as np
+from numpy import typing as npt
+
+
+# version of the cache layout, part of every cache key
+_FEATURE_CACHE_VERSION: int = 2
+
+# names of the data arrays (fetched from the database) in the order they are fetched
+_DATA_ARRAYS: List[str] = ["cmpd", "mz", "adduct", "ccs", "src", "smi", "mqn", "cls_lab"]
+
+# memoized database content hashes, keyed by (path, size, modification time)
+_DB_HASHES: Dict[Tuple[str, int, int], str] = {}
+
+
+def db_content_hash(db_path: str
+                    ) -> str :
+    """
+    Computes a hash of the contents of a database file, memoized on the path, size and
+    modification time of the file so it is only computed once per process for an
+    unchanged database
+
+    Parameters
+    ----------
+    db_path : ``str``
+        path to the database file
+
+    Returns
+    -------
+    db_hash : ``str``
+        SHA1 hash of the database file contents
+    """
+    stat = os.stat(db_path)
+    memo_key = (os.path.abspath(db_path), stat.st_size, stat.st_mtime_ns)
+    if (db_hash := _DB_HASHES.get(memo_key)) is None:
+        sha1 = hashlib.sha1()
+        with open(db_path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                sha1.update(chunk)
+        db_hash = _DB_HASHES[memo_key] = sha1.hexdigest()
+    return db_hash
+
+
+def _key(*parts: Any
+         ) -> str :
+    """ cache key from the (repr of the) parts """
+    return hashlib.sha1(repr((_FEATURE_CACHE_VERSION,) + parts).encode()).hexdigest()
+
+
+def _filter_repr(filter_: Optional[Dict[str, Any]]
+                 ) -> Optional[List[Tuple[str, Any]]] :
+    """ normalized filter for a cache key """
+    if not filter_:
+        return None
+    # sets are unordered, tuples (ranges) and lists stay distinct in the repr
+    return sorted((col, sorted(value) if isinstance(value, set) else value) for col, value in filter_.items())
+
+
+def data_key(db_path: str,
+             datasets: str | List[str],
+             annotation_filter: Optional[Dict[str, Any]],
+             where: Optional[Dict[str, Any]] = None,
+             sample: Optional[Tuple[int, Optional[str], int]] = None
+             ) -> str :
+    """
+    Cache key for the data fetched from a database
+
+    Parameters
+    ----------
+    db_path : ``str``
+        path to C3S.db database file
+    datasets : ``str`` or ``list(str)``
+        dataset(s) that were fetched
+    annotation_filter : ``dict(str:Any)`` or None
+        name annotation filter that was used (see `c3sdb.ml.data._annotation_filter_sql`)
+    where : ``dict(str:Any)``, optional
+        master table filter that was used (see `c3sdb.ml.data._where_sql`)
+    sample : ``tuple(int, str or None, int)``, optional
+        max_rows, sample_by and pRNG seed if the data were sampled (see `c3sdb.ml.data._sample_sql`)
+
+    Returns
+    -------
+    key : ``str``
+        cache key
+    """
+    parts = (db_content_hash(db_path), datasets, _filter_repr(annotation_filter))
+    # (only part of the key if used, so keys for unfiltered data do not change)
+    if where or sample is not None:
+        parts += (_filter_repr(where), sample)
+    return _key(*parts)
+
+
+def features_key(encoded_adduct: bool,
+                 mqn_indices: List[int],
+                 dtype: Any = np.float64
+                 ) -> str :
+    """
+    Cache key for a feature configuration (see `c3sdb.ml.data.C3SD.assemble_features`)
+
+    Parameters
+    ----------
+    encoded_adduct : ``bool``
+        encoded MS adduct included in the feature set
+    mqn_indices : ``list(int)``
+        indices of the MQNs included in the feature set
+    dtype : ``numpy.dtype``, default=numpy.float64
+        dtype of the features
+
+    Returns
+    -------
+    key : ``str``
+        cache key
+    """
+    return _key(bool(encoded_adduct), [int(i) for i in mqn_indices], np.dtype(dtype).str)
+
+
+def _load_array(path: str
+                ) -> npt.NDArray[Any] :
+    """ load an array memory-mapped, arrays with Python objects (e.g. None) can not be """
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        return np.load(path, allow_pickle=True)
+
+
+class FeatureCache:
+    """
+    On-disk cache of data fetched from C3S.db and of the feature matrices assembled from
+    it. Each entry is a directory (named by its key) of .npy files, entries are written
+    to a temporary directory first and then moved into place, so readers never see a
+    partially written entry and concurrent writers of the same entry do not conflict.
+
+    Layout::
+
+        cache_dir/
+            <data key>/
+                cmpd.npy, mz.npy, adduct.npy, ccs.npy, src.npy, smi.npy, mqn.npy, cls_lab.npy
+                <features key>/
+                    X.npy, y.npy, OHEncoder.pkl
+    """
+
+    def __init__(self,
+                 cache_dir: str
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        cache_dir : ``str``
+            cache directory, created if it does not exist
+        """
+        self.cache_dir_ = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _commit(self,
+                tmp_dir: str,
+                entry_dir: str
+                ) -> None :
+        """ move a finished entry into place (someone else may have beaten us to it) """
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load_data(self,
+                  dkey: str
+                  ) -> Optional[Dict[str, npt.NDArray[Any]]] :
+        """
+        Load cached data arrays
+
+        Parameters
+        ----------
+        dkey : ``str``
+            data cache key (see `data_key`)
+
+        Returns
+        -------
+        arrays : ``dict(str:numpy.ndarray)`` or ``None``
+            memory-mapped data arrays (see _DATA_ARRAYS), None if not cached
+        """
+        entry_dir = os.path.join(self.cache_dir_, dkey)
+        if not os.path.isdir(entry_dir):
+            return None
+        return {name: _load_array(os.path.join(entry_dir, name + ".npy")) for name in _DATA_ARRAYS}
+
+    def save_data(self,
+                  dkey: str,
+                  arrays: Dict[str, npt.NDArray[Any]]
+                  ) -> None :
+        """
+        Store data arrays in the cache
+
+        Parameters
+        ----------
+        dkey : ``str``
+            data cache key (see `data_key`)
+        arrays : ``dict(str:numpy.ndarray)``
+            data arrays (see _DATA_ARRAYS)
+        """
+        entry_dir = os.path.join(self.cache_dir_, dkey)
+        if os.path.isdir(entry_dir):
+            return
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir_)
+        for name in _DATA_ARRAYS:
+            np.save(os.path.join(tmp_dir, name + ".npy"), arrays[name], allow_pickle=True)
+        self._commit(tmp_dir, entry_dir)
+
+    def load_features(self,
+                      dkey: str,
+                      fkey: str
+                      ) -> Optional[Tuple[npt.NDArray[Any], npt.NDArray[Any], Any]] :
+        """
+        Load a cached feature matrix
+
+        Parameters
+        ----------
+        dkey : ``str``
+            data cache key (see `data_key`)
+        fkey : ``str``
+            features cache key (see `features_key`)
+
+        Returns
+        -------
+        X, y : ``numpy.ndarray(float)``
+            memory-mapped features and labels
+        ohe : ``sklearn.preprocessing.OneHotEncoder`` or ``None``
+            fitted adduct encoder (None if the adducts are not encoded)
+
+        or ``None`` if not cached
+        """
+        entry_dir = os.path.join(self.cache_dir_, dkey, fkey)
+        if not os.path.isdir(entry_dir):
+            return None
+        with open(os.path.join(entry_dir, "OHEncoder.pkl"), "rb") as pf:
+            ohe = pickle.load(pf)
+        return _load_array(os.path.join(entry_dir, "X.npy")), _load_array(os.path.join(entry_dir, "y.npy")), ohe
+
+    def save_features(self,
+                      dkey: str,
+                      fkey: str,
+                      X: npt.NDArray[Any],
+                      y: npt.NDArray[Any],
+                      ohe: Any
+                      ) -> None :
+        """
+        Store a feature matrix in the cache, the data it was assembled from must already
+        be stored (see `save_data`)
+
+        Parameters
+        ----------
+        dkey : ``str``
+            data cache key (see `data_key`)
+        fkey : ``str``
+            features cache key (see `features_key`)
+        X, y : ``numpy.ndarray(float)``
+            features and labels
+        ohe : ``sklearn.preprocessing.OneHotEncoder`` or ``None``
+            fitted adduct encoder (None if the adducts are not encoded)
+        """
+        data_dir = os.path.join(self.cache_dir_, dkey)
+        entry_dir = os.path.join(data_dir, fkey)
+        if not os.path.isdir(data_dir) or os.path.isdir(entry_dir):
+            return
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=data_dir)
+        np.save(os.path.join(tmp_dir, "X.npy"), np.ascontiguousarray(X))
+        np.save(os.path.join(tmp_dir, "y.npy"), np.ascontiguousarray(y))
+        with open(os.path.join(tmp_dir, "OHEncoder.pkl"), "wb") as pf:
+            pickle.dump(ohe, pf)
+        self._commit(tmp_dir, entry_dir)
@@ -0,0 +1,262 @@
+"""
+    c3sdb/ml/predict.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Module with a long-lived CCS predictor for inference, it loads the fitted encoder,
+    scaler and model once and keeps computed MQNs around, so repeated calls (e.g.
+    annotating batches of features as they come in) only pay for the new structures
+"""
+
+
+from typing import Optional, List, Tuple, Dict
+from collections import OrderedDict
+import pickle
+import os
+
+import numpy as np
+from numpy import typing as npt
+from rdkit.rdBase import BlockLogs
+
+from c3sdb.build_utils.mqns import MQNCache, _MQNPool, _mqns_for_chunk, _MQN_TIMEOUT
+from c3sdb.ml.data import _filter_common_adducts, pretrained_data
+
+
+# number of MQNs per structure
+_N_MQNS: int = 42
+
+
+class CCSPredictor:
+    """
+    Predicts CCS from m/z, MS adduct and SMILES structure using a fitted adduct encoder
+    (OneHotEncoder), feature scaler (StandardScaler) and model (e.g. KMCMulti), which are
+    loaded once when the predictor is created.
+
+    MQNs for unique structures that have not been seen before are computed in chunks (in
+    parallel by a pool of worker processes that is kept around between calls if n_workers > 1,
+    with a wall-clock time limit per structure), and kept in an in-memory LRU cache keyed by 
+    SMILES structure (and optionally in a persistent MQN cache as well). Failed structures are 
+    cached too, except for ones that timed out. Cache hits and misses are counted in the 
+    ``hits_`` and ``misses_`` attributes.
+
+    The worker pool should be shut down when done, either with ``close()`` or by using the
+    predictor as a context manager.
+    """
+
+    def __init__(self,
+                 model_f: Optional[str] = None,
+                 encoder_f: Optional[str] = None,
+                 scaler_f: Optional[str] = None,
+                 n_workers: int = 1,
+                 chunk_size: int = 256,
+                 lru_size: int = 100000,
+                 mqn_cache: Optional[MQNCache] = None,
+                 timeout: float = 10.
+                 ) -> None :
+        """
+        Parameters
+        ----------
+        model_f : ``str``, optional
+        encoder_f : ``str``, optional
+        scaler_f : ``str``, optional
+            paths to pickle files with the fitted model, OneHotEncoder and StandardScaler,
+            respectively, default to the pretrained ones (see `c3sdb.ml.data.pretrained_data`)
+        n_workers : ``int``, default=1
+            number of worker processes for computing MQNs, with a single worker everything is
+            computed in this process
+        chunk_size : ``int``, default=256
+            number of structures for each worker to process at a time, batches with fewer new
+            structures than this are computed in this process
+        lru_size : ``int``, default=100000
+            maximum number of structures to keep MQNs for in the in-memory cache
+        mqn_cache : ``c3sdb.build_utils.mqns.MQNCache``, optional
+            persistent cache of MQNs keyed by SMILES structure, checked for structures that
+            are not in the in-memory cache and newly computed MQNs are added to it
+        timeout : ``float``, default=10.
+            wall-clock time limit (in seconds) for computing MQNs for a single structure
+            in the worker pool, structures that take longer are treated as failed
+        """
+        model_f = str(pretrained_data("c3sdb_kmcm_svr.pkl")) if model_f is None else model_f
+        encoder_f = str(pretrained_data("c3sdb_OHEncoder.pkl")) if encoder_f is None else encoder_f
+        scaler_f = str(pretrained_data("c3sdb_SScaler.pkl")) if scaler_f is None else scaler_f
+        for f in [model_f, encoder_f, scaler_f]:
+            if not os.path.isfile(f):
+                msg = f"CCSPredictor: pickle file {f} not found"
+                raise FileNotFoundError(msg)
+        with open(model_f, "rb") as pf:
+            self.model_ = pickle.load(pf)
+        with open(encoder_f, "rb") as pf:
+            self.encoder_ = pickle.load(pf)
+        with open(scaler_f, "rb") as pf:
+            self.scaler_ = pickle.load(pf)
+        # encoded adducts are the (sorted) encoder categories
+        self.categories_ = np.asarray(self.encoder_.categories_[0]).astype(str)
+        self.n_features_ = 1 + self.categories_.shape[0] + _N_MQNS
+        self.n_workers_, self.chunk_size_ = n_workers, chunk_size
+        self.lru_size_ = lru_size
+        self.mqn_cache_ = mqn_cache
+        self.timeout_ = timeout
+        self.lru_: OrderedDict[str, Optional[npt.NDArray[np.int16]]] = OrderedDict()
+        self.pool_ = None
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def _compute(self,
+                 smis: List[str]
+                 ) -> List[Tuple[str, Optional[List[int]], Optional[str]]] :
+        """ compute MQNs for unique structures, in parallel chunks if there are enough of them """
+        chunks = [[(smi, smi) for smi in smis[i:i + self.chunk_size_]]
+                  for i in range(0, len(smis), self.chunk_size_)]
+        if self.n_workers_ > 1 and len(chunks) > 1:
+            if self.pool_ is None:
+                self.pool_ = _MQNPool(self.n_workers_)
+            results = list(self.pool_.imap(chunks, self.timeout_))
+        else:
+            # only silence RDKit (SMILES parse errors) while computing MQNs
+            with BlockLogs():
+                results = [_mqns_for_chunk(chunk) for chunk in chunks]
+        return [result for chunk_results in results for result in chunk_results]
+
+    def _mqns(self,
+              smis: List[str]
+              ) -> Dict[str, Optional[npt.NDArray[np.int16]]] :
+        """
+        Gets MQNs for unique structures from the in-memory cache, the persistent cache, or
+        by computing them (and adding them to the caches)
+
+        Parameters
+        ----------
+        smis : ``list(str)``
+            unique SMILES structures
+
+        Returns
+        -------
+        smi_to_mqns : ``dict(str:numpy.ndarray(int16) or None)``
+            mapping of SMILES structures to MQNs (None if they could not be computed)
+        """
+        smi_to_mqns, missing = {}, []
+        for smi in smis:
+            if smi in self.lru_:
+                self.lru_.move_to_end(smi)
+                smi_to_mqns[smi] = self.lru_[smi]
+            else:
+                missing.append(smi)
+        self.hits_ += len(smis) - len(missing)
+        self.misses_ += len(missing)
+        if missing:
+            new = {}
+            if self.mqn_cache_ is not None:
+                new.update({smi: mqn for smi, (mqn, _) in self.mqn_cache_.get_many(missing).items()})
+            computed = self._compute([smi for smi in missing if smi not in new])
+            if self.mqn_cache_ is not None:
+                self.mqn_cache_.put_many(computed)
+            new.update({smi: mqn for smi, mqn, _ in computed})
+            timed_out = {smi for smi, _, reason in computed if reason == _MQN_TIMEOUT}
+            for smi, mqn in new.items():
+                smi_to_mqns[smi] = None if mqn is None else np.array(mqn, dtype=np.int16)
+                if smi not in timed_out:
+                    self.lru_[smi] = smi_to_mqns[smi]
+            while len(self.lru_) > self.lru_size_:
+                self.lru_.popitem(last=False)
+        return smi_to_mqns
+
+    def featurize(self,
+                  mzs: npt.ArrayLike,
+                  adducts: npt.ArrayLike,
+                  smis: npt.ArrayLike
+                  ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_]] :
+        """
+        Generates scaled features (m/z + encoded adduct + all 42 MQNs) for inference
+
+        Parameters
+        ----------
+        mzs : ``arraylike(float)``
+            input m/zs
+        adducts : ``arraylike(str)``
+            input adducts (will be run through `c3sdb.ml.data._filter_common_adducts`
+            first to ensure they are all encodable)
+        smis : ``arraylike(str)``
+            input SMILES structures
+
+        Returns
+        -------
+        X : ``numpy.ndarray(float)``
+            scaled features ready for inference
+        included : ``numpy.ndarray(bool)``
+            array of booleans (same shape as input arrays) indicating which rows from the
+            original input data were able to have MQNs computed for them and thus were
+            included in the features
+        """
+        mzs, adducts, smis = np.asarray(mzs, dtype=np.float64), np.asarray(adducts), np.asarray(smis, dtype=object)
+        if not (mzs.shape[0] == adducts.shape[0] == smis.shape[0]):
+            msg = (f"CCSPredictor: featurize: mzs, adducts and smis must have the same length "
+                   f"({mzs.shape[0]}, {adducts.shape[0]}, {smis.shape[0]})")
+            raise ValueError(msg)
+        # encode adducts by looking them up in the (sorted) encoder categories
+        common = _filter_common_adducts(adducts).astype(str)
+        codes = np.minimum(np.searchsorted(self.categories_, common), self.categories_.shape[0] - 1)
+        if not np.array_equal(self.categories_[codes], common):
+            unknown = sorted(set(common[self.categories_[codes] != common]))
+            msg = f"CCSPredictor: featurize: adducts {unknown} can not be encoded"
+            raise ValueError(msg)
+        # MQNs once per unique structure
+        unique, inverse = np.unique(smis.astype(str), return_inverse=True)
+        smi_to_mqns = self._mqns(unique.tolist())
+        unique_mqns = [smi_to_mqns[smi] for smi in unique.tolist()]
+        included = np.array([mqn is not None for mqn in unique_mqns], dtype=bool)[inverse.ravel()]
+        # assemble features for the included rows
+        n_cat = self.categories_.shape[0]
+        X = np.zeros((int(included.sum()), self.n_features_), dtype=np.float64)
+        X[:, 0] = mzs[included]
+        X[np.arange(X.shape[0]), 1 + codes[included]] = 1
+        if X.shape[0]:
+            mqn_block = np.stack([np.zeros(_N_MQNS, dtype=np.int16) if mqn is None else mqn for mqn in unique_mqns])
+            X[:, 1 + n_cat:] = mqn_block[inverse.ravel()[included]]
+            X = self.scaler_.transform(X, copy=False)
+        return X, included
+
+    def predict(self,
+                mzs: npt.ArrayLike,
+                adducts: npt.ArrayLike,
+                smis: npt.ArrayLike
+                ) -> Tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_]] :
+        """
+        Predicts CCS
+
+        Parameters
+        ----------
+        mzs : ``arraylike(float)``
+            input m/zs
+        adducts : ``arraylike(str)``
+            input adducts
+        smis : ``arraylike(str)``
+            input SMILES structures
+
+        Returns
+        -------
+        ccs : ``numpy.ndarray(float)``
+            predicted CCS for the included rows
+        included : ``numpy.ndarray(bool)``
+            array of booleans (same shape as input arrays) indicating which rows from the
+            original input data were able to have MQNs computed for them and thus have a
+            predicted CCS
+        """
+        X, included = self.featurize(mzs, adducts, smis)
+        if not X.shape[0]:
+            return np.empty(0, dtype=np.float64), included
+        return np.asarray(self.model_.predict(X), dtype=np.float64), included
+
+    def close(self
+              ) -> None :
+        """ shut down the MQN worker pool (if any) """
+        if self.pool_ is not None:
+            self.pool_.close()
+            self.pool_ = None
+
+    def __enter__(self
+                  ) -> "CCSPredictor" :
+        return self
+
+    def __exit__(self, *args
+                 ) -> None :
+        self.close()
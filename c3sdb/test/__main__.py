@@ -6,3 +6,16 @@
     Run all defined unit tests in the test sub-package
 """
 
+
+import unittest
+import sys
+import os
+
+
+if __name__ == "__main__":
+    # test modules mirror the names of the modules they test, so match every module
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    top_dir = os.path.dirname(os.path.dirname(test_dir))
+    tests = unittest.TestLoader().discover(test_dir, pattern="*.py", top_level_dir=top_dir)
+    result = unittest.TextTestRunner(verbosity=2).run(tests)
+    sys.exit(not result.wasSuccessful())
@@ -4,4 +4,107 @@
     Dylan Ross (dylan.ross@pnnl.gov)
 
     Unit tests for the c3sdb.build_utils._remote module
-"""
\ No newline at end of file
+"""
+
+
+import unittest
+import tempfile
+import base64
+import json
+import os
+
+from c3sdb.build_utils._transport import replay_session
+from c3sdb.build_utils._remote import _PUBCHEM_URL, pubchem_search_by_name, pubchem_cids_fetch_smiles
+
+
+def _write_archive(archive, responses):
+    """ writes a replay archive with the (url, status, body) responses """
+    with open(archive, "w") as af:
+        for url, status, body in responses:
+            record = {"method": "GET", "url": url, "status": status, "headers": {}, 
+                      "content": base64.b64encode(body.encode()).decode()}
+            af.write(json.dumps(record) + "\n")
+
+
+def _cids_url(cids):
+    """ PubChem URL for fetching the SMILES structures for a batch of CIDs """
+    return _PUBCHEM_URL + "compound/cid/" + ",".join(map(str, cids)) + "/property/IsomericSMILES,CanonicalSMILES/JSON"
+
+
+class TestPubChemCIDsFetchSmiles(unittest.TestCase):
+    """ tests for fetching SMILES structures for batches of PubChem CIDs """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.archive = os.path.join(self.tmp_dir.name, "archive.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _fetch(self, cids, status, body):
+        _write_archive(self.archive, [(_cids_url(cids), status, body)])
+        return pubchem_cids_fetch_smiles(replay_session(self.archive), cids)
+
+    def test_found(self):
+        """ CIDs without SMILES structures are left out of the results """
+        body = json.dumps({"PropertyTable": {"Properties": [
+            {"CID": 2519, "IsomericSMILES": "CN1C=NC2=C1C(=O)N(C(=O)N2C)C"}, 
+            {"CID": 702, "CanonicalSMILES": "CCO"},
+            {"CID": 1}
+        ]}})
+        cid_to_smi, n_requests = self._fetch([2519, 702, 1], 200, body)
+        self.assertEqual(cid_to_smi, {2519: "CN1C=NC2=C1C(=O)N(C(=O)N2C)C", 702: "CCO"})
+        self.assertEqual(n_requests, 1)
+
+    def test_not_found(self):
+        """ a 404 means PubChem does not have any of the CIDs """
+        body = json.dumps({"Fault": {"Code": "PUGREST.NotFound", "Message": "No CID found"}})
+        self.assertEqual(self._fetch([1, 2], 404, body), ({}, 1))
+
+    def test_failed(self):
+        """ failed requests return None instead of an empty mapping """
+        # error status
+        body = json.dumps({"Fault": {"Code": "PUGREST.ServerBusy"}})
+        self.assertIsNone(self._fetch([1, 2], 503, body)[0])
+        # not JSON
+        self.assertIsNone(self._fetch([1, 2], 200, "<html></html>")[0])
+        # not a property table
+        self.assertIsNone(self._fetch([1, 2], 200, json.dumps({"Fault": {}}))[0])
+        # no response at all
+        _write_archive(self.archive, [])
+        cid_to_smi, n_requests = pubchem_cids_fetch_smiles(replay_session(self.archive), [1, 2])
+        self.assertIsNone(cid_to_smi)
+        self.assertEqual(n_requests, 1)
+
+    def test_empty(self):
+        """ no request is sent for an empty batch """
+        _write_archive(self.archive, [])
+        self.assertEqual(pubchem_cids_fetch_smiles(replay_session(self.archive), []), ({}, 0))
+
+
+class TestPubChemSearchByName(unittest.TestCase):
+    """ tests for searching PubChem by compound name """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.archive = os.path.join(self.tmp_dir.name, "archive.jsonl")
+        _write_archive(self.archive, [
+            (_PUBCHEM_URL + "compound/name/caffeine/cids/TXT", 200, "2519\n"),
+            (_PUBCHEM_URL + "compound/name/nothing/cids/TXT", 404, "Status: 404\n"),
+            (_PUBCHEM_URL + "compound/name/busy/cids/TXT", 503, "Status: 503\n"),
+        ])
+        self.session = replay_session(self.archive)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_search(self):
+        """ matches, no matches, and failed searches """
+        self.assertEqual(pubchem_search_by_name(self.session, "caffeine"), ([2519], 1))
+        self.assertEqual(pubchem_search_by_name(self.session, "nothing"), ([], 1))
+        self.assertIsNone(pubchem_search_by_name(self.session, "busy")[0])
+        self.assertIsNone(pubchem_search_by_name(self.session, "unrecorded")[0])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
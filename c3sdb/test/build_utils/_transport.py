@@ -0,0 +1,92 @@
+"""
+    c3sdb/test/build_utils/_transport.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Unit tests for the c3sdb.build_utils._transport module
+"""
+
+
+import unittest
+from unittest import mock
+import tempfile
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from c3sdb.build_utils._transport import (
+    ResponseNotRecorded, ReplayAdapter, recording_session, replay_session
+)
+
+
+def _fake_send(request, **kwargs):
+    """ stands in for HTTPAdapter.send, responds without touching the network """
+    resp = requests.Response()
+    resp.status_code = 404 if "missing" in request.url else 200
+    resp.headers = CaseInsensitiveDict({"Content-Type": "text/plain; charset=utf-8", "X-Test": "yes"})
+    resp._content = f"response for {request.url}\n".encode()
+    resp.url = request.url
+    resp.request = request
+    return resp
+
+
+class TestRecordReplay(unittest.TestCase):
+    """ tests for recording responses into an archive and replaying them """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.archive = os.path.join(self.tmp_dir.name, "archive.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _record(self, urls):
+        session = recording_session(self.archive)
+        with mock.patch.object(HTTPAdapter, "send", side_effect=_fake_send):
+            return [session.get(url) for url in urls]
+
+    def test_round_trip(self):
+        """ replayed responses match the recorded ones """
+        urls = ["https://example.com/a", "https://example.com/missing", "http://example.org/b?c=1"]
+        recorded = self._record(urls)
+        session = replay_session(self.archive)
+        for url, rec in zip(urls, recorded):
+            resp = session.get(url)
+            self.assertEqual(resp.status_code, rec.status_code)
+            self.assertEqual(resp.content, rec.content)
+            self.assertEqual(resp.text, rec.text)
+            self.assertEqual(resp.headers["X-Test"], "yes")
+            self.assertEqual(resp.ok, rec.ok)
+
+    def test_last_recording_wins(self):
+        """ URLs recorded more than once replay the last recorded response """
+        self._record(["https://example.com/a"])
+        def send_gone(request, **kwargs):
+            resp = _fake_send(request)
+            resp.status_code = 410
+            return resp
+        with mock.patch.object(HTTPAdapter, "send", side_effect=send_gone):
+            recording_session(self.archive).get("https://example.com/a")
+        resp = replay_session(self.archive).get("https://example.com/a")
+        self.assertEqual(resp.status_code, 410)
+        self.assertEqual(resp.reason, "Gone")
+
+    def test_not_recorded(self):
+        """ requests for URLs that were not recorded raise ResponseNotRecorded """
+        self._record(["https://example.com/a"])
+        session = replay_session(self.archive)
+        with self.assertRaises(ResponseNotRecorded):
+            session.get("https://example.com/b")
+        # it is still a RequestException, so callers handle it like other request failures
+        self.assertTrue(issubclass(ResponseNotRecorded, requests.RequestException))
+
+    def test_missing_archive(self):
+        """ a replay archive that does not exist raises a ValueError """
+        with self.assertRaises(ValueError):
+            ReplayAdapter(os.path.join(self.tmp_dir.name, "nope.jsonl"))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -4,4 +4,60 @@
     Dylan Ross (dylan.ross@pnnl.gov)
 
     Unit tests for the c3sdb.build_utils.db_init module
-"""
\ No newline at end of file
+"""
+
+
+import unittest
+import tempfile
+import sqlite3
+import os
+
+from c3sdb.build_utils.db_init import _INCLUDE_PATH, _SCHEMA_VERSION, create_db, migrate_db
+
+
+class TestMigrateDb(unittest.TestCase):
+    """ tests for upgrading databases made with the version 0 schema """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "C3S.db")
+        # version 0 schema: same master table, mqns.g_id declared INTEGER
+        con = sqlite3.connect(self.db_path)
+        with open(os.path.join(_INCLUDE_PATH, "C3SDB_schema.sqlite3"), "r") as sql_f:
+            con.executescript(sql_f.read())
+        cols = ", ".join(f"m{i} INTEGER NOT NULL" for i in range(42))
+        con.execute(f"CREATE TABLE mqns (g_id INTEGER UNIQUE NOT NULL, {cols})")
+        con.executemany("INSERT INTO master VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", 
+                        [(g_id, "compound", "[M+H]+", 100., 1, 101., 150., "C", None, "test", "DT", "single field")
+                         for g_id in ["a", "b", "c"]])
+        # MQNs out of order, with one that has no entry in master
+        con.executemany(f"INSERT INTO mqns VALUES ({','.join('?' * 43)})", 
+                        [(g_id, *[i] * 42) for i, g_id in enumerate(["z", "c", "a", "b"])])
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_create_db_refuses(self):
+        """ create_db does not touch a database that needs to be upgraded first """
+        with self.assertRaises(RuntimeError):
+            create_db(self.db_path, overwrite=False)
+
+    def test_migrate(self):
+        """ mqns is rebuilt with g_id declared TEXT and rows in master order """
+        self.assertTrue(migrate_db(self.db_path))
+        con = sqlite3.connect(self.db_path)
+        self.assertEqual(con.execute("PRAGMA user_version").fetchone()[0], _SCHEMA_VERSION)
+        g_id_type, = [t for _, name, t, *_ in con.execute("PRAGMA table_info(mqns)") if name == "g_id"]
+        self.assertEqual(g_id_type, "TEXT")
+        qry = "SELECT g_id, c FROM mqns ORDER BY rowid"
+        self.assertEqual(con.execute(qry).fetchall(), [("a", 2), ("b", 3), ("c", 1), ("z", 0)])
+        self.assertEqual(con.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+        con.close()
+        # already up to date
+        self.assertFalse(migrate_db(self.db_path))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
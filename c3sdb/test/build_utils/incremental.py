@@ -0,0 +1,97 @@
+"""
+    c3sdb/test/build_utils/incremental.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Unit tests for the c3sdb.build_utils.incremental module
+"""
+
+
+import unittest
+import tempfile
+import sqlite3
+import os
+
+from c3sdb.build_utils.db_init import create_db
+from c3sdb.build_utils.incremental import (
+    src_file_hash, plan_incremental, record_dataset, remove_dataset, order_datasets
+)
+
+
+def _add_entries(cursor, src_tag, n):
+    """ adds n placeholder entries from a source dataset to the master table """
+    qry = "INSERT INTO master VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"
+    cursor.executemany(qry, [(f"{src_tag}_{i}", f"compound {i}", "[M+H]+", 100., 1, 101., 150.,
+                              None, None, src_tag, "DT", "single field")
+                             for i in range(n)])
+
+
+class TestPlanIncremental(unittest.TestCase):
+    """ tests for planning incremental builds from the build manifest """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp_dir.name, "C3S.db")
+        create_db(db_path)
+        self.con = sqlite3.connect(db_path)
+        self.cur = self.con.cursor()
+
+    def tearDown(self):
+        self.con.close()
+        self.tmp_dir.cleanup()
+
+    def test_empty_db(self):
+        """ everything is added to an empty database """
+        src_tags = ["zhou1016", "zhou0817"]
+        self.assertEqual(plan_incremental(self.cur, src_tags), (src_tags, [], []))
+
+    def test_plan(self):
+        """ new, changed, unchanged, dropped and unrecorded source datasets """
+        # unchanged
+        _add_entries(self.cur, "zhou1016", 3)
+        record_dataset(self.cur, "zhou1016", 3)
+        # changed (the recorded hash does not match the file)
+        _add_entries(self.cur, "zhou0817", 2)
+        self.cur.execute("INSERT INTO build_manifest VALUES (?,?,?,?)", ("zhou0817", "0" * 40, 2, 0.))
+        # dropped
+        _add_entries(self.cur, "zhen0917", 2)
+        record_dataset(self.cur, "zhen0917", 2)
+        # in the database but not in the manifest (gets removed and added again)
+        _add_entries(self.cur, "pagl0314", 1)
+        to_add, to_remove, unchanged = plan_incremental(self.cur, ["zhou1016", "zhou0817", "pagl0314", "righ0218"])
+        self.assertEqual(to_add, ["zhou0817", "pagl0314", "righ0218"])
+        self.assertEqual(sorted(to_remove), ["pagl0314", "zhen0917", "zhou0817"])
+        self.assertEqual(unchanged, ["zhou1016"])
+
+    def test_record_dataset(self):
+        """ recorded datasets have the hash of the current file """
+        record_dataset(self.cur, "zhou1016", 0)
+        src_hash, = self.cur.execute("SELECT src_hash FROM build_manifest WHERE src_tag='zhou1016'").fetchone()
+        self.assertEqual(src_hash, src_file_hash("zhou1016"))
+
+    def test_remove_dataset(self):
+        """ removing a dataset also removes its MQNs and manifest entry """
+        _add_entries(self.cur, "zhou1016", 3)
+        _add_entries(self.cur, "zhou0817", 2)
+        record_dataset(self.cur, "zhou1016", 3)
+        self.cur.executemany(f"INSERT INTO mqns VALUES ({','.join('?' * 43)})",
+                             [(g_id, *[0] * 42) for g_id in ["zhou1016_0", "zhou0817_0"]])
+        self.assertEqual(remove_dataset(self.cur, "zhou1016"), 3)
+        self.assertEqual(self.cur.execute("SELECT g_id FROM mqns").fetchall(), [("zhou0817_0",)])
+        self.assertEqual(plan_incremental(self.cur, ["zhou1016"]), (["zhou1016"], ["zhou0817"], []))
+
+    def test_order_datasets(self):
+        """ re-added datasets are moved back to where a fresh build puts them """
+        _add_entries(self.cur, "zhou1016", 2)
+        _add_entries(self.cur, "zhen0917", 2)
+        _add_entries(self.cur, "zhou0817", 2)
+        src_tags = ["zhou1016", "zhou0817", "zhen0917"]
+        self.assertTrue(order_datasets(self.cur, src_tags))
+        g_ids = [g_id for g_id, in self.cur.execute("SELECT g_id FROM master ORDER BY rowid")]
+        self.assertEqual(g_ids, [f"{src_tag}_{i}" for src_tag in src_tags for i in range(2)])
+        # already in order
+        self.assertFalse(order_datasets(self.cur, src_tags))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,74 @@
+"""
+    c3sdb/test/build_utils/search_cache.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Unit tests for the c3sdb.build_utils.search_cache module
+"""
+
+
+import unittest
+import tempfile
+import time
+import os
+
+from c3sdb.build_utils.search_cache import SmilesSearchCache
+
+
+class TestNegativeCache(unittest.TestCase):
+    """ tests for the negative cache of SmilesSearchCache """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "cache.db")
+        self.cache = SmilesSearchCache(self.db_path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def test_expiry(self):
+        """ expired entries are treated as missing """
+        t_now = time.time()
+        self.cache.negative["live"] = t_now + 3600.
+        self.cache.negative["expired"] = t_now - 1.
+        self.assertIn("live", self.cache.negative)
+        self.assertNotIn("expired", self.cache.negative)
+        self.assertEqual(self.cache.negative["live"], t_now + 3600.)
+        with self.assertRaises(KeyError):
+            self.cache.negative["expired"]
+        self.assertEqual(list(self.cache.negative), ["live"])
+        self.assertEqual(len(self.cache.negative), 1)
+        # does not affect the positive cache
+        self.assertNotIn("live", self.cache)
+
+    def test_replace(self):
+        """ setting an entry again replaces its expiration time """
+        self.cache.negative["name"] = time.time() - 1.
+        self.assertNotIn("name", self.cache.negative)
+        self.cache.negative["name"] = time.time() + 3600.
+        self.assertIn("name", self.cache.negative)
+
+    def test_purge_expired(self):
+        """ purge_expired removes only the expired entries """
+        t_now = time.time()
+        self.cache.negative["live"] = t_now + 3600.
+        self.cache.negative["expired"] = t_now - 1.
+        self.cache["compound"] = "CCO"
+        self.assertEqual(self.cache.purge_expired(), 1)
+        # the expired entry is gone from the database, not just hidden
+        qry = "SELECT name FROM negative_cache"
+        self.assertEqual(self.cache.con_.execute(qry).fetchall(), [("live",)])
+        self.assertEqual(self.cache["compound"], "CCO")
+
+    def test_persistence(self):
+        """ entries are still there after reopening the cache """
+        expires = time.time() + 3600.
+        self.cache.negative["name"] = expires
+        self.cache.close()
+        self.cache = SmilesSearchCache(self.db_path)
+        self.assertEqual(self.cache.negative["name"], expires)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
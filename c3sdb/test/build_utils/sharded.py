@@ -0,0 +1,85 @@
+"""
+    c3sdb/test/build_utils/sharded.py
+
+    Dylan Ross (dylan.ross@pnnl.gov)
+
+    Unit tests for the c3sdb.build_utils.sharded module
+"""
+
+
+import unittest
+import tempfile
+import sqlite3
+import os
+
+from c3sdb.build_utils.db_init import create_db
+from c3sdb.build_utils.sharded import merge_shard
+
+
+def _add_entries(cursor, src_tag, g_ids, ccs=150.):
+    """ adds placeholder entries (with MQNs and name annotations) to a database """
+    cursor.executemany("INSERT INTO master VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                       [(g_id, "compound", "[M+H]+", 100., 1, 101., ccs, "C", None, src_tag, "DT", "single field")
+                        for g_id in g_ids])
+    cursor.executemany(f"INSERT INTO mqns VALUES ({','.join('?' * 43)})",
+                       [(g_id, *[int(ccs)] * 42) for g_id in g_ids])
+    cursor.executemany("INSERT INTO name_annotations VALUES (?,?,?,?,?,?,?,?)",
+                       [(g_id, None, None, None, None, None, 0, 0) for g_id in g_ids])
+    cursor.execute("INSERT OR REPLACE INTO build_manifest VALUES (?,?,?,?)", (src_tag, f"{ccs}", len(g_ids), 0.))
+
+
+class TestMergeShard(unittest.TestCase):
+    """ tests for merging shard databases into C3S.db """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp_dir.name, "C3S.db")
+        create_db(db_path)
+        self.con = sqlite3.connect(db_path)
+        self.cur = self.con.cursor()
+        _add_entries(self.cur, "zhou1016", ["a", "b"])
+        self.con.commit()
+
+    def tearDown(self):
+        self.con.close()
+        self.tmp_dir.cleanup()
+
+    def _shard(self, name, src_tag, g_ids, ccs):
+        shard_path = os.path.join(self.tmp_dir.name, name)
+        create_db(shard_path)
+        con = sqlite3.connect(shard_path)
+        _add_entries(con.cursor(), src_tag, g_ids, ccs=ccs)
+        con.commit()
+        con.close()
+        return shard_path
+
+    def test_merge(self):
+        """ entries from a shard are added in order after the existing ones """
+        shard_path = self._shard("s1.db", "zhou0817", ["e", "d", "c"], 200.)
+        self.assertEqual(merge_shard(self.cur, shard_path), 3)
+        for table in ["master", "mqns"]:
+            g_ids = [g_id for g_id, in self.cur.execute(f"SELECT g_id FROM {table} ORDER BY rowid")]
+            self.assertEqual(g_ids, ["a", "b", "e", "d", "c"])
+        self.assertEqual(self.cur.execute("SELECT COUNT(*) FROM name_annotations").fetchone()[0], 5)
+        self.assertEqual(self.cur.execute("SELECT COUNT(*) FROM build_manifest").fetchone()[0], 2)
+        # the shard is detached afterwards
+        self.assertEqual([db for _, db, _ in self.cur.execute("PRAGMA database_list")], ["main"])
+
+    def test_duplicates(self):
+        """ entries already in C3S.db are skipped (with their MQNs), manifest entries are replaced """
+        shard_path = self._shard("s1.db", "zhou1016", ["b", "c"], 200.)
+        self.assertEqual(merge_shard(self.cur, shard_path), 1)
+        qry = "SELECT g_id, ccs FROM master ORDER BY rowid"
+        self.assertEqual(self.cur.execute(qry).fetchall(), [("a", 150.), ("b", 150.), ("c", 200.)])
+        qry = "SELECT g_id, c FROM mqns ORDER BY rowid"
+        self.assertEqual(self.cur.execute(qry).fetchall(), [("a", 150), ("b", 150), ("c", 200)])
+        self.assertEqual(self.cur.execute("SELECT COUNT(*) FROM name_annotations").fetchone()[0], 3)
+        qry = "SELECT src_tag, src_hash FROM build_manifest"
+        self.assertEqual(self.cur.execute(qry).fetchall(), [("zhou1016", "200.0")])
+        # merging the same shard again does not add anything
+        self.assertEqual(merge_shard(self.cur, shard_path), 0)
+        self.assertEqual(self.cur.execute("SELECT COUNT(*) FROM mqns").fetchone()[0], 3)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
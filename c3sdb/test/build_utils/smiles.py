@@ -4,4 +4,116 @@
     Dylan Ross (dylan.ross@pnnl.gov)
 
     Unit tests for the c3sdb.build_utils.smiles module
-"""
\ No newline at end of file
+"""
+
+
+import unittest
+import contextlib
+import tempfile
+import sqlite3
+import json
+import time
+import io
+import os
+
+from c3sdb.build_utils.db_init import create_db
+from c3sdb.build_utils._transport import replay_session
+from c3sdb.build_utils._remote import _PUBCHEM_URL
+from c3sdb.build_utils.search_cache import SmilesSearchCache
+from c3sdb.build_utils.smiles import _in_negative_cache, add_smiles_to_db
+from c3sdb.test.build_utils._remote import _write_archive, _cids_url
+
+
+# SMILES structure for caffeine (PubChem CID 2519)
+_CAFFEINE: str = "CN1C=NC2=C1C(=O)N(C(=O)N2C)C"
+
+
+class TestInNegativeCache(unittest.TestCase):
+    """ tests for checking names against the negative cache """
+
+    def test_expiry(self):
+        """ only entries that have not expired count """
+        t_now = time.time()
+        negative_cache = {"live": t_now + 1., "expired": t_now - 1.}
+        self.assertTrue(_in_negative_cache(negative_cache, "live", t_now))
+        self.assertFalse(_in_negative_cache(negative_cache, "expired", t_now))
+        self.assertFalse(_in_negative_cache(negative_cache, "other", t_now))
+        self.assertFalse(_in_negative_cache(None, "live", t_now))
+
+
+class TestAddSmilesToDb(unittest.TestCase):
+    """ tests for resolving SMILES structures with responses replayed from an archive """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(self.tmp_dir.name, "C3S.db")
+        create_db(db_path)
+        self.con = sqlite3.connect(db_path)
+        self.cur = self.con.cursor()
+        self.cur.executemany("INSERT INTO master VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", 
+                             [(g_id, name, "[M+H]+", 100., 1, 101., 150., None, None, "test", "DT", "single field") 
+                              for g_id, name in [("1", "caffeine"), ("2", "nothing"), ("3", "caffeine")]])
+        self.archive = os.path.join(self.tmp_dir.name, "archive.jsonl")
+        self.cache = SmilesSearchCache(os.path.join(self.tmp_dir.name, "cache.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.con.close()
+        self.tmp_dir.cleanup()
+
+    def _add_smiles(self, cids_status, cids_body):
+        """ resolve the names, caffeine is found by name and nothing is not """
+        _write_archive(self.archive, [
+            (_PUBCHEM_URL + "compound/name/caffeine/cids/TXT", 200, "2519\n"),
+            (_PUBCHEM_URL + "compound/name/nothing/cids/TXT", 404, "Status: 404\n"),
+            (_cids_url([2519]), cids_status, cids_body),
+        ])
+        with contextlib.redirect_stdout(io.StringIO()):
+            return add_smiles_to_db(self.cur, replay_session(self.archive), self.cache, 
+                                    n_workers=1, negative_cache=self.cache.negative)
+
+    def test_found(self):
+        """ found names get their SMILES structures added to the database and search cache """
+        body = json.dumps({"PropertyTable": {"Properties": [{"CID": 2519, "IsomericSMILES": _CAFFEINE}]}})
+        n_smiles, n_requests = self._add_smiles(200, body)
+        self.assertEqual((n_smiles, n_requests), (2, 3))
+        qry = "SELECT g_id, smi FROM master ORDER BY rowid"
+        self.assertEqual(self.cur.execute(qry).fetchall(), [("1", _CAFFEINE), ("2", None), ("3", _CAFFEINE)])
+        self.assertEqual(self.cache["caffeine"], _CAFFEINE)
+        self.assertEqual(self.cache.get_source("caffeine"), "pubchem")
+        self.assertEqual(list(self.cache.negative), ["nothing"])
+
+    def test_no_smiles(self):
+        """ names that PubChem answered without a SMILES structure are negative-cached """
+        body = json.dumps({"Fault": {"Code": "PUGREST.NotFound"}})
+        self.assertEqual(self._add_smiles(404, body)[0], 0)
+        self.assertEqual(sorted(self.cache.negative), ["caffeine", "nothing"])
+        body = json.dumps({"PropertyTable": {"Properties": [{"CID": 2519}]}})
+        self.cache.negative.clear()
+        self.assertEqual(self._add_smiles(200, body)[0], 0)
+        self.assertEqual(sorted(self.cache.negative), ["caffeine", "nothing"])
+
+    def test_failed_batch(self):
+        """ names from a failed CID batch stay unresolved and are not negative-cached """
+        for status, body in [(503, json.dumps({"Fault": {"Code": "PUGREST.ServerBusy"}})), (200, "<html></html>")]:
+            self.assertEqual(self._add_smiles(status, body)[0], 0)
+            self.assertNotIn("caffeine", self.cache)
+            self.assertEqual(list(self.cache.negative), ["nothing"])
+        # looked up again the next time around
+        self.cache.negative.clear()
+        body = json.dumps({"PropertyTable": {"Properties": [{"CID": 2519, "IsomericSMILES": _CAFFEINE}]}})
+        self.assertEqual(self._add_smiles(200, body)[0], 2)
+
+    def test_negative_cache(self):
+        """ names in the negative cache are skipped until their entries expire """
+        self.cache.negative["caffeine"] = time.time() + 3600.
+        self.cache.negative["nothing"] = time.time() - 1.
+        body = json.dumps({"PropertyTable": {"Properties": [{"CID": 2519, "IsomericSMILES": _CAFFEINE}]}})
+        n_smiles, n_requests = self._add_smiles(200, body)
+        # only the name search for nothing was sent
+        self.assertEqual((n_smiles, n_requests), (0, 1))
+        self.assertGreater(self.cache.negative["nothing"], time.time())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)